@@ -0,0 +1,26 @@
+import time
+
+class BootProfile:
+    """Milliseconds from reset to each boot stage
+
+    time.ticks_ms() starts at 0 on reset, so each mark is an absolute
+    time since power-on (including the interpreter start and imports).
+    Only the first occurrence of a stage is kept.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.reported = False
+
+    def mark(self, stage):
+        if stage in self.stages:
+            return
+        now = time.ticks_ms()
+        self.stages[stage] = now
+        print(f"Boot: {stage} at {now} ms")
+
+    def summary(self):
+        """Stage -> ms since reset, in the order reached"""
+        return dict(self.stages)
+
+BOOT = BootProfile()
@@ -20,11 +20,150 @@ SHADOW_GET_TOPIC = f"$aws/things/{DEVICE_ID}/shadow/get"
 SHADOW_UPDATE_ACCEPTED_TOPIC = f"$aws/things/{DEVICE_ID}/shadow/update/accepted"
 SHADOW_UPDATE_REJECTED_TOPIC = f"$aws/things/{DEVICE_ID}/shadow/update/rejected"
 SHADOW_GET_ACCEPTED_TOPIC = f"$aws/things/{DEVICE_ID}/shadow/get/accepted"
+SHADOW_UPDATE_DELTA_TOPIC = f"$aws/things/{DEVICE_ID}/shadow/update/delta"
+TELEMETRY_TOPIC = f"irrigation/{DEVICE_ID}/telemetry"
+METRICS_TOPIC = f"irrigation/{DEVICE_ID}/metrics"
+PROGRAM_COMMAND_TOPIC = f"irrigation/{DEVICE_ID}/cmd/program"
+LOG_TOPIC = f"irrigation/{DEVICE_ID}/log"
+LOG_COMMAND_TOPIC = f"irrigation/{DEVICE_ID}/cmd/log"
 
 # Hardware Configuration
+VALVE_DRIVER = "gpio"  # "gpio" (VALVE_PINS) or "shift_register" (74HC595 chain)
 VALVE_PINS = [2, 3, 4, 5, 6, 7, 8, 9]  # GPIO pins for 8 valves
-NUM_VALVES = 8
+NUM_VALVES = 8  # Up to len(VALVE_PINS) for gpio, 8 per register for shift_register
+VALVE_MAX_RUN_SECONDS = [3600] * NUM_VALVES  # Hard auto-off per valve (0 = no limit)
+
+# 74HC595 chain on hardware SPI (VALVE_DRIVER = "shift_register")
+SHIFT_REGISTER_SPI_ID = 0
+SHIFT_REGISTER_BAUDRATE = 1000000
+SHIFT_REGISTER_SCK_PIN = 18
+SHIFT_REGISTER_MOSI_PIN = 19
+SHIFT_REGISTER_LATCH_PIN = 17
 
 # Time sync configuration
-NTP_SERVER = "pool.ntp.org"
-TIME_SYNC_INTERVAL_HOURS = 3
\ No newline at end of file
+NTP_SERVERS = ["0.pool.ntp.org", "1.pool.ntp.org", "time.google.com"]  # Queried concurrently
+NTP_PORT = 123
+NTP_TIMEOUT_MS = 1500  # Wait for replies from all servers
+TIME_SYNC_INTERVAL_HOURS = 3  # Initial sync interval; adapted to the measured drift
+NTP_MIN_INTERVAL_SECONDS = 15 * 60
+NTP_MAX_INTERVAL_SECONDS = 24 * 3600
+NTP_TARGET_ERROR_MS = 250  # Interval grows while drift error stays well below this
+NTP_STEP_THRESHOLD_MS = 2000  # Larger offsets step the RTC; smaller ones are slewed
+NTP_SLEW_RATE_PPM = 500  # Slew speed (500 ppm = 0.5 ms per second)
+NTP_MAX_DRIFT_PPM = 500
+MIN_VALID_YEAR = 2024  # RTC years before this mean the clock was never set
+
+# Runtime task intervals
+WIFI_CHECK_INTERVAL_MS = 2000
+MQTT_POLL_INTERVAL_MS = 50  # Reader back-off while disconnected
+MQTT_KEEPALIVE_SECONDS = 60
+MQTT_IDLE_WAIT_MS = 30000  # Longest the reader blocks on the socket without a wake-up
+MQTT_MAX_MESSAGES_PER_WAKE = 8
+MQTT_CHECK_INTERVAL_MS = 5000
+MQTT_BACKOFF_MIN_MS = 1000
+MQTT_BACKOFF_MAX_MS = 120000
+NTP_CHECK_INTERVAL_MS = 60000
+HEARTBEAT_INTERVAL_SECONDS = 60  # Local check for unreported valve changes
+VALVE_SAFETY_INTERVAL_MS = 1000
+GC_INTERVAL_MS = 10000  # Planned time between collections
+GC_CHECK_INTERVAL_MS = 250  # Retry delay when a due collection found no idle slack
+GC_THRESHOLD_MIN_BYTES = 4096  # Bounds for the automatic gc.threshold backstop
+GC_THRESHOLD_MAX_BYTES = 65536
+GC_MIN_SLACK_MS = 20  # Never collect closer than this to the next scheduled event
+GC_HOLD_MIN_FREE_BYTES = 16384  # Collect before disabling GC if less heap than this is free
+
+# Timer wheel (all periodic work runs from it)
+TIMER_TICK_MS = 20
+TIMER_WHEEL_SLOTS = 64  # One revolution = TIMER_TICK_MS * TIMER_WHEEL_SLOTS
+WATCHDOG_ENABLED = False  # Hardware watchdog fed from the timer wheel
+WATCHDOG_TIMEOUT_MS = 8000  # RP2350 maximum is about 8.3 s
+
+# Shadow reporting
+SHADOW_REPORT_COALESCE_MS = 500  # Changes within this window go out as one update
+COMMAND_COALESCE_MS = 150  # Valve commands this close to the previous one are merged per valve
+COMMAND_QUEUE_MAX = 16  # Commands merged before the batch is applied without waiting
+TELEMETRY_INTERVAL_SECONDS = 900
+TELEMETRY_MAX_BYTES = 256
+
+# Store-and-forward outbox (publishes made while MQTT is down)
+OUTBOX_PATH = "/outbox.bin"
+OUTBOX_SLOTS = 32
+# Largest valve report: 62 bytes of framing plus at most 17 per valve (shadow_codec.py)
+VALVE_REPORT_MAX_BYTES = 62 + 17 * NUM_VALVES
+# A slot holds the 8-byte header, the topic and the largest report or telemetry message
+OUTBOX_SLOT_SIZE = 8 + len(SHADOW_UPDATE_TOPIC) + max(TELEMETRY_MAX_BYTES, VALVE_REPORT_MAX_BYTES)
+OUTBOX_DRAIN_BATCH = 4
+OUTBOX_DRAIN_INTERVAL_MS = 1000
+
+# Local irrigation schedules
+SCHEDULE_PATH = "/schedules.json"
+SCHEDULE_TICK_MS = 1000
+SCHEDULE_UTC_OFFSET_MINUTES = 0  # Program start times are local = UTC + offset
+SCHEDULE_MISSED_GRACE_SECONDS = 300  # Starts later than this (clock step) are skipped
+SCHEDULE_MAX_STEP_SECONDS = 4 * 3600
+SCHEDULE_MAX_SOAK_SECONDS = 4 * 3600  # Optional third step element: valves closed before the next step
+BATCH_MAX_STEPS = 32
+BATCH_QUEUE_MAX = 4  # Batch programs waiting behind the active run
+
+# Hot-path latency/heap metrics (off by default; near-zero cost when off)
+METRICS_ENABLED = False
+METRICS_INTERVAL_SECONDS = 300
+
+# Idle power
+WLAN_POWER_SAVE = True  # PM_POWERSAVE while no valve is open
+LIGHTSLEEP_ENABLED = False  # machine.lightsleep() between events while no valve is open
+LIGHTSLEEP_MIN_MS = 50
+LIGHTSLEEP_MAX_MS = 1000
+POWER_CHECK_INTERVAL_MS = 1000
+
+# LAN control endpoint (see local_api.py)
+LOCAL_API_TOKEN = ""  # Shared secret sent as "Authorization: Bearer <token>"; empty disables the endpoint
+LOCAL_API_PORT = 8080
+LOCAL_API_TIMEOUT_MS = 2000  # Whole request must arrive within this
+LOCAL_API_MAX_BODY = 512
+LOCAL_API_MAX_LINE = 256  # Longest request or header line
+LOCAL_API_MAX_HEADERS = 16
+LOCAL_API_MAX_CLIENTS = 2
+
+# Warm-boot journal (valve state, run position, shadow version)
+JOURNAL_PATH = "/journal.bin"
+JOURNAL_COMPACT_BYTES = 4096  # Rewritten as just the latest records past this size
+JOURNAL_CHECKPOINT_SECONDS = 30  # Remaining run time is re-journaled this often while watering
+
+# Dual-core split: valves and schedules on core 1, networking on core 0
+VALVE_CORE_ENABLED = True  # Falls back to single-core where _thread is missing
+VALVE_CORE_POLL_MS = 1  # Core 1 loop period: mailbox, run timers, schedule ticks
+VALVE_CORE_MAILBOX_SLOTS = 8
+VALVE_CORE_EVENT_SLOTS = 16  # Callbacks queued from core 1 for core 0 (journal, reports)
+VALVE_CORE_CALL_TIMEOUT_MS = 100
+
+# Flow and pressure sensing (see flow_monitor.py); both pins None disables it
+FLOW_PIN = None  # Flow meter pulse output (e.g. 22)
+FLOW_PULSES_PER_LITER = 450  # Flow meter K-factor
+PRESSURE_ADC_PIN = None  # Pressure transducer on an ADC pin (e.g. 26)
+PRESSURE_RAW_ZERO = 6554  # read_u16() at 0 kPa
+PRESSURE_RAW_FULL_SCALE = 58982  # read_u16() at PRESSURE_KPA_FULL_SCALE
+PRESSURE_KPA_FULL_SCALE = 1200
+SENSOR_SAMPLE_HZ = 50  # Timer IRQ sampling rate
+SENSOR_RING_SAMPLES = 256  # Per ring; must cover SENSOR_BATCH_MS of samples
+SENSOR_BATCH_MS = 1000  # Samples are aggregated once per batch
+FLOW_SETTLE_MS = 10000  # Ignore flow checks this long after any valve change
+LEAK_FLOW_LPM = 0.5  # Flow at or above this with all valves OFF counts as a leak
+LEAK_CONFIRM_BATCHES = 5  # Consecutive leak batches before the emergency stop
+NO_FLOW_LPM = 0.2  # An open zone below this is flagged "no_flow"
+NO_FLOW_CONFIRM_BATCHES = 10
+FLOW_REPORT_INTERVAL_SECONDS = 300
+
+# Ring-buffer log (see log.py)
+LOG_LEVEL = "info"  # debug, info, warning or error; lower levels cost one no-op call
+LOG_CONSOLE_LEVEL = "warning"  # Records at or above this are also printed ("debug" on the bench)
+LOG_RING_RECORDS = 128
+LOG_UPLOAD_BATCH = 16  # Records per message when uploading on LOG_COMMAND_TOPIC
+
+# Concurrent zones (default: one valve ON at a time)
+CONCURRENT_ZONES = False  # Open several valves together within the budgets below
+VALVE_CURRENT_MA = [250] * NUM_VALVES  # Holding current per solenoid
+VALVE_FLOW_LPM = [8] * NUM_VALVES  # Rated flow per zone
+CURRENT_BUDGET_MA = 750  # Valve supply current available for open solenoids
+FLOW_BUDGET_LPM = 24  # Water supply available for open zones
+VALVE_OPEN_STAGGER_MS = 250  # Minimum gap between two openings (inrush)
\ No newline at end of file
@@ -0,0 +1,196 @@
+import time
+import machine
+from array import array
+from machine import Pin
+from config import (
+    NUM_VALVES, FLOW_PIN, FLOW_PULSES_PER_LITER, PRESSURE_ADC_PIN, PRESSURE_RAW_ZERO,
+    PRESSURE_RAW_FULL_SCALE, PRESSURE_KPA_FULL_SCALE, SENSOR_SAMPLE_HZ, SENSOR_RING_SAMPLES,
+    FLOW_SETTLE_MS, VALVE_FLOW_LPM, LEAK_FLOW_LPM, LEAK_CONFIRM_BATCHES, NO_FLOW_LPM, NO_FLOW_CONFIRM_BATCHES
+)
+from log import LOG
+
+def _ring_reduce(fn, ring, start, count):
+    """fn over count ring entries from start, without a Python loop per sample"""
+    view = memoryview(ring)
+    end = start + count
+    if end <= len(ring):
+        return fn(view[start:end])
+    return fn((fn(view[start:]), fn(view[:end - len(ring)])))
+
+class FlowMonitor:
+    """Flow meter and pressure sensor feedback for the valves
+
+    A hard IRQ counts flow meter pulses; a timer IRQ at SENSOR_SAMPLE_HZ
+    stores the pulses since the previous sample and one pressure reading
+    in preallocated array rings. The IRQs do no other work and allocate
+    nothing. process() runs once per batch (on the valve core), reduces
+    the new samples with sum() over memoryview slices, and charges
+    the water to the open zone (split by rated flow when zones run
+    concurrently).
+
+    Flow while every valve is closed, once FLOW_SETTLE_MS has passed since
+    the last change, means a leak or a valve stuck open: after
+    LEAK_CONFIRM_BATCHES such batches all valves are emergency stopped and
+    on_fault is called. An open zone without flow is flagged "no_flow".
+    """
+
+    def __init__(self, valve_controller):
+        self.valve_controller = valve_controller
+        self.pulse_ring = array('H', bytes(2 * SENSOR_RING_SAMPLES))
+        self.pressure_ring = array('H', bytes(2 * SENSOR_RING_SAMPLES))
+        # IRQ-owned counters (single-element arrays so IRQs update them in place)
+        self._pulses = array('I', [0])
+        self._written = array('I', [0])
+        self._processed = 0
+        self.zone_pulses = array('I', bytes(4 * NUM_VALVES))
+        self.leak_pulses = 0
+        self.flow_lpm = 0.0
+        self.pressure_kpa = None
+        self.faults = {}
+        self.overruns = 0
+        self._last_mask = 0
+        self._mask_changed_ms = time.ticks_ms()
+        self._leak_batches = 0
+        self._dry_batches = 0
+        # on_fault(kind, detail) after an automatic emergency stop
+        self.on_fault = None
+        self._timer = None
+        self._flow_pin = None
+        self._adc = None
+
+    def start(self):
+        """Attach the pulse IRQ and start the sampling timer"""
+        pulses = self._pulses
+        if FLOW_PIN is not None:
+            self._flow_pin = Pin(FLOW_PIN, Pin.IN, Pin.PULL_UP)
+
+            def on_pulse(pin):
+                pulses[0] += 1
+
+            self._flow_pin.irq(handler=on_pulse, trigger=Pin.IRQ_FALLING, hard=True)
+        if PRESSURE_ADC_PIN is not None:
+            self._adc = machine.ADC(PRESSURE_ADC_PIN)
+
+        self._timer = machine.Timer()
+        self._timer.init(mode=machine.Timer.PERIODIC, freq=SENSOR_SAMPLE_HZ,
+                         callback=self._make_sample_callback(), hard=True)
+        print(f"Flow monitor: flow pin {FLOW_PIN}, pressure ADC {PRESSURE_ADC_PIN}, {SENSOR_SAMPLE_HZ} Hz")
+
+    def _make_sample_callback(self):
+        """Build the allocation-free sampling IRQ"""
+        pulses = self._pulses
+        written = self._written
+        pulse_ring = self.pulse_ring
+        pressure_ring = self.pressure_ring
+        adc = self._adc
+        last = array('I', [0])
+
+        def sample(timer):
+            n = written[0]
+            i = n % SENSOR_RING_SAMPLES
+            count = pulses[0]
+            pulse_ring[i] = (count - last[0]) & 0xFFFF
+            last[0] = count
+            if adc is not None:
+                pressure_ring[i] = adc.read_u16()
+            written[0] = n + 1
+
+        return sample
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+        if self._flow_pin is not None:
+            self._flow_pin.irq(handler=None)
+
+    def process(self):
+        """Aggregate the samples taken since the last batch and check for faults"""
+        written = self._written[0]
+        count = (written - self._processed) & 0xFFFFFFFF
+        if not count:
+            return
+        if count > SENSOR_RING_SAMPLES:
+            self.overruns += 1
+            count = SENSOR_RING_SAMPLES
+        start = (written - count) % SENSOR_RING_SAMPLES
+        self._processed = written
+
+        pulses = _ring_reduce(sum, self.pulse_ring, start, count)
+        self.flow_lpm = pulses * 60 * SENSOR_SAMPLE_HZ / (FLOW_PULSES_PER_LITER * count)
+        if self._adc is not None:
+            raw = _ring_reduce(sum, self.pressure_ring, start, count) // count
+            self.pressure_kpa = max(0, (raw - PRESSURE_RAW_ZERO) * PRESSURE_KPA_FULL_SCALE
+                                    // (PRESSURE_RAW_FULL_SCALE - PRESSURE_RAW_ZERO))
+
+        valves = self.valve_controller
+        mask = valves.state_mask
+        now = time.ticks_ms()
+        if mask != self._last_mask:
+            self._last_mask = mask
+            self._mask_changed_ms = now
+            self._leak_batches = 0
+            self._dry_batches = 0
+        settled = time.ticks_diff(now, self._mask_changed_ms) >= FLOW_SETTLE_MS
+
+        if mask:
+            self.faults.pop("leak", None)
+            active = valves.active_valve
+            if mask & (mask - 1):
+                self._share_pulses(mask, pulses)
+            elif active is not None:
+                self.zone_pulses[active] += pulses
+            if settled and self.flow_lpm < NO_FLOW_LPM:
+                self._dry_batches += 1
+                if self._dry_batches == NO_FLOW_CONFIRM_BATCHES:
+                    self.faults["no_flow"] = None if active is None else active + 1
+                    LOG.warning("Flow monitor: no flow through valve %s", self.faults["no_flow"])
+            else:
+                self._dry_batches = 0
+                self.faults.pop("no_flow", None)
+            return
+
+        self.faults.pop("no_flow", None)
+        self.leak_pulses += pulses
+        if settled and self.flow_lpm >= LEAK_FLOW_LPM:
+            self._leak_batches += 1
+            if self._leak_batches == LEAK_CONFIRM_BATCHES:
+                LOG.error("Flow monitor: %.1f L/min with all valves OFF", self.flow_lpm)
+                valves.emergency_stop()
+                self.faults["leak"] = round(self.flow_lpm, 1)
+                if self.on_fault:
+                    self.on_fault("leak", self.faults["leak"])
+        else:
+            self._leak_batches = 0
+            if settled:
+                self.faults.pop("leak", None)
+
+    def _share_pulses(self, mask, pulses):
+        """Split a batch between concurrently open zones by their rated flow"""
+        rated = 0
+        for i in range(NUM_VALVES):
+            if mask & (1 << i):
+                rated += VALVE_FLOW_LPM[i]
+        if not rated:
+            return
+        for i in range(NUM_VALVES):
+            if mask & (1 << i):
+                self.zone_pulses[i] += pulses * VALVE_FLOW_LPM[i] // rated
+
+    def summary(self):
+        """Compact reported-state form: liters per zone, leak liters, rate, pressure, faults"""
+        liters = FLOW_PULSES_PER_LITER
+        return {
+            "zone_l": [round(p / liters, 1) for p in self.zone_pulses],
+            "leak_l": round(self.leak_pulses / liters, 1),
+            "lpm": round(self.flow_lpm, 1),
+            "kpa": self.pressure_kpa,
+            "faults": dict(self.faults)
+        }
+
+    def get_status(self):
+        """Get flow monitor status"""
+        status = self.summary()
+        status['samples'] = self._written[0]
+        status['overruns'] = self.overruns
+        return status
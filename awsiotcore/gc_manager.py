@@ -0,0 +1,132 @@
+import gc
+import time
+from config import (
+    GC_INTERVAL_MS, GC_THRESHOLD_MIN_BYTES, GC_THRESHOLD_MAX_BYTES, GC_MIN_SLACK_MS,
+    GC_HOLD_MIN_FREE_BYTES
+)
+
+class GCManager:
+    """Slack-time garbage collection
+
+    Collections are planned instead of left to allocation pressure: the
+    automatic threshold is sized from the measured allocation rate so it
+    only trips as a backstop, and maybe_collect() runs gc.collect() when a
+    collection is due and the time to the next scheduled event leaves room
+    for a pause. Between hold() and release() (command receipt through
+    valve actuation) automatic collection is disabled.
+    """
+
+    def __init__(self, next_event_ms=None):
+        # Callable returning ms until the next scheduled event, or None if nothing is due
+        self.next_event_ms = next_event_ms
+        self.threshold = GC_THRESHOLD_MAX_BYTES
+        self.rate = 0               # Allocation rate, bytes/s (smoothed)
+        self._held = 0
+        self._sample_alloc = gc.mem_alloc()
+        self._sample_ms = time.ticks_ms()
+        self._base_alloc = self._sample_alloc
+        self.last_collect_ms = self._sample_ms
+        # Pause statistics
+        self.collections = 0
+        self.deferred = 0
+        self.pause_last_us = 0
+        self.pause_max_us = 0
+        self.pause_total_us = 0
+        gc.threshold(self.threshold)
+
+    def hold(self):
+        """Suspend automatic collection on the command path
+
+        With automatic collection off a full heap raises MemoryError instead
+        of collecting, so a low heap is collected first.
+        """
+        if not self._held:
+            if gc.mem_free() < GC_HOLD_MIN_FREE_BYTES:
+                self.collect()
+            gc.disable()
+        self._held += 1
+
+    def release(self):
+        self._held -= 1
+        if not self._held:
+            gc.enable()
+
+    def sample(self):
+        """Update the allocation rate and retune gc.threshold"""
+        now = time.ticks_ms()
+        alloc = gc.mem_alloc()
+        elapsed = time.ticks_diff(now, self._sample_ms)
+        delta = alloc - self._sample_alloc
+        self._sample_ms = now
+        self._sample_alloc = alloc
+        if elapsed <= 0 or delta < 0:
+            # A collection ran in between; the next sample measures again
+            return
+        self.rate += (delta * 1000 // elapsed - self.rate) >> 2
+
+        # Size the automatic trigger to twice the planned collection period,
+        # so it only fires if slack collections keep being deferred
+        threshold = self.rate * GC_INTERVAL_MS * 2 // 1000
+        threshold = max(GC_THRESHOLD_MIN_BYTES, min(GC_THRESHOLD_MAX_BYTES, threshold))
+        # Avoid churning the setting for small rate changes
+        if abs(threshold - self.threshold) > self.threshold >> 3:
+            self.threshold = threshold
+            gc.threshold(threshold)
+
+    def _due(self):
+        if time.ticks_diff(time.ticks_ms(), self.last_collect_ms) >= GC_INTERVAL_MS:
+            return True
+        return gc.mem_alloc() - self._base_alloc >= self.threshold >> 1
+
+    def ms_until_due(self):
+        """Milliseconds until a collection is due, or None if nothing was allocated since the last one"""
+        allocated = gc.mem_alloc() - self._base_alloc
+        if allocated <= 0:
+            return None
+        left = GC_INTERVAL_MS - time.ticks_diff(time.ticks_ms(), self.last_collect_ms)
+        if self.rate:
+            left = min(left, ((self.threshold >> 1) - allocated) * 1000 // self.rate)
+        return left if left > 0 else 0
+
+    def _slack_needed_ms(self):
+        return max(GC_MIN_SLACK_MS, self.pause_max_us * 2 // 1000)
+
+    def maybe_collect(self):
+        """Collect if due and there is idle slack before the next event; returns True if collected"""
+        self.sample()
+        if self._held or not self._due():
+            return False
+        if self.next_event_ms is not None:
+            slack = self.next_event_ms()
+            if slack is not None and slack < self._slack_needed_ms():
+                self.deferred += 1
+                return False
+        self.collect()
+        return True
+
+    def collect(self):
+        """Run a timed collection"""
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+        self.collections += 1
+        self.pause_last_us = pause
+        self.pause_total_us += pause
+        if pause > self.pause_max_us:
+            self.pause_max_us = pause
+        self.last_collect_ms = time.ticks_ms()
+        self._base_alloc = gc.mem_alloc()
+        self._sample_alloc = self._base_alloc
+        self._sample_ms = self.last_collect_ms
+
+    def get_status(self):
+        """GC pause and tuning statistics"""
+        return {
+            'collections': self.collections,
+            'deferred': self.deferred,
+            'pause_last_us': self.pause_last_us,
+            'pause_max_us': self.pause_max_us,
+            'pause_avg_us': self.pause_total_us // self.collections if self.collections else 0,
+            'threshold': self.threshold,
+            'alloc_rate': self.rate
+        }
@@ -0,0 +1,142 @@
+import os
+import json
+import struct
+import binascii
+from config import JOURNAL_PATH, JOURNAL_COMPACT_BYTES
+
+# Record layout: type, payload length, payload, crc32 of type/length/payload
+_HEADER = "<BH"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_CRC_SIZE = 4
+_MAGIC = b"JRN1"
+
+REC_VALVES = 1   # <III valve mask, remaining run seconds, wall-clock timestamp
+REC_RUN = 2      # JSON run position; empty when no run is active
+REC_VERSION = 3  # <I last applied shadow version
+
+_VALVES = "<III"
+
+class Journal:
+    """Append-only flash journal of the state needed to resume after a reset
+
+    Only the latest record of each type matters, so replay keeps the last
+    one seen and stops at the first torn or corrupt record. Records are
+    appended, never rewritten in place; once the file passes
+    JOURNAL_COMPACT_BYTES the latest records are written to a new file that
+    replaces the old one by rename, so a reset mid-compaction leaves the old
+    journal intact. LittleFS spreads the appends over free blocks.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self.size = 0
+        # type -> latest payload, the contents of the next compaction
+        self.latest = {}
+        self.appends = 0
+        self.compactions = 0
+        self.errors = 0
+
+    def replay(self):
+        """Load the latest record of each type; returns the number of records read"""
+        self.latest = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+
+        count = 0
+        offset = len(_MAGIC)
+        if data[:offset] == _MAGIC:
+            end = len(data)
+            while offset + _HEADER_SIZE + _CRC_SIZE <= end:
+                rec_type, length = struct.unpack_from(_HEADER, data, offset)
+                stop = offset + _HEADER_SIZE + length
+                if stop + _CRC_SIZE > end:
+                    break
+                crc = struct.unpack_from("<I", data, stop)[0]
+                if binascii.crc32(data[offset:stop]) != crc:
+                    break
+                self.latest[rec_type] = data[offset + _HEADER_SIZE:stop]
+                offset = stop + _CRC_SIZE
+                count += 1
+
+        self.size = min(offset, len(data))
+        if self.size != len(data) or not data:
+            # Torn tail or no journal: start a clean file so new appends are reachable
+            if data:
+                print(f"Journal: discarded {len(data) - self.size} byte(s) of torn records")
+            self.compact()
+        return count
+
+    def _encode(self, rec_type, payload):
+        record = struct.pack(_HEADER, rec_type, len(payload)) + payload
+        return record + struct.pack("<I", binascii.crc32(record))
+
+    def append(self, rec_type, payload):
+        """Append a record unless it repeats the latest one of its type"""
+        if self.latest.get(rec_type) == payload:
+            return True
+        record = self._encode(rec_type, payload)
+        try:
+            with open(self.path, "ab") as f:
+                f.write(record)
+        except OSError as e:
+            print(f"Journal write error: {e}")
+            self.errors += 1
+            return False
+        self.latest[rec_type] = payload
+        self.size += len(record)
+        self.appends += 1
+        if self.size > self.compact_bytes:
+            self.compact()
+        return True
+
+    def compact(self):
+        """Rewrite the journal as just the latest record of each type"""
+        tmp = self.path + ".tmp"
+        data = _MAGIC + b"".join(self._encode(t, p) for t, p in self.latest.items())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.rename(tmp, self.path)
+        except OSError as e:
+            print(f"Journal compaction error: {e}")
+            self.errors += 1
+            return False
+        self.size = len(data)
+        self.compactions += 1
+        return True
+
+    def record_valves(self, mask, remaining_s, timestamp):
+        return self.append(REC_VALVES, struct.pack(_VALVES, mask, remaining_s, timestamp))
+
+    def record_run(self, position):
+        return self.append(REC_RUN, json.dumps(position).encode() if position else b"")
+
+    def record_version(self, version):
+        return self.append(REC_VERSION, struct.pack("<I", version))
+
+    def valves(self):
+        """(mask, remaining seconds, timestamp) from the journal, or None"""
+        payload = self.latest.get(REC_VALVES)
+        return struct.unpack(_VALVES, payload) if payload else None
+
+    def run(self):
+        """Run position dict from the journal, or None"""
+        payload = self.latest.get(REC_RUN)
+        return json.loads(payload) if payload else None
+
+    def version(self):
+        payload = self.latest.get(REC_VERSION)
+        return struct.unpack("<I", payload)[0] if payload else 0
+
+    def get_status(self):
+        """Get journal status"""
+        return {
+            'bytes': self.size,
+            'appends': self.appends,
+            'compactions': self.compactions,
+            'errors': self.errors
+        }
@@ -0,0 +1,196 @@
+import json
+import asyncio
+from config import (
+    LOCAL_API_TOKEN, LOCAL_API_PORT, LOCAL_API_TIMEOUT_MS, LOCAL_API_MAX_BODY,
+    LOCAL_API_MAX_CLIENTS, LOCAL_API_MAX_LINE, LOCAL_API_MAX_HEADERS
+)
+from valve_controller import VALVE_NAMES
+from log import LOG
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    503: "Service Unavailable"
+}
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or _REASONS[status])
+        self.status = status
+
+def _token_matches(given):
+    """Compare against LOCAL_API_TOKEN in time independent of where they differ"""
+    expected = LOCAL_API_TOKEN.encode()
+    if len(given) != len(expected):
+        return False
+    diff = 0
+    for a, b in zip(given, expected):
+        diff |= a ^ b
+    return diff == 0
+
+class LocalAPI:
+    """Small HTTP/JSON endpoint for valve control on the local network
+
+    Runs on the same event loop as the MQTT client, so a LAN command is
+    applied without the round trip through AWS and keeps working while the
+    internet link is down. Every request needs the shared secret as
+    "Authorization: Bearer <LOCAL_API_TOKEN>"; an empty token disables the
+    endpoint.
+
+        GET  /status                      valve states and link status
+        POST /valves {"valve_1": "ON"}    same values as the desired shadow
+        POST /stop                        stop the active run, close all valves
+    """
+
+    def __init__(self, shadow_manager, stop_run, get_status):
+        self.shadow_manager = shadow_manager
+        self.stop_run = stop_run
+        self.get_status = get_status
+        self.server = None
+        self.clients = 0
+        self.stats = {'requests': 0, 'rejected': 0, 'errors': 0}
+
+    async def start(self):
+        """Listen on LOCAL_API_PORT; returns False when the endpoint is disabled"""
+        if not LOCAL_API_TOKEN:
+            print("Local API disabled (no LOCAL_API_TOKEN)")
+            return False
+        self.server = await asyncio.start_server(self._serve, "0.0.0.0", LOCAL_API_PORT)
+        print(f"Local API listening on port {LOCAL_API_PORT}")
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    async def _serve(self, reader, writer):
+        """Handle one request per connection"""
+        status, body = 200, None
+        self.clients += 1
+        try:
+            if self.clients > LOCAL_API_MAX_CLIENTS:
+                raise HTTPError(503)
+            method, path, headers, payload = await asyncio.wait_for_ms(
+                self._read_request(reader), LOCAL_API_TIMEOUT_MS)
+            self.stats['requests'] += 1
+            scheme, _, token = headers.get(b"authorization", b"").partition(b" ")
+            if scheme != b"Bearer" or not _token_matches(token):
+                raise HTTPError(401)
+            body = self._dispatch(method, path, payload)
+        except HTTPError as e:
+            status, body = e.status, {"error": str(e)}
+            self.stats['rejected'] += 1
+        except asyncio.TimeoutError:
+            status, body = 400, {"error": "timeout"}
+            self.stats['rejected'] += 1
+        except Exception as e:
+            LOG.warning("Local API error: %s", e)
+            status, body = 400, {"error": "bad request"}
+            self.stats['errors'] += 1
+        try:
+            await self._respond(writer, status, body)
+        except Exception:
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+            await writer.wait_closed()
+
+    async def _read_head(self, reader):
+        """Read the request line and headers in bounded chunks; returns (lines, bytes after them)
+
+        Lines are limited to LOCAL_API_MAX_LINE bytes and headers to
+        LOCAL_API_MAX_HEADERS, so a client cannot grow them until the timeout.
+        """
+        lines = []
+        buf = b""
+        while True:
+            end = buf.find(b"\n")
+            if end < 0:
+                if len(buf) > LOCAL_API_MAX_LINE:
+                    raise HTTPError(431)
+                chunk = await reader.read(LOCAL_API_MAX_LINE)
+                if not chunk:
+                    return lines, b""
+                buf += chunk
+                continue
+            line = buf[:end + 1]
+            buf = buf[end + 1:]
+            if len(line) > LOCAL_API_MAX_LINE:
+                raise HTTPError(431)
+            if line in (b"\r\n", b"\n"):
+                return lines, buf
+            # The request line plus the headers
+            if len(lines) > LOCAL_API_MAX_HEADERS:
+                raise HTTPError(431)
+            lines.append(line)
+
+    async def _read_request(self, reader):
+        """Parse the request line, headers (lower-cased keys) and a bounded body"""
+        lines, rest = await self._read_head(reader)
+        parts = lines[0].split() if lines else ()
+        if len(parts) < 2:
+            raise HTTPError(400)
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get(b"content-length", 0))
+        if length > LOCAL_API_MAX_BODY:
+            raise HTTPError(413)
+        if len(rest) < length:
+            rest += await reader.readexactly(length - len(rest))
+        return parts[0], parts[1], headers, rest[:length]
+
+    def _dispatch(self, method, path, payload):
+        if path == b"/status":
+            if method != b"GET":
+                raise HTTPError(405)
+            return self.get_status()
+        if path == b"/valves":
+            if method != b"POST":
+                raise HTTPError(405)
+            return self._set_valves(payload)
+        if path == b"/stop":
+            if method != b"POST":
+                raise HTTPError(405)
+            self.stop_run()
+            self.shadow_manager.apply_local({name: "OFF" for name in VALVE_NAMES})
+            return self.get_status()
+        raise HTTPError(404)
+
+    def _set_valves(self, payload):
+        """Apply {"valve_N": "ON" | "OFF" | seconds, ...}"""
+        try:
+            desired = json.loads(payload)
+        except ValueError:
+            raise HTTPError(400, "invalid JSON")
+        if not isinstance(desired, dict) or not desired:
+            raise HTTPError(400, "expected an object of valves")
+        for valve_name, value in desired.items():
+            if valve_name not in VALVE_NAMES:
+                raise HTTPError(400, f"unknown valve {valve_name}")
+            if value not in ("ON", "OFF") and not (type(value) is int and value > 0):
+                raise HTTPError(400, f"invalid value for {valve_name}")
+        self.shadow_manager.apply_local(desired)
+        return self.get_status()
+
+    async def _respond(self, writer, status, body):
+        data = json.dumps(body).encode() if body is not None else b""
+        writer.write(f"HTTP/1.0 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode())
+        writer.write(data)
+        await writer.drain()
+
+    def get_stats(self):
+        """Request counters for status reporting"""
+        stats = dict(self.stats)
+        stats['enabled'] = self.server is not None
+        stats['clients'] = self.clients
+        return stats
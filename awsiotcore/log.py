@@ -0,0 +1,112 @@
+import time
+from array import array
+from config import LOG_LEVEL, LOG_CONSOLE_LEVEL, LOG_RING_RECORDS
+
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+_LETTERS = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+def _discard(fmt, *args):
+    pass
+
+def _format(fmt, args):
+    try:
+        return fmt % args if args else fmt
+    except Exception:
+        return f"{fmt} {args}"
+
+class RingLog:
+    """Leveled log kept in a fixed ring of records in RAM
+
+    A record is the ticks_ms time, the level, the format string and the
+    argument tuple, stored in preallocated slots; nothing is formatted
+    until the records are read back. Methods for levels below the current
+    one are replaced by a no-op, so a disabled call costs one function
+    call. Records at or above the console level are also printed, which
+    does format them and write to USB-CDC.
+    """
+
+    def __init__(self, records=LOG_RING_RECORDS, level=LOG_LEVEL, console_level=LOG_CONSOLE_LEVEL):
+        self.size = records
+        self.ticks = array('I', bytes(4 * records))
+        self.levels = bytearray(records)
+        self.fmts = [None] * records
+        self.args = [None] * records
+        # Records written since boot; seq % size is the next slot
+        self.seq = 0
+        # Core 1 (valve core) logs as well
+        self.lock = _thread.allocate_lock() if _thread else None
+        self.console_level = LEVELS[console_level]
+        self.set_level(level)
+
+    def set_level(self, level):
+        """Set the lowest recorded level by name; returns False for an unknown name"""
+        value = LEVELS.get(level)
+        if value is None:
+            return False
+        self.level = value
+        self.debug = self._writer(DEBUG) if DEBUG >= value else _discard
+        self.info = self._writer(INFO) if INFO >= value else _discard
+        self.warning = self._writer(WARNING) if WARNING >= value else _discard
+        self.error = self._writer(ERROR)
+        return True
+
+    def _writer(self, level):
+        write = self._write
+
+        def log(fmt, *args):
+            write(level, fmt, args)
+
+        return log
+
+    def _write(self, level, fmt, args):
+        lock = self.lock
+        if lock:
+            lock.acquire()
+        i = self.seq % self.size
+        self.ticks[i] = time.ticks_ms()
+        self.levels[i] = level
+        self.fmts[i] = fmt
+        self.args[i] = args
+        self.seq += 1
+        if lock:
+            lock.release()
+        if level >= self.console_level:
+            print(_format(fmt, args))
+
+    def records(self, since=0, limit=None):
+        """[seq, ms, level, text] for the records still held with seq >= since, oldest first"""
+        lock = self.lock
+        if lock:
+            lock.acquire()
+        end = self.seq
+        start = max(since, end - self.size, 0)
+        if limit is not None:
+            end = min(end, start + limit)
+        raw = []
+        for seq in range(start, end):
+            i = seq % self.size
+            raw.append((seq, self.ticks[i], self.levels[i], self.fmts[i], self.args[i]))
+        if lock:
+            lock.release()
+        # Formatting happens here, outside the lock and off the hot path
+        return [[seq, ms, _LETTERS[level], _format(fmt, args)] for seq, ms, level, fmt, args in raw]
+
+    def get_status(self):
+        """Get log status"""
+        return {
+            'level': self.level,
+            'seq': self.seq,
+            'held': min(self.seq, self.size)
+        }
+
+LOG = RingLog()
@@ -5,171 +5,577 @@ Main program for controlling irrigation valves via AWS IoT Core
 
 import time
 import gc
+import json
+import asyncio
+import machine
 from machine import Pin, reset
 import sys
 
+# First of our modules, so the boot profile covers the imports below
+from boot_profile import BOOT
+
 # Import our modules
 from wifi_manager import WiFiManager
 from mqtt_client import AWSIoTClient
 from valve_controller import ValveController
 from shadow_manager import ShadowManager
 from time_sync import TimeSync
-from config import DEVICE_ID
+from scheduler import ScheduleEngine
+from gc_manager import GCManager
+from timer_wheel import Timer, TimerWheel
+from journal import Journal
+from valve_core import ValveCore
+from metrics import METRICS
+from log import LOG
+from config import (
+    DEVICE_ID, LOCAL_API_TOKEN, PROGRAM_COMMAND_TOPIC, LOG_TOPIC, LOG_COMMAND_TOPIC,
+    LOG_UPLOAD_BATCH, HEARTBEAT_INTERVAL_SECONDS, WIFI_CHECK_INTERVAL_MS,
+    MQTT_POLL_INTERVAL_MS, MQTT_CHECK_INTERVAL_MS, NTP_CHECK_INTERVAL_MS,
+    VALVE_SAFETY_INTERVAL_MS, GC_CHECK_INTERVAL_MS, SHADOW_REPORT_COALESCE_MS, TELEMETRY_TOPIC,
+    TELEMETRY_INTERVAL_SECONDS, TELEMETRY_MAX_BYTES, OUTBOX_DRAIN_INTERVAL_MS,
+    SCHEDULE_TICK_MS, METRICS_TOPIC, METRICS_INTERVAL_SECONDS, MQTT_IDLE_WAIT_MS,
+    WLAN_POWER_SAVE, LIGHTSLEEP_ENABLED, LIGHTSLEEP_MIN_MS, LIGHTSLEEP_MAX_MS,
+    POWER_CHECK_INTERVAL_MS, WATCHDOG_ENABLED, WATCHDOG_TIMEOUT_MS, JOURNAL_CHECKPOINT_SECONDS,
+    TIMER_TICK_MS, FLOW_PIN, PRESSURE_ADC_PIN, SENSOR_BATCH_MS, FLOW_REPORT_INTERVAL_SECONDS
+)
+
+BOOT.mark("imports")
 
 class IrrigationController:
     def __init__(self):
+        # Valve outputs are driven low before anything else
+        self.valve_controller = ValveController()
         self.wifi = WiFiManager()
         self.mqtt_client = AWSIoTClient()
-        self.valve_controller = ValveController()
         self.time_sync = TimeSync()
-        self.shadow_manager = None
+        self.shadow_manager = ShadowManager(self.mqtt_client, self.valve_controller)
+        self.scheduler = ScheduleEngine(self.valve_controller, self.time_sync,
+                                        on_change=self._schedule_changed,
+                                        report=self._report_run,
+                                        persist=self._save_schedules)
+        self.flow_monitor = None
+        if FLOW_PIN is not None or PRESSURE_ADC_PIN is not None:
+            from flow_monitor import FlowMonitor
+            self.flow_monitor = FlowMonitor(self.valve_controller)
+            self.flow_monitor.on_fault = self._flow_fault
+        self._flow_reported = None
+        # Valve and schedule state is only changed on the valve core
+        self.valve_core = ValveCore(self.valve_controller, self.scheduler, self.flow_monitor)
+        self.valve_core.on_expired = self.shadow_manager.report_expired
+        self.shadow_manager.execute = self.valve_core.call
+        self.shadow_manager.register_desired_section(
+            "schedules", lambda changes: self.valve_core.call(self.scheduler.update_programs, changes))
+        self.mqtt_client.register_handler(
+            PROGRAM_COMMAND_TOPIC, lambda message: self.valve_core.call(self.scheduler.handle_command, message))
+        self.mqtt_client.register_handler(LOG_COMMAND_TOPIC, self._log_command)
+        self.gc_manager = GCManager(next_event_ms=self.scheduler.ms_until_next_event)
+        # No automatic collection between a command's receipt and its valve actuation
+        self.mqtt_client.gc_guard = self.gc_manager
+        self.local_api = None
+        if LOCAL_API_TOKEN:
+            from local_api import LocalAPI
+            self.local_api = LocalAPI(self.shadow_manager, self._stop_run, self._local_status)
+        self.journal = Journal()
         self.running = True
-        self.last_heartbeat = 0
-        self.heartbeat_interval = 60  # Send heartbeat every 60 seconds
+        self.heartbeat_interval = HEARTBEAT_INTERVAL_SECONDS
+        self.timers = TimerWheel(on_error=self._report_task_error)
         
         # Setup onboard LED for status indication
         self.status_led = Pin("LED", Pin.OUT)
         self.status_led.value(0)
         
         print(f"Irrigation Controller initialized for device: {DEVICE_ID}")
+        BOOT.mark("init")
     
     def setup(self):
-        """Initialize all components"""
+        """Initialize everything that does not need the network while WiFi associates"""
         print("=== Pico 2W Irrigation Controller Starting ===")
-        
-        # Connect to WiFi
-        if not self.wifi.connect():
-            print("Failed to connect to WiFi")
-            return False
-        
-        # Initial time sync
-        print("Performing initial time synchronization...")
-        if not self.time_sync.sync_time():
-            print("Warning: Initial time sync failed")
-        
-        # Connect to AWS IoT Core
-        if not self.mqtt_client.connect():
-            print("Failed to connect to AWS IoT Core")
-            return False
-        
-        # Initialize shadow manager
-        self.shadow_manager = ShadowManager(self.mqtt_client, self.valve_controller)
-        
-        # Setup MQTT message callback to include shadow processing
-        original_callback = self.mqtt_client._message_callback
-        
-        def enhanced_callback(topic, msg):
-            original_callback(topic, msg)
-            # Also process shadow messages
-            try:
-                import json
-                topic_str = topic.decode('utf-8')
-                message = json.loads(msg.decode('utf-8'))
-                self.shadow_manager.process_shadow_message(topic_str, message)
-            except Exception as e:
-                print(f"Error in enhanced callback: {e}")
-        
-        self.mqtt_client._message_callback = enhanced_callback
-        
-        # Sync initial state with shadow
-        self.shadow_manager.sync_with_shadow()
-        
-        # Turn on status LED to indicate ready
-        self.status_led.value(1)
-        
-        print("=== System Ready ===")
+        self.wifi.begin()
+        BOOT.mark("wifi_started")
+        self._restore_state()
+        BOOT.mark("journal")
+        # Certificate reads and TLS context setup overlap with the association
+        if not self.mqtt_client.prepare():
+            print("Credentials not loaded; retrying at connect")
+        BOOT.mark("credentials")
         return True
     
-    def run(self):
-        """Main program loop"""
-        if not self.setup():
-            print("Setup failed, restarting in 10 seconds...")
-            time.sleep(10)
-            reset()
-            return
-        
-        print("Starting main loop...")
-        
+    def _restore_state(self):
+        """Replay the journal so an interrupted run resumes before the network is up"""
+        start_ms = time.ticks_ms()
+        try:
+            count = self.journal.replay()
+            self.shadow_manager.last_version = self.journal.version()
+            run = self.journal.run()
+            valves = self.journal.valves()
+            if run is not None:
+                self.scheduler.resume(run, self._seconds_since(run["at"]))
+            elif valves is not None and valves[0]:
+                self._resume_valve(*valves)
+        except Exception as e:
+            print(f"Journal replay failed: {e}")
+            count = 0
+        # Record from here on; the restored state is journaled again by the hooks
+        self.valve_controller.on_change = self._valves_changed
+        self.shadow_manager.on_version = self.journal.record_version
+        # The valve core is not running yet, so its state can be read directly
+        self._journal_valves(self.valve_controller.get_state_mask(), self.valve_controller.remaining_seconds())
+        self.journal.record_run(self.scheduler.position())
+        print(f"Journal replayed {count} record(s) in {time.ticks_diff(time.ticks_ms(), start_ms)} ms")
+    
+    def _seconds_since(self, timestamp):
+        """Seconds since a journaled timestamp; 0 when the RTC did not survive the reset"""
+        if not self.time_sync.is_time_valid():
+            return 0
+        return max(0, self.time_sync.get_timestamp() - timestamp)
+    
+    def _resume_valve(self, mask, remaining, timestamp):
+        """Reopen the valves that were on at reset, for what is left of the shortest run time"""
+        if remaining:
+            remaining -= self._seconds_since(timestamp)
+            if remaining <= 0:
+                return
+        valve_index = 0
+        while mask:
+            if mask & 1:
+                print(f"Resuming valve {valve_index + 1}")
+                self.valve_controller.set_valve(valve_index, True, remaining or None)
+            mask >>= 1
+            valve_index += 1
+    
+    def _valves_changed(self):
+        """Valve state changed (on the valve core): journal it on core 0"""
+        valves = self.valve_controller
+        self.valve_core.emit(self._journal_valves, valves.get_state_mask(), valves.remaining_seconds())
+    
+    def _journal_valves(self, mask, remaining):
+        # Covers valves opened after their inrush stagger, outside any command
+        self.shadow_manager.request_report()
+        self.journal.record_valves(mask, remaining, self.time_sync.get_timestamp())
+    
+    def _schedule_changed(self):
+        """Run started, stepped or stopped (on the valve core): report and journal it on core 0"""
+        self.valve_core.emit(self._record_run, self.scheduler.position())
+    
+    def _record_run(self, position):
+        self.shadow_manager.request_report()
+        self.journal.record_run(position)
+    
+    def _report_run(self, fields):
+        """Run progress from the scheduler, published from core 0"""
+        self.valve_core.emit(self.shadow_manager.report_fields, fields)
+    
+    def _save_schedules(self, programs):
+        """Edited programs from the valve core; core 0 owns flash writes"""
+        self.valve_core.emit(self.scheduler.save, programs)
+    
+    def _stop_run(self):
+        self.valve_core.call(self.scheduler.stop)
+    
+    def _flow_fault(self, kind, detail):
+        """Valve core: the flow monitor emergency-stopped the valves; end the run and report"""
+        self.scheduler.stop()
+        self.valve_core.emit(self._report_flow, self.flow_monitor.summary())
+    
+    def _report_flow(self, summary=None):
+        """Report the flow summary when it changed since the last report"""
+        if summary is None:
+            summary = self.valve_core.call(self.flow_monitor.summary)
+        if summary != self._flow_reported:
+            self._flow_reported = summary
+            self.shadow_manager.report_fields({"flow": summary})
+    
+    def _journal_checkpoint(self):
+        """Re-journal the time left while watering"""
+        mask, _, run_name, _, _ = self.valve_core.current()
+        if mask:
+            self._journal_valves(mask, self.valve_core.call(self.valve_controller.remaining_seconds))
+        if run_name is not None:
+            self.journal.record_run(self.valve_core.call(self.scheduler.position))
+    
+    def _update_status_led(self):
+        """LED is ON only while both WiFi and MQTT are up"""
+        self.status_led.value(1 if self.wifi.is_connected() and self.mqtt_client.is_connected() else 0)
+    
+    def _report_task_error(self, task_name, e):
+        """Log a task error and blink the status LED"""
+        print(f"Error in {task_name} task: {e}")
+        self.status_led.value(0)
+    
+    def _create_timers(self):
+        """Every periodic job is a timer on the wheel; async jobs are woken through events"""
+        timers = self.timers
+        self._wifi_due = asyncio.Event()
+        self._mqtt_due = asyncio.Event()
+        self._ntp_due = asyncio.Event()
+        self.wifi_timer = Timer("wifi", self._wifi_due.set)
+        self.mqtt_timer = Timer("mqtt", self._mqtt_due.set)
+        self.ntp_timer = Timer("ntp", self._ntp_due.set)
+        # Armed on demand, so an idle wheel can sleep until its next real deadline
+        self.outbox_timer = Timer("outbox", self._drain_outbox)
+        self.gc_timer = Timer("gc", self._collect_garbage)
+        periodic = [
+            Timer("heartbeat", self.shadow_manager.request_report, self.heartbeat_interval * 1000),
+            Timer("telemetry", self._telemetry, TELEMETRY_INTERVAL_SECONDS * 1000),
+            Timer("power", self._power_save, POWER_CHECK_INTERVAL_MS),
+            Timer("journal", self._journal_checkpoint, JOURNAL_CHECKPOINT_SECONDS * 1000),
+        ]
+        if not self.valve_core.threaded:
+            # Single-core: valve safety and schedules run from the wheel as well
+            periodic.append(Timer("valve_safety", self._valve_safety, VALVE_SAFETY_INTERVAL_MS))
+            periodic.append(Timer("schedule", self.scheduler.tick, SCHEDULE_TICK_MS))
+            if self.valve_controller.concurrent:
+                periodic.append(Timer("stagger", self.valve_controller.service_deferred, TIMER_TICK_MS))
+            if self.flow_monitor is not None:
+                periodic.append(Timer("flow", self.flow_monitor.process, SENSOR_BATCH_MS))
+        if self.flow_monitor is not None:
+            periodic.append(Timer("flow_report", self._report_flow, FLOW_REPORT_INTERVAL_SECONDS * 1000))
+        if METRICS:
+            periodic.append(Timer("metrics", self._publish_metrics, METRICS_INTERVAL_SECONDS * 1000))
+        if WATCHDOG_ENABLED:
+            self.watchdog = machine.WDT(timeout=WATCHDOG_TIMEOUT_MS)
+            periodic.append(Timer("watchdog", self.watchdog.feed, WATCHDOG_TIMEOUT_MS // 4))
+        for timer in periodic:
+            timers.start(timer)
+        # Connection and time checks run right away
+        for timer in (self.wifi_timer, self.mqtt_timer, self.ntp_timer):
+            timers.schedule(timer, 0)
+    
+    async def _timer_task(self):
+        """Drive the timer wheel, sleeping until its next deadline"""
+        timers = self.timers
         while self.running:
+            timers.run()
+            self._arm_gc()
+            delay_ms = timers.next_deadline_ms()
+            timers.changed.clear()
+            if delay_ms is None:
+                await timers.changed.wait()
+                continue
+            try:
+                await asyncio.wait_for_ms(timers.changed.wait(), delay_ms)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _wifi_task(self):
+        """Supervise the WiFi association"""
+        while self.running:
+            await self._wifi_due.wait()
+            self._wifi_due.clear()
             try:
-                # Check WiFi connection
                 if not self.wifi.is_connected():
                     print("WiFi disconnected, attempting reconnection...")
                     self.status_led.value(0)
-                    if not self.wifi.connect():
+                    if await self.wifi.connect_async():
+                        # Don't wait out the MQTT and NTP check periods
+                        self.timers.schedule(self.mqtt_timer, 0)
+                        self.timers.schedule(self.ntp_timer, 0)
+                    else:
                         print("WiFi reconnection failed")
-                        time.sleep(5)
-                        continue
-                    self.status_led.value(1)
-                
-                # Check MQTT connection
-                if not self.mqtt_client.is_connected():
+                if self.wifi.is_connected():
+                    BOOT.mark("wifi")
+                self._update_status_led()
+            except Exception as e:
+                self._report_task_error("wifi", e)
+            self.timers.schedule(self.wifi_timer, WIFI_CHECK_INTERVAL_MS)
+    
+    async def _mqtt_supervisor_task(self):
+        """Keep the AWS IoT connection up once WiFi is available, backing off on failure"""
+        while self.running:
+            await self._mqtt_due.wait()
+            self._mqtt_due.clear()
+            delay_ms = MQTT_CHECK_INTERVAL_MS
+            try:
+                if self.wifi.is_connected() and not self.mqtt_client.is_connected():
                     print("MQTT disconnected, attempting reconnection...")
-                    self.status_led.value(0)
-                    if not self.mqtt_client.connect():
-                        print("MQTT reconnection failed")
-                        time.sleep(5)
-                        continue
-                    self.status_led.value(1)
-                
-                # Process MQTT messages
+                    # The TLS handshake itself is blocking in umqtt.simple
+                    if self.mqtt_client.connect():
+                        # Every queued shadow report goes out before the live full
+                        # report, so none can overwrite it; the rest follow in batches
+                        self.mqtt_client.drain_outbox(len(self.mqtt_client.outbox), priority_only=True)
+                        self._drain_outbox()
+                        self.shadow_manager.sync_with_shadow()
+                        self.valve_core.call(self.scheduler.resend_progress)
+                        print("=== System Ready ===")
+                    else:
+                        delay_ms = self.mqtt_client.retry_delay_ms()
+                        print(f"MQTT reconnection failed, retrying in {delay_ms} ms")
+                else:
+                    self.mqtt_client.keepalive()
+                self._update_status_led()
+            except Exception as e:
+                self._report_task_error("mqtt supervisor", e)
+            # The reconnect backoff is just this timer's next delay
+            self.timers.schedule(self.mqtt_timer, delay_ms)
+    
+    async def _mqtt_reader_task(self):
+        """Dispatch inbound MQTT messages as soon as the socket is readable"""
+        while self.running:
+            if not self.mqtt_client.is_connected():
+                await self.mqtt_client.ready.wait()
+                continue
+            # The event loop blocks in poll() until data arrives or the next task is due
+            try:
+                await asyncio.wait_for_ms(self.mqtt_client.wait_readable(), MQTT_IDLE_WAIT_MS)
+            except asyncio.TimeoutError:
+                pass
+            except Exception as e:
+                self._report_task_error("mqtt reader", e)
+                await asyncio.sleep_ms(MQTT_POLL_INTERVAL_MS)
+                continue
+            if METRICS:
+                iteration_us = time.ticks_us()
+            try:
                 self.mqtt_client.check_messages()
-                
-                # Auto-sync time if needed (every 3 hours)
-                self.time_sync.auto_sync_if_needed()
-                
-                # Send periodic status/heartbeat
-                current_time = time.time()
-                if current_time - self.last_heartbeat >= self.heartbeat_interval:
-                    self.send_heartbeat()
-                    self.last_heartbeat = current_time
-                
-                # Small delay to prevent busy waiting
-                time.sleep(0.1)
-                
-                # Periodic garbage collection
-                if time.ticks_ms() % 10000 < 100:
-                    gc.collect()
-                
-            except KeyboardInterrupt:
-                print("Received keyboard interrupt")
-                self.shutdown()
-                break
             except Exception as e:
-                print(f"Error in main loop: {e}")
-                self.status_led.value(0)
-                time.sleep(1)
-                self.status_led.value(1)
+                self._report_task_error("mqtt reader", e)
+            self._arm_gc()
+            if METRICS:
+                METRICS.since("loop_iter", iteration_us)
+    
+    async def _ntp_task(self):
+        """Keep the RTC synchronized; the interval adapts to the measured drift"""
+        while self.running:
+            await self._ntp_due.wait()
+            self._ntp_due.clear()
+            delay_ms = NTP_CHECK_INTERVAL_MS
+            try:
+                if self.wifi.is_connected():
+                    last_sync = self.time_sync.last_sync_time
+                    await self.time_sync.auto_sync_if_needed()
+                    if self.time_sync.last_sync_time != last_sync:
+                        BOOT.mark("time")
+                        self.valve_core.call(self.scheduler.reschedule)
+                    if not self.time_sync.is_sync_needed():
+                        # Sleep through the whole (adaptive) interval
+                        delay_ms = (self.time_sync.sync_interval_seconds - self.time_sync.get_time_since_sync()) * 1000
+            except Exception as e:
+                self._report_task_error("ntp", e)
+            self.timers.schedule(self.ntp_timer, delay_ms)
+    
+    async def _shadow_report_task(self):
+        """Coalesce valve changes into one reported-state update"""
+        while self.running:
+            await self.shadow_manager.report_event.wait()
+            await asyncio.sleep_ms(SHADOW_REPORT_COALESCE_MS)
+            self.shadow_manager.report_event.clear()
+            # While offline the report is queued in the outbox
+            try:
+                self.shadow_manager.flush_reported()
+            except Exception as e:
+                self._report_task_error("shadow report", e)
+    
+    async def _command_task(self):
+        """Apply coalesced valve commands once their window ends"""
+        shadow = self.shadow_manager
+        while self.running:
+            await shadow.command_event.wait()
+            shadow.command_event.clear()
+            delay_ms = shadow.ms_until_apply()
+            if delay_ms:
+                await asyncio.sleep_ms(delay_ms)
+            self.gc_manager.hold()
+            try:
+                shadow.apply_pending()
+            except Exception as e:
+                self._report_task_error("command", e)
+            finally:
+                self.gc_manager.release()
+            self._arm_gc()
+    
+    def _telemetry(self):
+        """Send the full device status on the (much longer) telemetry period"""
+        if self.mqtt_client.is_connected():
+            self.send_telemetry()
+    
+    async def _valve_core_task(self):
+        """Run the journal and report callbacks queued by the valve core"""
+        while self.running:
+            await self.valve_core.events_ready.wait()
+            self.valve_core.drain_events()
+    
+    def _valve_safety(self):
+        """Reconcile timer auto-offs and periodically re-assert valve outputs"""
+        expired = self.valve_controller.service_expired()
+        if expired:
+            self.shadow_manager.report_expired(expired)
+        self.valve_controller.verify_outputs()
+    
+    def _drain_outbox(self):
+        """Replay one outbox batch, re-arming while records are left"""
+        self.mqtt_client.drain_outbox()
+        if self.mqtt_client.is_connected() and len(self.mqtt_client.outbox):
+            self.timers.schedule(self.outbox_timer, OUTBOX_DRAIN_INTERVAL_MS)
+    
+    def _collect_garbage(self):
+        """Collect garbage in idle slack between scheduled events"""
+        if self.gc_manager.maybe_collect() and METRICS:
+            METRICS.sample_heap()
+        self._arm_gc()
     
-    def send_heartbeat(self):
-        """Send periodic heartbeat/status message"""
+    def _arm_gc(self):
+        """Arm the GC timer for when a collection falls due, if anything was allocated
+
+        Allocation outside the paths that call this is still caught by the
+        automatic gc.threshold backstop.
+        """
+        if self.gc_timer.pending():
+            return
+        delay_ms = self.gc_manager.ms_until_due()
+        if delay_ms is not None:
+            # A due collection that found no slack retries after GC_CHECK_INTERVAL_MS
+            self.timers.schedule(self.gc_timer, max(delay_ms, GC_CHECK_INTERVAL_MS))
+    
+    def _is_idle(self):
+        """No valve open and nothing waiting to be reported or sent"""
+        return (not self.valve_core.current()[0]
+                and not self.shadow_manager.report_event.is_set()
+                and not len(self.mqtt_client.outbox))
+    
+    def _power_save(self):
+        """Drop the radio and CPU into low-power modes while nothing is watering"""
+        idle = self._is_idle()
+        if WLAN_POWER_SAVE and self.wifi.is_connected():
+            self.wifi.set_power_save(idle)
+        # lightsleep would stop the valve core's clock as well
+        if LIGHTSLEEP_ENABLED and idle and not self.valve_core.threaded:
+            # Sleep until the next timer or schedule event, capped so an
+            # incoming command waits at most the cap
+            sleep_ms = LIGHTSLEEP_MAX_MS
+            for next_ms in (self.timers.next_deadline_ms(), self.scheduler.ms_until_next_event()):
+                if next_ms is not None and next_ms < sleep_ms:
+                    sleep_ms = next_ms
+            if sleep_ms >= LIGHTSLEEP_MIN_MS:
+                machine.lightsleep(sleep_ms)
+    
+    def _local_status(self):
+        """Status returned by the LAN endpoint"""
+        return {
+            "device_id": DEVICE_ID,
+            "timestamp": self.time_sync.get_timestamp(),
+            "valves": self.valve_controller.states_from_mask(self.valve_core.current()[0]),
+            "schedule": self.valve_core.call(self.scheduler.get_status),
+            "cloud": self.mqtt_client.is_connected(),
+            "unsynced": self.shadow_manager.local_desired,
+            "flow": self.valve_core.call(self.flow_monitor.summary) if self.flow_monitor else None
+        }
+    
+    def _log_command(self, message):
+        """Set the log level and/or upload held log records in batches on the log topic"""
+        level = message.get("level")
+        if level is not None and not LOG.set_level(level):
+            LOG.warning("Unknown log level: %s", level)
+        if not message.get("upload", True):
+            return
+        records = LOG.records(message.get("since", 0))
+        for start in range(0, len(records), LOG_UPLOAD_BATCH):
+            batch = {
+                "device_id": DEVICE_ID,
+                "seq": LOG.seq,
+                "records": records[start:start + LOG_UPLOAD_BATCH]
+            }
+            if not self.mqtt_client.publish(LOG_TOPIC, batch, queue=False):
+                break
+    
+    def _publish_metrics(self):
+        """Publish a metrics summary on the metrics topic"""
+        if self.mqtt_client.is_connected():
+            summary = METRICS.summary()
+            summary["device_id"] = DEVICE_ID
+            summary["uptime_seconds"] = time.ticks_ms() // 1000
+            summary["gc"] = self.gc_manager.get_status()
+            summary["valve_core"] = self.valve_core.get_status()
+            summary["log"] = LOG.get_status()
+            summary["commands"] = self.shadow_manager.command_stats
+            self.mqtt_client.publish(METRICS_TOPIC, summary, queue=False)
+        METRICS.reset()
+    
+    async def run_async(self):
+        """Start the valve core, the timer wheel and the event-driven tasks"""
+        if self.flow_monitor is not None:
+            self.flow_monitor.start()
+        self.valve_core.start()
+        self._create_timers()
+        if self.local_api is not None:
+            try:
+                await self.local_api.start()
+            except OSError as e:
+                print(f"Local API not started: {e}")
+        tasks = [
+            asyncio.create_task(self._timer_task()),
+            asyncio.create_task(self._wifi_task()),
+            asyncio.create_task(self._mqtt_supervisor_task()),
+            asyncio.create_task(self._mqtt_reader_task()),
+            asyncio.create_task(self._ntp_task()),
+            asyncio.create_task(self._shadow_report_task()),
+            asyncio.create_task(self._command_task()),
+        ]
+        if self.valve_core.threaded:
+            tasks.append(asyncio.create_task(self._valve_core_task()))
+        await asyncio.gather(*tasks)
+    
+    def run(self):
+        """Main program entry: run the task graph until shutdown"""
+        if not self.setup():
+            print("Setup failed, restarting in 10 seconds...")
+            time.sleep(10)
+            reset()
+            return
+        
+        print("Starting task loop...")
+        
+        try:
+            asyncio.run(self.run_async())
+        except KeyboardInterrupt:
+            print("Received keyboard interrupt")
+            self.shutdown()
+        finally:
+            asyncio.new_event_loop()
+    
+    def send_telemetry(self):
+        """Publish a compact, size-bounded status message on the telemetry topic"""
         try:
+            time_status = self.time_sync.get_status()
+            _, active_valve, run_name, _, _ = self.valve_core.current()
             status = {
                 "device_id": DEVICE_ID,
                 "timestamp": self.time_sync.get_timestamp(),
                 "uptime_seconds": time.ticks_ms() // 1000,
-                "wifi_status": self.wifi.get_status(),
-                "valve_status": self.valve_controller.get_status(),
-                "time_sync_status": self.time_sync.get_status(),
-                "free_memory": gc.mem_free()
+                "ip": self.wifi.get_status()["ip"],
+                "active_valve": active_valve,
+                "schedule": run_name,
+                "time_since_sync_seconds": time_status["time_since_sync_seconds"],
+                "last_connect_ms": self.mqtt_client.connect_stats["last_connect_ms"],
+                "free_memory": gc.mem_free(),
+                "gc_pause_max_us": self.gc_manager.pause_max_us
             }
             
-            # Update reported state in shadow
-            valve_states = self.valve_controller.get_valve_states()
-            self.shadow_manager.update_reported_state(valve_states)
+            message = json.dumps(status)
+            if len(message) > TELEMETRY_MAX_BYTES:
+                print(f"Telemetry too large ({len(message)} bytes), sending minimal status")
+                message = json.dumps({"device_id": DEVICE_ID, "free_memory": status["free_memory"]})
+            
+            return self.mqtt_client.publish(TELEMETRY_TOPIC, message)
             
         except Exception as e:
-            print(f"Error sending heartbeat: {e}")
+            print(f"Error sending telemetry: {e}")
+            return False
     
     def shutdown(self):
         """Graceful shutdown"""
         print("Shutting down...")
         self.running = False
         
-        # Turn off all valves
+        # Turn off all valves; a deliberate shutdown does not resume at boot
+        self.valve_core.stop()
+        if self.flow_monitor is not None:
+            self.flow_monitor.stop()
+        self.scheduler.stop()
         self.valve_controller.emergency_stop()
         
         # Disconnect from services
+        if self.local_api is not None:
+            self.local_api.stop()
         if self.mqtt_client:
             self.mqtt_client.disconnect()
         
@@ -0,0 +1,15 @@
+# Freeze the firmware into a custom MicroPython build, so nothing is read
+# from flash and compiled at boot:
+#   make -C ports/rp2 BOARD=RPI_PICO2_W FROZEN_MANIFEST=/path/to/awsiotcore/manifest.py
+# config.py (per-device settings) and main.py (the script the board runs)
+# stay on the filesystem.
+include("$(BOARD_DIR)/manifest.py")
+require("umqtt.simple")
+
+for name in (
+    "boot_profile", "wifi_manager", "mqtt_client", "outbox", "shadow_manager",
+    "shadow_codec", "valve_controller", "valve_drivers", "time_sync", "scheduler",
+    "gc_manager", "timer_wheel", "journal", "local_api", "metrics", "valve_core",
+    "flow_monitor", "log",
+):
+    module(name + ".py")
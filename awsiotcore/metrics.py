@@ -0,0 +1,123 @@
+import gc
+import time
+from config import METRICS_ENABLED
+
+# Shared bucket upper bounds (microseconds); the last bucket is overflow
+EDGES_US = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000, 3000000, 10000000)
+
+class Histogram:
+    """Fixed-bucket latency histogram; record() allocates nothing"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(EDGES_US) + 1)
+        self.count = 0
+        self.max = 0
+
+    def record(self, value_us):
+        i = 0
+        for edge in EDGES_US:
+            if value_us <= edge:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        if value_us > self.max:
+            self.max = value_us
+
+    def reset(self):
+        for i in range(len(self.buckets)):
+            self.buckets[i] = 0
+        self.count = 0
+        self.max = 0
+
+    def summary(self):
+        return {"n": self.count, "max": self.max, "b": self.buckets}
+
+
+class Metrics:
+    """ticks_us hot-path timings and heap statistics
+
+    Call sites guard with `if METRICS:`, so a disabled build pays one global
+    lookup per site. Inbound messages are stamped at receive time and the
+    stamp follows the command to actuation and to the shadow report.
+    """
+
+    NAMES = ("parse", "handle", "rx_to_gpio", "rx_to_report", "loop_iter", "reconnect")
+
+    def __init__(self):
+        self.histograms = {name: Histogram() for name in self.NAMES}
+        self.rx_us = None          # Receive stamp of the message being handled
+        self.actuated_rx_us = None  # Receive stamp of the last command that moved a valve
+        self.heap_min_free = -1
+        self.messages = 0
+
+    def record(self, name, value_us):
+        self.histograms[name].record(value_us)
+
+    def since(self, name, start_us):
+        self.histograms[name].record(time.ticks_diff(time.ticks_us(), start_us))
+
+    def message_received(self):
+        """Stamp an inbound message; returns the stamp"""
+        self.messages += 1
+        self.rx_us = time.ticks_us()
+        return self.rx_us
+
+    def valve_actuated(self):
+        """A valve output changed; attribute it to the message being handled"""
+        if self.rx_us is not None:
+            self.since("rx_to_gpio", self.rx_us)
+            self.actuated_rx_us = self.rx_us
+
+    def reported(self):
+        """Reported state was published; close the receive-to-report span"""
+        if self.actuated_rx_us is not None:
+            self.since("rx_to_report", self.actuated_rx_us)
+            self.actuated_rx_us = None
+
+    def sample_heap(self):
+        free = gc.mem_free()
+        if self.heap_min_free < 0 or free < self.heap_min_free:
+            self.heap_min_free = free
+        return free
+
+    def _largest_free_block(self, free):
+        """Binary-search the largest single allocation that succeeds"""
+        low, high = 0, free
+        while high - low > 256:
+            mid = (low + high) // 2
+            try:
+                block = bytearray(mid)
+                del block
+                low = mid
+            except MemoryError:
+                high = mid
+        return low
+
+    def summary(self):
+        """Snapshot for the metrics topic; resets the histograms"""
+        gc.collect()
+        free = self.sample_heap()
+        largest = self._largest_free_block(free)
+        report = {
+            "edges_us": EDGES_US,
+            "messages": self.messages,
+            "h": {name: h.summary() for name, h in self.histograms.items() if h.count},
+            "heap": {
+                "free": free,
+                "alloc": gc.mem_alloc(),
+                "min_free": self.heap_min_free,
+                "largest_free": largest,
+                "frag_pct": 100 - largest * 100 // free if free > 0 else 0
+            }
+        }
+        return report
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.messages = 0
+        self.heap_min_free = -1
+
+
+METRICS = Metrics() if METRICS_ENABLED else None
@@ -1,133 +1,355 @@
-import ssl
+import os
 import time
-from umqtt.simple import MQTTClient
+import random
+import binascii
+import select
+import asyncio
 from config import *
 import json
+from outbox import Outbox
+from metrics import METRICS
+from boot_profile import BOOT
+from log import LOG
+
+try:
+    from asyncio import core  # MicroPython: the event loop's poll set
+except ImportError:
+    core = None
+
+def _readable(sock):
+    """Suspend the awaiting task until sock is readable (MicroPython asyncio)"""
+    yield core._io_queue.queue_read(sock)
 
 class AWSIoTClient:
     def __init__(self):
         self.client = None
+        self.ssl_context = None
         self.connected = False
+        self.backoff_ms = 0
+        # Set while connected; the reader task waits on it instead of polling
+        self.ready = asyncio.Event()
+        self._poller = None
+        self.last_tx_ms = time.ticks_ms()
+        self.connect_stats = {
+            'attempts': 0,
+            'successes': 0,
+            'last_context_ms': -1,
+            'last_connect_ms': -1,
+            'min_connect_ms': -1,
+            'max_connect_ms': 0
+        }
+        # bytes topic -> (handler, parse_json)
+        self._routes = {}
+        # Automatic GC is held (hold()/release()) around each message's parse and handler
+        self.gc_guard = None
+        # Publishes made while offline; superseded valve reports are compacted
+        self.outbox = Outbox(priority_topics=(SHADOW_UPDATE_TOPIC,))
         
-    def read_file(self, path):
+        self.register_handler(SHADOW_UPDATE_ACCEPTED_TOPIC, self._handle_shadow_update_accepted, parse=False)
+        self.register_handler(SHADOW_UPDATE_REJECTED_TOPIC, self._handle_shadow_update_rejected)
+        
+    def register_handler(self, topic, handler, parse=True):
+        """Route a topic to handler(message); parse=False passes the raw payload bytes"""
+        if isinstance(topic, str):
+            topic = topic.encode()
+        self._routes[topic] = (handler, parse)
+        if self.client and self.connected:
+            self.client.subscribe(topic)
+        
+    def read_file(self, path, mode='r'):
         """Read certificate/key files"""
         try:
-            with open(path, 'r') as f:
+            with open(path, mode) as f:
                 return f.read()
         except Exception as e:
             print(f"Error reading {path}: {e}")
             return None
     
+    def _load_credential(self, pem_path):
+        """Return a credential as DER bytes, converting and caching the PEM once"""
+        der_path = pem_path + ".der"
+        try:
+            with open(der_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+        
+        pem = self.read_file(pem_path, 'rb')
+        if not pem:
+            return None
+        
+        # Bundles with several blocks stay PEM; mbedtls accepts both
+        if pem.count(b"-----BEGIN") != 1:
+            return pem
+        
+        body = b"".join(line.strip() for line in pem.split(b"\n") if line.strip() and not line.startswith(b"-----"))
+        try:
+            der = binascii.a2b_base64(body)
+        except ValueError:
+            return pem
+        try:
+            with open(der_path, 'wb') as f:
+                f.write(der)
+            print(f"Cached DER credential: {der_path}")
+        except OSError as e:
+            print(f"Could not cache {der_path}: {e}")
+        return der
+    
+    def clear_credential_cache(self):
+        """Forget the cached context and DER files (after replacing certificates)"""
+        self.ssl_context = None
+        self.client = None
+        for path in (DEVICE_CERT_PATH, DEVICE_KEY_PATH, ROOT_CA_PATH):
+            try:
+                os.remove(path + ".der")
+            except OSError:
+                pass
+    
+    def _get_ssl_context(self):
+        """Build the SSL context once and reuse it for every reconnect"""
+        if self.ssl_context is not None:
+            return self.ssl_context
+        
+        device_cert = self._load_credential(DEVICE_CERT_PATH)
+        device_key = self._load_credential(DEVICE_KEY_PATH)
+        root_ca = self._load_credential(ROOT_CA_PATH)
+        
+        if not all([device_cert, device_key, root_ca]):
+            print("Missing certificate files")
+            return None
+        
+        import ssl  # Deferred: only needed once, off the import path at boot
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_cert_chain(device_cert, device_key)
+        context.load_verify_locations(cadata=root_ca)
+        
+        self.ssl_context = context
+        return context
+    
+    def prepare(self):
+        """Load the credentials and build the TLS context ahead of the first connect"""
+        return self._get_ssl_context() is not None
+    
     def connect(self):
         """Connect to AWS IoT Core with SSL/TLS"""
+        self.connect_stats['attempts'] += 1
+        start_ms = time.ticks_ms()
         try:
-            # Read certificates
-            device_cert = self.read_file(DEVICE_CERT_PATH)
-            device_key = self.read_file(DEVICE_KEY_PATH)
-            root_ca = self.read_file(ROOT_CA_PATH)
-            
-            if not all([device_cert, device_key, root_ca]):
-                print("Missing certificate files")
-                return False
-            
-            # Create SSL context
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_REQUIRED
-            
-            # Load certificates
-            context.load_cert_chain(DEVICE_CERT_PATH, DEVICE_KEY_PATH)
-            context.load_verify_locations(ROOT_CA_PATH)
+            context = self._get_ssl_context()
+            if context is None:
+                return self._connect_failed()
+            context_ms = time.ticks_diff(time.ticks_ms(), start_ms)
             
-            # Create MQTT client
-            self.client = MQTTClient(
-                client_id=DEVICE_ID,
-                server=AWS_IOT_ENDPOINT,
-                port=AWS_IOT_PORT,
-                ssl=context,
-                keepalive=60
-            )
+            # The client object is reused; connect() opens a fresh socket
+            if self.client is None:
+                from umqtt.simple import MQTTClient
+                self.client = MQTTClient(
+                    client_id=DEVICE_ID,
+                    server=AWS_IOT_ENDPOINT,
+                    port=AWS_IOT_PORT,
+                    ssl=context,
+                    keepalive=MQTT_KEEPALIVE_SECONDS
+                )
+                self.client.set_callback(self._message_callback)
+            elif self.client.sock:
+                try:
+                    self.client.sock.close()
+                except Exception:
+                    pass
             
-            self.client.set_callback(self._message_callback)
             self.client.connect()
             self.connected = True
-            print(f"Connected to AWS IoT Core: {AWS_IOT_ENDPOINT}")
+            self._poller = select.poll()
+            self._poller.register(self.client.sock, select.POLLIN)
+            self.last_tx_ms = time.ticks_ms()
+            self.ready.set()
             
-            # Subscribe to shadow topics
-            self.client.subscribe(SHADOW_UPDATE_ACCEPTED_TOPIC)
-            self.client.subscribe(SHADOW_UPDATE_REJECTED_TOPIC)
-            self.client.subscribe(SHADOW_GET_ACCEPTED_TOPIC)
+            # Subscribe to every routed topic
+            for topic in self._routes:
+                self.client.subscribe(topic)
             
+            total_ms = time.ticks_diff(time.ticks_ms(), start_ms)
+            self._record_connect(context_ms, total_ms)
+            BOOT.mark("mqtt")
+            LOG.info("Connected to AWS IoT Core: %s in %d ms (credentials %d ms)", AWS_IOT_ENDPOINT, total_ms, context_ms)
             return True
             
         except Exception as e:
-            print(f"MQTT connection error: {e}")
-            return False
+            LOG.error("MQTT connection error: %s", e)
+            return self._connect_failed()
+    
+    def _record_connect(self, context_ms, total_ms):
+        """Record reconnect timing and reset the backoff"""
+        stats = self.connect_stats
+        stats['successes'] += 1
+        if METRICS:
+            METRICS.record("reconnect", total_ms * 1000)
+        stats['last_context_ms'] = context_ms
+        stats['last_connect_ms'] = total_ms
+        if stats['min_connect_ms'] < 0 or total_ms < stats['min_connect_ms']:
+            stats['min_connect_ms'] = total_ms
+        if total_ms > stats['max_connect_ms']:
+            stats['max_connect_ms'] = total_ms
+        self.backoff_ms = 0
+    
+    def _connect_failed(self):
+        """Grow the reconnect backoff exponentially with jitter"""
+        if self.backoff_ms:
+            self.backoff_ms = min(self.backoff_ms * 2, MQTT_BACKOFF_MAX_MS)
+        else:
+            self.backoff_ms = MQTT_BACKOFF_MIN_MS
+        return False
+    
+    def retry_delay_ms(self):
+        """Delay before the next connect attempt (equal jitter: half fixed, half random)"""
+        if not self.backoff_ms:
+            return 0
+        half = self.backoff_ms // 2
+        return half + random.getrandbits(16) % (half + 1)
     
     def disconnect(self):
         """Disconnect from AWS IoT Core"""
         if self.client and self.connected:
             try:
                 self.client.disconnect()
-                self.connected = False
-                print("Disconnected from AWS IoT Core")
+                self._mark_disconnected()
+                LOG.info("Disconnected from AWS IoT Core")
             except Exception as e:
-                print(f"Disconnect error: {e}")
+                LOG.warning("Disconnect error: %s", e)
     
-    def publish(self, topic, message):
-        """Publish message to topic"""
+    def publish(self, topic, message, queue=True, covers=0):
+        """Publish message to topic; while offline it is queued to flash when queue=True
+
+        covers is passed to Outbox.put to compact superseded queued records.
+        """
+        if isinstance(message, dict):
+            message = json.dumps(message)
+        
         if not self.connected:
-            print("Not connected to MQTT broker")
+            if queue and self.outbox.put(topic, message, covers):
+                return True
+            LOG.warning("Not connected to MQTT broker")
             return False
-            
+        
+        if self._publish_raw(topic, message):
+            return True
+        return queue and self.outbox.put(topic, message, covers)
+    
+    def _publish_raw(self, topic, message):
+        """Publish without queueing; a failure marks the connection down"""
         try:
-            if isinstance(message, dict):
-                message = json.dumps(message)
             self.client.publish(topic, message)
+            self.last_tx_ms = time.ticks_ms()
             return True
         except Exception as e:
-            print(f"Publish error: {e}")
+            LOG.error("Publish error: %s", e)
+            self._mark_disconnected()
             return False
     
-    def check_messages(self):
-        """Check for incoming messages"""
-        if self.client and self.connected:
-            try:
+    def _mark_disconnected(self):
+        self.connected = False
+        self.ready.clear()
+    
+    def keepalive(self):
+        """Ping when nothing was sent for half the keepalive period"""
+        if not self.connected:
+            return
+        if time.ticks_diff(time.ticks_ms(), self.last_tx_ms) < MQTT_KEEPALIVE_SECONDS * 500:
+            return
+        try:
+            self.client.ping()
+            self.last_tx_ms = time.ticks_ms()
+        except Exception as e:
+            LOG.error("Ping error: %s", e)
+            self._mark_disconnected()
+    
+    def drain_outbox(self, max_records=OUTBOX_DRAIN_BATCH, priority_only=False):
+        """Replay one rate-limited batch of queued publishes"""
+        if not self.connected or not len(self.outbox):
+            return 0
+        sent = self.outbox.drain(self._publish_raw, max_records, priority_only)
+        if sent:
+            LOG.info("Outbox: replayed %d, %d pending", sent, len(self.outbox))
+        return sent
+    
+    async def wait_readable(self):
+        """Suspend until the MQTT socket has data; the event loop sleeps in poll() meanwhile"""
+        sock = self.client.sock
+        if core is not None:
+            await _readable(sock)
+            return
+        # CPython event loop (host simulation)
+        loop = asyncio.get_event_loop()
+        readable = loop.create_future()
+        loop.add_reader(sock, readable.set_result, None)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(sock)
+    
+    def check_messages(self, max_messages=MQTT_MAX_MESSAGES_PER_WAKE):
+        """Dispatch the messages waiting on the socket; returns the number of reads"""
+        if not (self.client and self.connected):
+            return 0
+        count = 0
+        try:
+            while count < max_messages:
                 self.client.check_msg()
-            except Exception as e:
-                print(f"Message check error: {e}")
-                self.connected = False
+                count += 1
+                if not self._poller.poll(0):
+                    break
+        except Exception as e:
+            LOG.error("Message check error: %s", e)
+            self._mark_disconnected()
+        return count
     
     def _message_callback(self, topic, msg):
-        """Handle incoming MQTT messages"""
+        """Dispatch an incoming MQTT message to its handler, parsing at most once"""
+        route = self._routes.get(topic)
+        if route is None:
+            LOG.warning("No handler for topic: %s", topic)
+            return
+        
+        handler, parse = route
+        LOG.debug("Message on %s (%d bytes)", topic, len(msg))
+        if METRICS:
+            rx_us = METRICS.message_received()
+        guard = self.gc_guard
+        if guard:
+            guard.hold()
         try:
-            topic_str = topic.decode('utf-8')
-            message = json.loads(msg.decode('utf-8'))
-            print(f"Received message on {topic_str}: {message}")
-            
-            # Handle shadow responses
-            if topic_str == SHADOW_UPDATE_ACCEPTED_TOPIC:
-                self._handle_shadow_update_accepted(message)
-            elif topic_str == SHADOW_UPDATE_REJECTED_TOPIC:
-                self._handle_shadow_update_rejected(message)
-            elif topic_str == SHADOW_GET_ACCEPTED_TOPIC:
-                self._handle_shadow_get_accepted(message)
-                
+            if parse:
+                msg = json.loads(msg)
+                if METRICS:
+                    METRICS.since("parse", rx_us)
+            handler(msg)
         except Exception as e:
-            print(f"Message callback error: {e}")
+            LOG.error("Message callback error: %s", e)
+        finally:
+            if guard:
+                guard.release()
+        if METRICS:
+            METRICS.since("handle", rx_us)
+            METRICS.rx_us = None
     
-    def _handle_shadow_update_accepted(self, message):
+    def _handle_shadow_update_accepted(self, msg):
         """Handle shadow update accepted"""
-        print("Shadow update accepted")
+        LOG.debug("Shadow update accepted")
     
     def _handle_shadow_update_rejected(self, message):
         """Handle shadow update rejected"""
-        print(f"Shadow update rejected: {message}")
+        LOG.warning("Shadow update rejected: %s", message)
     
-    def _handle_shadow_get_accepted(self, message):
-        """Handle shadow get accepted"""
-        print("Shadow get accepted")
-        # This will be handled by the shadow manager
+    def get_status(self):
+        """Get MQTT connection status"""
+        return {
+            'connected': self.connected,
+            'backoff_ms': self.backoff_ms,
+            'connect_stats': self.connect_stats,
+            'outbox': self.outbox.get_status()
+        }
     
     def is_connected(self):
         """Check if connected to MQTT broker"""
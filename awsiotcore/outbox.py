@@ -0,0 +1,180 @@
+import struct
+from config import OUTBOX_PATH, OUTBOX_SLOTS, OUTBOX_SLOT_SIZE
+
+# Slot layout: sequence (0 = never written), topic length, payload length
+_HEADER = "<IHH"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+class Outbox:
+    """Store-and-forward queue of MQTT publishes in fixed-size flash slots
+
+    Record N always lives in slot N % OUTBOX_SLOTS, so writes rotate evenly
+    over the file and a full queue overwrites its oldest record. Drained
+    records are not erased; the highest delivered sequence is kept in a
+    small side file written once per batch.
+
+    A record may carry a covers bitmask (e.g. the valves a shadow report
+    restates); it supersedes queued records whose mask it fully covers.
+    Records without one, such as run progress or faults, are always
+    delivered. Masks live in RAM only, so records reloaded from flash are
+    never compacted.
+    """
+
+    def __init__(self, priority_topics=(), path=OUTBOX_PATH, slots=OUTBOX_SLOTS, slot_size=OUTBOX_SLOT_SIZE):
+        self.path = path
+        self.ack_path = path + ".ack"
+        self.slots = slots
+        self.slot_size = slot_size
+        self.priority_topics = set(t.encode() if isinstance(t, str) else t for t in priority_topics)
+        self.pending = []  # [(seq, topic, covers)] oldest first
+        self.next_seq = 1
+        self.acked_seq = 0
+        self.dropped = 0
+        self._load()
+
+    def _load(self):
+        """Rebuild the pending index from the slot headers"""
+        try:
+            with open(self.ack_path, "rb") as f:
+                self.acked_seq = struct.unpack("<I", f.read(4))[0]
+        except (OSError, ValueError, struct.error):
+            self.acked_seq = 0
+
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            self._format()
+            self.next_seq = self.acked_seq + 1
+            return
+
+        records = []
+        highest = self.acked_seq
+        with f:
+            for slot in range(self.slots):
+                f.seek(slot * self.slot_size)
+                header = f.read(_HEADER_SIZE)
+                if len(header) < _HEADER_SIZE:
+                    break
+                seq, topic_len, _ = struct.unpack(_HEADER, header)
+                if seq > highest:
+                    highest = seq
+                if seq > self.acked_seq:
+                    records.append((seq, f.read(topic_len)))
+
+        records.sort()
+        for seq, topic in records:
+            self._index(seq, topic, 0)
+        self.next_seq = highest + 1
+        if self.pending:
+            print(f"Outbox: {len(self.pending)} record(s) pending from flash")
+
+    def _format(self):
+        """Create the slot file at its full size"""
+        blank = bytes(self.slot_size)
+        with open(self.path, "wb") as f:
+            for _ in range(self.slots):
+                f.write(blank)
+
+    def _index(self, seq, topic, covers):
+        """Add a record to the pending index, compacting the ones it supersedes"""
+        if covers:
+            self.pending = [r for r in self.pending
+                            if not (r[1] == topic and r[2] and r[2] & ~covers == 0)]
+        self.pending.append((seq, topic, covers))
+
+    def put(self, topic, payload, covers=0):
+        """Append a publish to the queue; returns False if it cannot be stored"""
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+
+        size = _HEADER_SIZE + len(topic) + len(payload)
+        if size > self.slot_size:
+            print(f"Outbox: record too large ({size} bytes), dropped")
+            self.dropped += 1
+            return False
+
+        seq = self.next_seq
+        # The target slot may still hold an undelivered record from one lap ago
+        overwritten = seq - self.slots
+        for record in self.pending:
+            if record[0] == overwritten:
+                self.pending.remove(record)
+                self.dropped += 1
+                break
+
+        try:
+            with open(self.path, "r+b") as f:
+                f.seek((seq % self.slots) * self.slot_size)
+                f.write(struct.pack(_HEADER, seq, len(topic), len(payload)))
+                f.write(topic)
+                f.write(payload)
+        except OSError as e:
+            print(f"Outbox write error: {e}")
+            return False
+
+        self.next_seq = seq + 1
+        self._index(seq, topic, covers)
+        return True
+
+    def _read(self, seq):
+        """Read (topic, payload) for a pending record"""
+        with open(self.path, "rb") as f:
+            f.seek((seq % self.slots) * self.slot_size)
+            stored_seq, topic_len, payload_len = struct.unpack(_HEADER, f.read(_HEADER_SIZE))
+            if stored_seq != seq:
+                return None
+            return f.read(topic_len), f.read(payload_len)
+
+    def drain(self, publish, max_records, priority_only=False):
+        """Replay up to max_records through publish(topic, payload); returns the number sent
+
+        Priority topics (shadow reports) go first, oldest first. Only a
+        complete priority_only drain before the live reports guarantees no
+        older queued report lands after them.
+        """
+        batch = [r for r in self.pending if r[1] in self.priority_topics]
+        if not priority_only:
+            batch += [r for r in self.pending if r[1] not in self.priority_topics]
+
+        sent = 0
+        for record in batch[:max_records]:
+            seq = record[0]
+            try:
+                entry = self._read(seq)
+            except OSError as e:
+                print(f"Outbox read error: {e}")
+                break
+            if entry is not None and not publish(entry[0], entry[1]):
+                break
+            self.pending.remove(record)
+            sent += 1
+
+        if sent:
+            self._ack()
+        return sent
+
+    def _ack(self):
+        """Persist the delivered watermark (one small write per batch)"""
+        acked = self.pending[0][0] - 1 if self.pending else self.next_seq - 1
+        if acked == self.acked_seq:
+            return
+        try:
+            with open(self.ack_path, "wb") as f:
+                f.write(struct.pack("<I", acked))
+            self.acked_seq = acked
+        except OSError as e:
+            print(f"Outbox ack write error: {e}")
+
+    def __len__(self):
+        return len(self.pending)
+
+    def get_status(self):
+        """Get outbox status"""
+        return {
+            'pending': len(self.pending),
+            'dropped': self.dropped,
+            'next_seq': self.next_seq,
+            'acked_seq': self.acked_seq
+        }
@@ -0,0 +1,556 @@
+import json
+import time
+from config import (
+    NUM_VALVES, SCHEDULE_PATH, SCHEDULE_UTC_OFFSET_MINUTES, SCHEDULE_MISSED_GRACE_SECONDS,
+    SCHEDULE_MAX_STEP_SECONDS, SCHEDULE_MAX_SOAK_SECONDS, SCHEDULE_TICK_MS, BATCH_MAX_STEPS, BATCH_QUEUE_MAX
+)
+from log import LOG
+
+SECONDS_PER_DAY = 86400
+
+# A step's valve timer runs this much past the step so the tick closes it first
+_STEP_GRACE_SECONDS = 2 * SCHEDULE_TICK_MS // 1000
+
+# Packed-plan entry states
+_WAITING, _OPEN, _DONE = 0, 1, 2
+
+class ScheduleEngine:
+    """Weekly irrigation programs run locally from the RTC kept by TimeSync
+
+    A program is {"days": [0..6], "start": minute_of_day, "steps": [[valve, seconds], ...],
+    "enabled": bool}, with days numbered like time.gmtime() (0 = Monday) and
+    valves numbered from 1 as in the shadow. A step may carry a third
+    element, a soak time in seconds with all valves closed before the next
+    step. The earliest next start over all programs is precomputed whenever
+    programs change or one finishes, so tick() is a constant-time comparison.
+
+    Batch programs (one-off step lists from the program command topic) run
+    through the same step machinery and queue behind the active run.
+
+    With concurrent zones, a run's steps are first packed into a plan of
+    [start_seconds, valve_index, seconds] entries that overlap within the
+    valve supply budget, and the plan is executed instead of one step after
+    another. A step's soak then only delays the next step of the same zone.
+    """
+
+    def __init__(self, valve_controller, time_sync, on_change=None, report=None, persist=None):
+        self.valve_controller = valve_controller
+        self.time_sync = time_sync
+        self.on_change = on_change
+        # report(fields) publishes reported shadow fields (run progress)
+        self.report = report
+        # persist(programs) has them written to flash (by core 0); None saves inline
+        self.persist = persist
+        self.programs = {}
+        self.next_fire_at = None
+        self.next_fire_name = None
+        # Active run: name, its steps, step index, valve index, ticks_ms deadline
+        self.run_name = None
+        self.run_steps = None
+        self.run_step = 0
+        self.run_valve = None
+        self.soaking = False
+        self.step_end_ms = 0
+        # Packed run (concurrent zones): plan entries, their states, ticks_ms start
+        self.run_plan = None
+        self._plan_state = None
+        self.run_started_ms = 0
+        # Batch programs waiting to run: (id, steps)
+        self.batch_queue = []
+        self._reported_run = None
+        self.load()
+
+    def load(self):
+        """Load programs from flash"""
+        try:
+            with open(SCHEDULE_PATH, 'r') as f:
+                self.programs = json.load(f)
+            print(f"Loaded {len(self.programs)} schedule program(s)")
+        except (OSError, ValueError):
+            self.programs = {}
+        self.reschedule()
+
+    def save(self, programs=None):
+        """Persist programs (default: the current ones) to flash (only on edit)"""
+        try:
+            with open(SCHEDULE_PATH, 'w') as f:
+                json.dump(self.programs if programs is None else programs, f)
+        except OSError as e:
+            LOG.error("Error saving schedules: %s", e)
+
+    def validate(self, program):
+        """Return None if the program is valid, otherwise a reason string"""
+        days = program.get("days")
+        if not isinstance(days, list) or not all(isinstance(d, int) and 0 <= d <= 6 for d in days):
+            return "days must be a list of 0-6"
+        start = program.get("start")
+        if not isinstance(start, int) or not 0 <= start < 1440:
+            return "start must be a minute of day (0-1439)"
+        return self.validate_steps(program.get("steps"))
+
+    def validate_steps(self, steps):
+        """Return None if steps is a valid [[valve, seconds(, soak)], ...] list, otherwise a reason"""
+        if not isinstance(steps, list) or not steps:
+            return "steps must be a non-empty list"
+        if len(steps) > BATCH_MAX_STEPS:
+            return f"at most {BATCH_MAX_STEPS} steps"
+        for step in steps:
+            if not isinstance(step, list) or not 2 <= len(step) <= 3:
+                return "each step must be [valve, seconds] or [valve, seconds, soak]"
+            valve, seconds = step[0], step[1]
+            if not isinstance(valve, int) or not 1 <= valve <= NUM_VALVES:
+                return f"invalid valve {valve}"
+            if not isinstance(seconds, int) or not 0 < seconds <= SCHEDULE_MAX_STEP_SECONDS:
+                return f"invalid duration {seconds}"
+            # The valve's hard auto-off must not cut the step short
+            limit = self.valve_controller.max_run_seconds[valve - 1]
+            if limit and seconds + _STEP_GRACE_SECONDS > limit:
+                return f"valve {valve} runs at most {limit - _STEP_GRACE_SECONDS} s per step"
+            if len(step) == 3 and (not isinstance(step[2], int) or not 0 <= step[2] <= SCHEDULE_MAX_SOAK_SECONDS):
+                return f"invalid soak {step[2]}"
+        return None
+
+    def update_programs(self, changes):
+        """Merge program changes from the shadow; returns the programs accepted"""
+        accepted = {}
+        for name, fields in changes.items():
+            if fields is None:
+                if self.programs.pop(name, None) is not None:
+                    accepted[name] = None
+                    if name == self.run_name:
+                        self.stop()
+                continue
+            program = dict(self.programs.get(name, {"enabled": True}))
+            program.update(fields)
+            error = self.validate(program)
+            if error:
+                LOG.warning("Rejected schedule %s: %s", name, error)
+                continue
+            self.programs[name] = program
+            accepted[name] = program
+
+        if accepted:
+            if self.persist:
+                # A copy, as the programs may change again before it is written
+                self.persist(dict(self.programs))
+            else:
+                self.save()
+            self.reschedule()
+        return accepted
+
+    def _local_now(self):
+        return self.time_sync.get_timestamp() + SCHEDULE_UTC_OFFSET_MINUTES * 60
+
+    def _next_start(self, program, local_now):
+        """Next local start time of a program strictly after local_now"""
+        day_start = local_now - local_now % SECONDS_PER_DAY
+        weekday = time.gmtime(local_now)[6]
+        offset = program["start"] * 60
+        for ahead in range(8):
+            if (weekday + ahead) % 7 in program["days"]:
+                candidate = day_start + ahead * SECONDS_PER_DAY + offset
+                if candidate > local_now:
+                    return candidate
+        return None
+
+    def reschedule(self):
+        """Recompute the earliest next start over all enabled programs"""
+        self.next_fire_at = None
+        self.next_fire_name = None
+        if not self.time_sync.is_time_valid():
+            return
+        local_now = self._local_now()
+        for name, program in self.programs.items():
+            if not program.get("enabled", True):
+                continue
+            start = self._next_start(program, local_now)
+            if start is not None and (self.next_fire_at is None or start < self.next_fire_at):
+                self.next_fire_at = start
+                self.next_fire_name = name
+
+    def ms_until_next_event(self):
+        """Milliseconds until the next step change or program start, or None"""
+        if self.run_name is not None:
+            return max(0, time.ticks_diff(self.step_end_ms, time.ticks_ms()))
+        if self.next_fire_at is None:
+            return None
+        return max(0, (self.next_fire_at - self._local_now()) * 1000)
+
+    def tick(self):
+        """Advance the active run and start (or queue) the next program when due"""
+        if self.run_name is not None and time.ticks_diff(time.ticks_ms(), self.step_end_ms) >= 0:
+            if self.run_plan is not None:
+                self._advance_plan()
+            else:
+                self._next_step()
+
+        if self.next_fire_at is None:
+            if self.run_name is None and self.programs and self.time_sync.is_time_valid():
+                self.reschedule()
+            return
+
+        late = self._local_now() - self.next_fire_at
+        if late < 0:
+            return
+        if late > SCHEDULE_MISSED_GRACE_SECONDS:
+            # Clock stepped past the start; don't water hours late
+            LOG.warning("Skipping missed schedule %s (%d s late)", self.next_fire_name, late)
+            self.reschedule()
+            return
+        if self.run_name is None:
+            self.start_program(self.next_fire_name)
+        else:
+            self._queue_program(self.next_fire_name)
+
+    def _queue_program(self, name):
+        """A program fell due during another run: run it next, like a batch"""
+        self.reschedule()
+        if name == self.run_name or any(entry[0] == name for entry in self.batch_queue):
+            error = "already running or queued"
+        elif len(self.batch_queue) >= BATCH_QUEUE_MAX:
+            error = "queue full"
+        else:
+            self.batch_queue.append((name, self.programs[name]["steps"]))
+            LOG.info("Queued schedule %s behind %s", name, self.run_name)
+            self._report_queue()
+            if self.on_change:
+                self.on_change()
+            return
+        LOG.warning("Skipping schedule %s: %s", name, error)
+        if self.report is not None:
+            self.report({"run_rejected": {"id": name, "error": error}})
+
+    def start_program(self, name):
+        """Start a program immediately"""
+        if name not in self.programs:
+            LOG.warning("Unknown schedule: %s", name)
+            return False
+        self.stop()
+        LOG.info("Starting schedule %s", name)
+        self._start(name, self.programs[name]["steps"])
+        return True
+
+    def _start(self, name, steps):
+        self.run_name = name
+        self.run_steps = steps
+        self.run_step = -1
+        self.soaking = False
+        if self.valve_controller.concurrent:
+            self.run_plan = self.plan(steps)
+            self._plan_state = bytearray(len(self.run_plan))
+            self.run_started_ms = time.ticks_ms()
+            LOG.info("Packed %s into a %d s window (%d s one at a time)", name, self.plan_window(),
+                     sum(step[1] for step in steps))
+            self._advance_plan()
+        else:
+            self._next_step()
+
+    def plan(self, steps):
+        """Pack steps into overlapping slots within the valve budget; [[start, valve_index, seconds], ...]
+
+        Greedy list scheduling, longest step first: at each point in time
+        every zone whose next step is ready is started, longest first, while
+        the budget allows; then time advances to the next step end or zone
+        ready time. A zone's steps keep their order, never overlap, and the
+        next one waits out the previous one's soak.
+        """
+        fits = self.valve_controller.within_budget
+        pending = [(step[0] - 1, step[1], step[2] if len(step) > 2 else 0) for step in steps]
+        ready = {}
+        running = []
+        plan = []
+        now = 0
+        while pending:
+            running = [entry for entry in running if entry[0] > now]
+            mask = 0
+            for entry in running:
+                mask |= 1 << entry[1]
+            # The next step of each idle, ready zone, longest first
+            heads = []
+            seen = 0
+            for job in pending:
+                bit = 1 << job[0]
+                if not seen & bit:
+                    seen |= bit
+                    if not mask & bit and ready.get(job[0], 0) <= now:
+                        heads.append(job)
+            heads.sort(key=lambda job: -job[1])
+            for job in heads:
+                valve, seconds, soak = job
+                if fits(mask | (1 << valve)):
+                    mask |= 1 << valve
+                    plan.append([now, valve, seconds])
+                    running.append((now + seconds, valve))
+                    ready[valve] = now + seconds + soak
+                    pending.remove(job)
+            later = [entry[0] for entry in running] + [t for t in ready.values() if t > now]
+            if not later:
+                break
+            now = min(later)
+        plan.sort()
+        return plan
+
+    def plan_window(self):
+        """Seconds from the start of the packed run to its last step end"""
+        return max(entry[0] + entry[2] for entry in self.run_plan) if self.run_plan else 0
+
+    def _advance_plan(self, notify=True):
+        """Open and close the packed entries due by now; the run completes after the last one"""
+        valves = self.valve_controller
+        state = self._plan_state
+        elapsed = time.ticks_diff(time.ticks_ms(), self.run_started_ms)
+        next_ms = None
+        started = 0
+        is_open = False
+        changed = False
+        for i, (start, valve, seconds) in enumerate(self.run_plan):
+            begin = start * 1000
+            end = begin + seconds * 1000
+            if state[i] != _DONE and elapsed >= end:
+                if state[i] == _OPEN:
+                    valves.set_valve(valve, False)
+                state[i] = _DONE
+                changed = True
+            if state[i] == _DONE:
+                started += 1
+                continue
+            due = begin
+            if elapsed >= begin:
+                if state[i] == _WAITING:
+                    # The valve's run timer backstops the entry end, with two ticks of grace
+                    if valves.set_valve(valve, True, (end - elapsed + 999) // 1000 + _STEP_GRACE_SECONDS):
+                        state[i] = _OPEN
+                        changed = True
+                due = end if state[i] == _OPEN else elapsed + SCHEDULE_TICK_MS
+            if state[i] == _OPEN:
+                started += 1
+                is_open = True
+            if next_ms is None or due < next_ms:
+                next_ms = due
+
+        self.run_step = started - 1
+        self.soaking = not is_open
+        if next_ms is None:
+            self._complete()
+        else:
+            self.step_end_ms = time.ticks_add(self.run_started_ms, next_ms)
+            if changed and notify:
+                self._progress("watering" if is_open else "soaking")
+        if (changed or next_ms is None) and notify and self.on_change:
+            self.on_change()
+
+    def _complete(self):
+        LOG.info("Run %s complete", self.run_name)
+        self._progress("done")
+        self.run_name = None
+        self.run_steps = None
+        self.run_plan = None
+        self.reschedule()
+        self._start_queued()
+
+    def _next_step(self):
+        """Close the current step's valve, soak if asked, then open the next one"""
+        steps = self.run_steps
+        if self.run_valve is not None:
+            self.valve_controller.set_valve(self.run_valve, False)
+            self.run_valve = None
+            step = steps[self.run_step]
+            if len(step) > 2 and step[2] and self.run_step + 1 < len(steps):
+                self.soaking = True
+                self.step_end_ms = time.ticks_add(time.ticks_ms(), step[2] * 1000)
+                self._progress("soaking")
+                if self.on_change:
+                    self.on_change()
+                return
+
+        self.soaking = False
+        self.run_step += 1
+        if self.run_step >= len(steps):
+            self._complete()
+        else:
+            valve, seconds = steps[self.run_step][0], steps[self.run_step][1]
+            self.run_valve = valve - 1
+            # The valve's own run timer is the hard backstop for the step; two
+            # ticks of grace keep it from racing the normal step change
+            self.valve_controller.set_valve(self.run_valve, True, seconds + _STEP_GRACE_SECONDS)
+            self.step_end_ms = time.ticks_add(time.ticks_ms(), seconds * 1000)
+            self._progress("watering")
+
+        if self.on_change:
+            self.on_change()
+
+    def stop(self):
+        """Abort the active run, closing its valve"""
+        if self.run_name is None:
+            return
+        LOG.info("Stopping run %s", self.run_name)
+        if self.run_plan is not None:
+            for i, entry in enumerate(self.run_plan):
+                if self._plan_state[i] == _OPEN:
+                    self.valve_controller.set_valve(entry[1], False)
+            self.run_plan = None
+        elif self.run_valve is not None:
+            self.valve_controller.set_valve(self.run_valve, False)
+            self.run_valve = None
+        self._progress("cancelled")
+        self.run_name = None
+        self.run_steps = None
+        self.soaking = False
+        self.reschedule()
+        if self.on_change:
+            self.on_change()
+
+    def position(self):
+        """The active run and queue as a JSON-able dict (for the journal), or None"""
+        if self.run_name is None:
+            return None
+        position = {
+            "name": self.run_name,
+            "steps": self.run_steps,
+            "step": self.run_step,
+            "soaking": self.soaking,
+            "left": (max(0, time.ticks_diff(self.step_end_ms, time.ticks_ms())) + 999) // 1000,
+            "at": self.time_sync.get_timestamp(),
+            "queue": self.batch_queue
+        }
+        if self.run_plan is not None:
+            position["plan"] = self.run_plan
+            position["elapsed"] = time.ticks_diff(time.ticks_ms(), self.run_started_ms) // 1000
+        return position
+
+    def resume(self, position, elapsed=0):
+        """Continue a run from a saved position, elapsed seconds after it was taken"""
+        self.run_name = position["name"]
+        self.run_steps = position["steps"]
+        self.run_step = position["step"]
+        self.soaking = position["soaking"]
+        self.batch_queue = [tuple(entry) for entry in position["queue"]]
+        if "plan" in position:
+            self.run_plan = position["plan"]
+            self._plan_state = bytearray(len(self.run_plan))
+            self.run_started_ms = time.ticks_add(time.ticks_ms(), -(position["elapsed"] + elapsed) * 1000)
+            LOG.info("Resumed packed run %s at %d s of %d s", self.run_name,
+                     position["elapsed"] + elapsed, self.plan_window())
+            self._advance_plan(notify=False)
+            if self.run_name is not None:
+                self._progress("soaking" if self.soaking else "watering")
+            return
+        left = max(0, position["left"] - elapsed)
+        self.step_end_ms = time.ticks_add(time.ticks_ms(), left * 1000)
+        if not self.soaking and left:
+            self.run_valve = self.run_steps[self.run_step][0] - 1
+            self.valve_controller.set_valve(self.run_valve, True, left + _STEP_GRACE_SECONDS)
+        LOG.info("Resumed run %s at step %d (%d s left)", self.run_name, self.run_step + 1, left)
+        self._progress("soaking" if self.soaking else "watering")
+
+    def queue_batch(self, run_id, steps, soak=0, replace=False):
+        """Validate a one-off program and run it now or after the active run"""
+        if not isinstance(soak, int) or not 0 <= soak <= SCHEDULE_MAX_SOAK_SECONDS:
+            error = f"invalid soak {soak}"
+        else:
+            error = self.validate_steps(steps)
+        if error is None and not replace and len(self.batch_queue) >= BATCH_QUEUE_MAX:
+            error = "queue full"
+        if error:
+            LOG.warning("Rejected program %s: %s", run_id, error)
+            if self.report is not None:
+                self.report({"run_rejected": {"id": run_id, "error": error}})
+            return False
+
+        # The batch-wide soak applies to steps without their own
+        steps = [step if len(step) > 2 else [step[0], step[1], soak] for step in steps]
+        if replace:
+            self.batch_queue = []
+            self.stop()
+        self.batch_queue.append((run_id, steps))
+        LOG.info("Queued program %s (%d steps)", run_id, len(steps))
+        if self.run_name is None:
+            self._start_queued()
+        else:
+            self._report_queue()
+            if self.on_change:
+                self.on_change()
+        return True
+
+    def cancel_batch(self, run_id):
+        """Drop a queued program or stop it if it is running"""
+        for entry in self.batch_queue:
+            if entry[0] == run_id:
+                self.batch_queue.remove(entry)
+                self._report_queue()
+                if self.on_change:
+                    self.on_change()
+                return True
+        if self.run_name == run_id:
+            self.stop()
+            self._start_queued()
+            return True
+        return False
+
+    def _start_queued(self):
+        if self.batch_queue and self.run_name is None:
+            run_id, steps = self.batch_queue.pop(0)
+            LOG.info("Starting program %s", run_id)
+            self._report_queue()
+            self._start(run_id, steps)
+
+    def handle_command(self, message):
+        """Program command: {"id", "steps", "soak", "replace"} or {"id", "cancel": true}"""
+        run_id = message.get("id")
+        if not isinstance(run_id, str) or not run_id:
+            LOG.warning("Program command without an id")
+            return
+        if message.get("cancel"):
+            self.cancel_batch(run_id)
+        else:
+            self.queue_batch(run_id, message.get("steps"), message.get("soak", 0), message.get("replace", False))
+
+    def _progress(self, state):
+        """Report the active run's position; only changed fields are sent"""
+        run = {
+            "id": self.run_name,
+            "state": state,
+            "step": min(self.run_step + 1, len(self.run_steps)),
+            "of": len(self.run_steps)
+        }
+        if self.run_plan is not None:
+            run["window"] = self.plan_window()
+        self._send_run(run)
+
+    def _report_queue(self):
+        if self.report is not None:
+            self.report({"run_queue": [entry[0] for entry in self.batch_queue]})
+
+    def _send_run(self, run):
+        if self.report is None:
+            return
+        last = self._reported_run
+        if last is None or last.get("id") != run.get("id"):
+            changes = run
+        else:
+            changes = {}
+            for key, value in run.items():
+                if last.get(key) != value:
+                    changes[key] = value
+            if not changes:
+                return
+        self._reported_run = dict(run)
+        self.report({"run": changes})
+
+    def resend_progress(self):
+        """Report the full run status again (after reconnecting)"""
+        if self._reported_run is not None and self.report is not None:
+            self.report({"run": self._reported_run})
+
+    def get_status(self):
+        """Get scheduler status"""
+        return {
+            'programs': len(self.programs),
+            'active': self.run_name,
+            'step': self.run_step if self.run_name is not None else None,
+            'soaking': self.soaking,
+            'window': self.plan_window() if self.run_plan is not None else None,
+            'queued': [entry[0] for entry in self.batch_queue],
+            'next': self.next_fire_name,
+            'next_at': self.next_fire_at
+        }
@@ -0,0 +1,260 @@
+import json
+from config import NUM_VALVES
+from valve_controller import VALVE_NAMES
+
+# Fragments around the valve entries; the timestamp takes at most
+# _TIMESTAMP_WIDTH digits. config.VALVE_REPORT_MAX_BYTES mirrors this layout.
+_PREFIX = b'{"state":{"reported":{"valves":{'
+_MIDDLE = b'},"timestamp":'
+_SUFFIX = b'}}}'
+_TIMESTAMP_WIDTH = 12
+_ON = b'"ON"'
+_OFF = b'"OFF"'
+
+class ShadowEncoder:
+    """Reported-state encoder writing into one preallocated bytearray
+
+    Only the valves in a report are written, back to back after the fixed
+    prefix, so a one-valve report stays short however many valves there
+    are. The buffer is sized for a full report; encode() returns a
+    memoryview of the bytes written, which is all it allocates.
+    """
+
+    def __init__(self):
+        self._keys = [b'"' + name.encode() + b'":' for name in VALVE_NAMES]
+        size = len(_PREFIX) + len(_MIDDLE) + _TIMESTAMP_WIDTH + len(_SUFFIX)
+        for key in self._keys:
+            size += 1 + len(key) + len(_OFF)
+        self.buffer = bytearray(size)
+        self._view = memoryview(self.buffer)
+        self._copy(0, _PREFIX)
+
+    def _copy(self, offset, data):
+        """Write data at offset; returns the offset after it"""
+        buf = self.buffer
+        for i in range(len(data)):
+            buf[offset + i] = data[i]
+        return offset + len(data)
+
+    def _write_int(self, offset, value):
+        """Write a non-negative integer in decimal; returns the offset after it"""
+        buf = self.buffer
+        end = offset + 1
+        rest = value // 10
+        while rest > 0 and end - offset < _TIMESTAMP_WIDTH:
+            rest //= 10
+            end += 1
+        i = end - 1
+        while i >= offset:
+            buf[i] = 0x30 + value % 10  # '0'..'9'
+            value //= 10
+            i -= 1
+        return end
+
+    def encode(self, state_mask, include_mask, timestamp):
+        """Encode the valves selected by include_mask; returns a view of the shared buffer"""
+        offset = len(_PREFIX)
+        first = True
+        for i in range(NUM_VALVES):
+            if not (include_mask >> i) & 1:
+                continue
+            if not first:
+                self.buffer[offset] = 0x2C  # ','
+                offset += 1
+            first = False
+            offset = self._copy(offset, self._keys[i])
+            offset = self._copy(offset, _ON if (state_mask >> i) & 1 else _OFF)
+        offset = self._copy(offset, _MIDDLE)
+        offset = self._write_int(offset, max(0, int(timestamp)))
+        offset = self._copy(offset, _SUFFIX)
+        return self._view[:offset]
+
+
+# --- Selective streaming decode -------------------------------------------
+
+_WHITESPACE = b" \t\r\n"
+_VALUE_END = b",}] \t\r\n"
+
+def _skip_ws(msg, i):
+    while i < len(msg) and msg[i] in _WHITESPACE:
+        i += 1
+    return i
+
+def _skip_string(msg, i):
+    """msg[i] is the opening quote; returns the index after the closing quote"""
+    j = i + 1
+    while True:
+        j = msg.find(b'"', j)
+        if j < 0:
+            raise ValueError("unterminated string")
+        # An odd run of backslashes escapes the quote
+        k = j - 1
+        while msg[k] == 0x5C:
+            k -= 1
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        j += 1
+
+def _skip_value(msg, i):
+    """Return the index just after the JSON value starting at i"""
+    c = msg[i]
+    if c == 0x22:  # '"'
+        return _skip_string(msg, i)
+    if c == 0x7B or c == 0x5B:  # '{' or '['
+        depth = 0
+        n = len(msg)
+        while i < n:
+            c = msg[i]
+            if c == 0x22:
+                i = _skip_string(msg, i)
+                continue
+            if c == 0x7B or c == 0x5B:
+                depth += 1
+            elif c == 0x7D or c == 0x5D:
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+        raise ValueError("unterminated container")
+    while i < len(msg) and msg[i] not in _VALUE_END:
+        i += 1
+    return i
+
+def _members(msg, i):
+    """Iterate (key_start, key_end, value_start) over the object at msg[i]
+
+    The caller must resume iteration with the index after the value, so
+    this is written as a generator that receives it via send().
+    """
+    i = _skip_ws(msg, i)
+    if msg[i] != 0x7B:
+        raise ValueError("object expected")
+    i = _skip_ws(msg, i + 1)
+    if msg[i] == 0x7D:
+        return
+    while True:
+        key_end = _skip_string(msg, i)
+        j = _skip_ws(msg, key_end)
+        if msg[j] != 0x3A:  # ':'
+            raise ValueError("':' expected")
+        value_start = _skip_ws(msg, j + 1)
+        i = yield (i + 1, key_end - 1, value_start)
+        i = _skip_ws(msg, i)
+        if msg[i] == 0x7D:
+            return
+        if msg[i] != 0x2C:
+            raise ValueError("',' expected")
+        i = _skip_ws(msg, i + 1)
+
+def _key_is(msg, start, end, key):
+    return end - start == len(key) and msg.startswith(key, start)
+
+def _parse_int(msg, i):
+    value = 0
+    negative = msg[i] == 0x2D
+    if negative:
+        i += 1
+    while i < len(msg) and 0x30 <= msg[i] <= 0x39:
+        value = value * 10 + msg[i] - 0x30
+        i += 1
+    return -value if negative else value
+
+def _valve_index(msg, start, end):
+    """Index for a "valve_N" key, or -1"""
+    if not msg.startswith(b"valve_", start):
+        return -1
+    n = 0
+    for i in range(start + 6, end):
+        c = msg[i]
+        if not 0x30 <= c <= 0x39:
+            return -1
+        n = n * 10 + c - 0x30
+    return n - 1 if 1 <= n <= NUM_VALVES else -1
+
+def _read_valves(msg, i):
+    """Decode a valves object without building intermediate strings"""
+    valves = {}
+    members = _members(msg, i)
+    try:
+        member = next(members)
+        while True:
+            key_start, key_end, value_start = member
+            index = _valve_index(msg, key_start, key_end)
+            if index >= 0:
+                c = msg[value_start]
+                if msg.startswith(b'"ON"', value_start):
+                    valves[VALVE_NAMES[index]] = "ON"
+                elif msg.startswith(b'"OFF"', value_start):
+                    valves[VALVE_NAMES[index]] = "OFF"
+                elif 0x30 <= c <= 0x39:
+                    valves[VALVE_NAMES[index]] = _parse_int(msg, value_start)
+            member = members.send(_skip_value(msg, value_start))
+    except StopIteration:
+        pass
+    return valves
+
+def extract_desired(msg, path, sections=()):
+    """Pull the version, desired valves and named sections out of a shadow document
+
+    msg is the raw payload, path the keys leading to the desired object (e.g.
+    (b"state", b"desired") for get/accepted, (b"state",) for a delta). Only
+    the valves object and the requested sections are materialized; metadata
+    and everything else is skipped in place.
+    Returns (version or None, {"valves": {...}, section: value, ...}).
+    """
+    version = None
+    desired = {}
+    target = -1
+
+    members = _members(msg, 0)
+    try:
+        member = next(members)
+        while True:
+            key_start, key_end, value_start = member
+            if _key_is(msg, key_start, key_end, b"version"):
+                version = _parse_int(msg, value_start)
+            elif _key_is(msg, key_start, key_end, path[0]):
+                target = value_start
+            member = members.send(_skip_value(msg, value_start))
+    except StopIteration:
+        pass
+
+    # Descend the rest of the path
+    for key in path[1:]:
+        if target < 0:
+            break
+        found = -1
+        members = _members(msg, target)
+        try:
+            member = next(members)
+            while True:
+                key_start, key_end, value_start = member
+                if _key_is(msg, key_start, key_end, key):
+                    found = value_start
+                    members.close()
+                    break
+                member = members.send(_skip_value(msg, value_start))
+        except StopIteration:
+            pass
+        target = found
+
+    if target < 0 or msg[target] != 0x7B:
+        return version, desired
+
+    members = _members(msg, target)
+    try:
+        member = next(members)
+        while True:
+            key_start, key_end, value_start = member
+            value_end = _skip_value(msg, value_start)
+            if _key_is(msg, key_start, key_end, b"valves"):
+                desired["valves"] = _read_valves(msg, value_start)
+            else:
+                for name in sections:
+                    if _key_is(msg, key_start, key_end, name):
+                        desired[name.decode()] = json.loads(msg[value_start:value_end])
+                        break
+            member = members.send(value_end)
+    except StopIteration:
+        pass
+    return version, desired
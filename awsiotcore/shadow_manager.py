@@ -1,109 +1,390 @@
-import json
 import time
+import asyncio
 from config import *
+from valve_controller import VALVE_NAMES, VALVE_INDEX, VALVE_BITS
+from shadow_codec import ShadowEncoder, extract_desired
+from metrics import METRICS
+from boot_profile import BOOT
+from log import LOG
+
+_DELTA_PATH = (b"state",)
+_GET_PATH = (b"state", b"desired")
+
+def _inline(fn, *args):
+    return fn(*args)
+
+def _turns_on(value):
+    """True for "ON" or a positive run time in seconds (local_api rejects the rest too)"""
+    return value == "ON" or (type(value) is int and value > 0)
 
 class ShadowManager:
     def __init__(self, mqtt_client, valve_controller):
         self.mqtt_client = mqtt_client
         self.valve_controller = valve_controller
-        self.shadow_state = {
+        # Valve bitmask last accepted for delivery as reported state
+        self.reported_mask = 0
+        self.reported_timestamp = 0
+        # Version of the last desired document applied (delta or get)
+        self.last_version = 0
+        # Called with each newly accepted version (the journal records it)
+        self.on_version = None
+        # Set when valve state may differ from what was last reported
+        self.report_event = asyncio.Event()
+        # Valves closed by their run timer whose desired value must be reset to OFF
+        self.pending_desired_off = {}
+        # Desired valve values implied by LAN commands, pushed once the cloud link is up
+        self.local_desired = {}
+        # Extra desired sections (e.g. "schedules") -> handler(value) returning the value to report
+        self._sections = {}
+        self._section_keys = ()
+        # execute(fn, *args) runs valve changes where the valves live (the valve core)
+        self.execute = _inline
+        # Reported valve documents are patched in place, not built as dicts
+        self.encoder = ShadowEncoder()
+        # Valve commands coalesced per valve until the window ends (latest value wins)
+        self.pending_valves = {}
+        self.pending_count = 0
+        self.pending_since_ms = 0
+        self.last_command_ms = time.ticks_add(time.ticks_ms(), -COMMAND_COALESCE_MS)
+        # Set when commands are pending; the command task applies them after the window
+        self.command_event = asyncio.Event()
+        self.command_stats = {'queued': 0, 'superseded': 0, 'batches': 0, 'backpressure': 0,
+                              'stale': 0, 'max_depth': 0}
+        
+        # Raw payloads: only the valves and registered sections are decoded
+        self.mqtt_client.register_handler(SHADOW_UPDATE_DELTA_TOPIC, self.handle_delta, parse=False)
+        self.mqtt_client.register_handler(SHADOW_GET_ACCEPTED_TOPIC, self.handle_get_accepted, parse=False)
+        
+    def update_reported_state(self, valve_states):
+        """Publish the full reported valve state to the device shadow"""
+        timestamp = time.time()
+        mask = self.valve_controller.mask_from_states(valve_states)
+        every_valve = (1 << self.valve_controller.num_valves) - 1
+        payload = self.encoder.encode(mask, every_valve, timestamp)
+        
+        success = self.mqtt_client.publish(SHADOW_UPDATE_TOPIC, payload, covers=every_valve)
+        if success:
+            self.reported_mask = mask
+            self.reported_timestamp = timestamp
+            LOG.debug("Shadow reported state updated")
+        return success
+    
+    def get_shadow_state(self):
+        """Request current shadow state from AWS"""
+        empty_message = {}
+        success = self.mqtt_client.publish(SHADOW_GET_TOPIC, empty_message, queue=False)
+        if success:
+            LOG.debug("Requested shadow state")
+        return success
+    
+    def report_valve_changes(self, changed_valves):
+        """Report only the valves that changed; the shadow merges them"""
+        touched = 0
+        for valve_name in changed_valves:
+            if valve_name in VALVE_INDEX:
+                touched |= VALVE_BITS[VALVE_INDEX[valve_name]]
+        return self._report_mask(self.valve_controller.mask_from_states(changed_valves), touched)
+    
+    def _report_mask(self, on_mask, touched):
+        """Publish the valves in touched with their bits from on_mask"""
+        timestamp = time.time()
+        payload = self.encoder.encode(on_mask, touched, timestamp)
+        
+        # A queued report for a subset of these valves is superseded by this one
+        success = self.mqtt_client.publish(SHADOW_UPDATE_TOPIC, payload, covers=touched)
+        if success:
+            self.reported_mask = (self.reported_mask & ~touched) | (on_mask & touched)
+            self.reported_timestamp = timestamp
+            if METRICS:
+                METRICS.reported()
+            LOG.debug("Shadow reported valve changes")
+        return success
+    
+    def register_desired_section(self, name, handler):
+        """Route a top-level desired key to handler(value)"""
+        self._sections[name] = handler
+        self._section_keys = tuple(key.encode() for key in self._sections)
+    
+    def report_fields(self, fields):
+        """Publish arbitrary top-level reported fields (e.g. accepted schedules)"""
+        shadow_update = {
+            "state": {
+                "reported": fields
+            }
+        }
+        return self.mqtt_client.publish(SHADOW_UPDATE_TOPIC, shadow_update)
+    
+    def report_expired(self, valve_names):
+        """Report valves closed by their run timer and clear their desired ON"""
+        timestamp = time.time()
+        for valve_name in valve_names:
+            self.pending_desired_off[valve_name] = timestamp
+        self.request_report()
+        if self.mqtt_client.is_connected():
+            self._publish_desired_off()
+    
+    def _publish_desired_off(self):
+        """Reset desired ON for expired valves so a later shadow get cannot reopen them"""
+        if not self.pending_desired_off:
+            return True
+        shadow_update = {
             "state": {
-                "reported": {
-                    "valves": {f"valve_{i+1}": "OFF" for i in range(NUM_VALVES)},
-                    "timestamp": 0
-                },
                 "desired": {
-                    "valves": {f"valve_{i+1}": "OFF" for i in range(NUM_VALVES)}
+                    "valves": {name: "OFF" for name in self.pending_desired_off}
+                },
+                "reported": {
+                    "expired": self.pending_desired_off
                 }
             }
         }
+        # Not queued: on reconnect sync_with_shadow sends it before the shadow get
+        success = self.mqtt_client.publish(SHADOW_UPDATE_TOPIC, shadow_update, queue=False)
+        if success:
+            LOG.info("Reported run timer expiry: %s", list(self.pending_desired_off))
+            self.pending_desired_off = {}
+        return success
+    
+    def apply_local(self, desired_valves):
+        """Apply a LAN valve command as if it were a desired document
+
+        The desired values it implies (including valves it closed implicitly)
+        are published as desired state, so a later delta or shadow get does
+        not undo the command. With one valve ON at a time, every other valve
+        is set desired OFF too, since a desired ON left in the cloud would
+        otherwise replace the valve this command opened.
+        """
+        valves = self.valve_controller
+        before = valves.get_state_mask()
+        # Queued cloud commands are older than this one
+        self.apply_pending()
+        self._apply_desired_valves(desired_valves)
+        after = valves.get_state_mask()
         
-    def update_reported_state(self, valve_states):
-        """Update reported state in device shadow"""
-        self.shadow_state["state"]["reported"]["valves"] = valve_states
-        self.shadow_state["state"]["reported"]["timestamp"] = time.time()
+        for valve_name, desired_value in desired_valves.items():
+            if valve_name in VALVE_INDEX:
+                self.local_desired[valve_name] = desired_value
+        changed = before ^ after
+        exclusive = after and not valves.concurrent
+        for i in range(valves.num_valves):
+            if after & VALVE_BITS[i]:
+                continue
+            if changed & VALVE_BITS[i] or (exclusive and VALVE_NAMES[i] not in desired_valves):
+                self.local_desired[VALVE_NAMES[i]] = "OFF"
         
+        if self.mqtt_client.is_connected():
+            self._publish_local_desired()
+        return changed
+    
+    def _publish_local_desired(self):
+        """Push desired values set over the LAN to the shadow"""
+        if not self.local_desired:
+            return True
         shadow_update = {
             "state": {
-                "reported": self.shadow_state["state"]["reported"]
+                "desired": {
+                    "valves": self.local_desired
+                }
             }
         }
-        
-        success = self.mqtt_client.publish(SHADOW_UPDATE_TOPIC, shadow_update)
+        # Not queued: on reconnect sync_with_shadow sends it before the shadow get
+        success = self.mqtt_client.publish(SHADOW_UPDATE_TOPIC, shadow_update, queue=False)
         if success:
-            print("Shadow reported state updated")
+            LOG.info("Reconciled local valve commands: %s", dict(self.local_desired))
+            self.local_desired = {}
         return success
     
-    def get_shadow_state(self):
-        """Request current shadow state from AWS"""
-        empty_message = {}
-        success = self.mqtt_client.publish(SHADOW_GET_TOPIC, empty_message)
-        if success:
-            print("Requested shadow state")
-        return success
+    def request_report(self):
+        """Mark reported state dirty; the report task flushes it after the coalesce window"""
+        self.report_event.set()
+    
+    def get_unreported_changes(self):
+        """Valves whose current state differs from the last successful report"""
+        diff = self.valve_controller.get_state_mask() ^ self.reported_mask
+        if not diff:
+            return {}
+        return self.valve_controller.states_from_mask(self.valve_controller.get_state_mask(), diff)
+    
+    def flush_reported(self):
+        """Publish pending valve changes, if any; unsent changes stay dirty"""
+        mask = self.valve_controller.get_state_mask()
+        if mask == self.reported_mask:
+            return True
+        return self._report_mask(mask, mask ^ self.reported_mask)
+    
+    def _accept_version(self, version):
+        """Drop shadow documents older than the last one applied"""
+        if version is None:
+            return True
+        if version <= self.last_version:
+            self.command_stats['stale'] += 1
+            LOG.info("Ignoring stale shadow version %d (have %d)", version, self.last_version)
+            return False
+        self.last_version = version
+        if self.on_version:
+            self.on_version(version)
+        return True
     
     def handle_desired_state_change(self, desired_state):
-        """Handle desired state changes from shadow"""
+        """Apply desired sections, then only the valves whose desired value differs"""
+        reported = {}
+        for name, handler in self._sections.items():
+            if name in desired_state:
+                value = handler(desired_state[name])
+                if value:
+                    reported[name] = value
+        if reported:
+            self.report_fields(reported)
+        
         if "valves" not in desired_state:
             return
-            
-        desired_valves = desired_state["valves"]
-        current_valves = self.valve_controller.get_valve_states()
+        self.queue_valves(desired_state["valves"])
+    
+    def queue_valves(self, desired_valves):
+        """Apply a valve command now if commands were idle, else coalesce it into the pending batch
+
+        The first command after COMMAND_COALESCE_MS of quiet is applied at
+        once. Later ones are merged per valve (latest value wins) and applied
+        together when the window opened by the first of them ends. Unless
+        zones run concurrently only a message's first ON counts, as in
+        _apply_valves, and it replaces ONs pending from earlier messages. A batch
+        that reaches COMMAND_QUEUE_MAX commands is applied immediately, in
+        the MQTT reader, which holds off further reads until it is done.
+        """
+        now = time.ticks_ms()
+        idle = time.ticks_diff(now, self.last_command_ms) >= COMMAND_COALESCE_MS
+        self.last_command_ms = now
+        if idle and not self.pending_count:
+            self.command_stats['batches'] += 1
+            self._apply_desired_valves(desired_valves)
+            return
         
-        # Check for changes
-        changes_needed = False
-        for valve_name, desired_value in desired_valves.items():
-            if valve_name in current_valves:
-                if current_valves[valve_name] != desired_value:
-                    changes_needed = True
+        stats = self.command_stats
+        pending = self.pending_valves
+        if not self.pending_count:
+            self.pending_since_ms = now
+        first_on = None
+        if not self.valve_controller.concurrent:
+            for valve_name, desired_value in desired_valves.items():
+                if valve_name in VALVE_INDEX and _turns_on(desired_value):
+                    first_on = valve_name
                     break
+        superseded = False
+        for valve_name, desired_value in desired_valves.items():
+            if valve_name not in VALVE_INDEX:
+                continue
+            if first_on is not None and valve_name != first_on and _turns_on(desired_value):
+                continue
+            if valve_name in pending:
+                superseded = True
+            pending[valve_name] = desired_value
+        if first_on is not None:
+            # Only one valve can be ON: this ON supersedes those pending from earlier messages
+            for other in [name for name, value in pending.items()
+                          if name != first_on and _turns_on(value)]:
+                del pending[other]
+                superseded = True
+        # Counted once per message that overrode an earlier one
+        if superseded:
+            stats['superseded'] += 1
+        self.pending_count += 1
+        stats['queued'] += 1
+        if self.pending_count > stats['max_depth']:
+            stats['max_depth'] = self.pending_count
         
-        if not changes_needed:
-            print("No valve state changes needed")
+        if self.pending_count >= COMMAND_QUEUE_MAX:
+            stats['backpressure'] += 1
+            self.apply_pending()
+        else:
+            self.command_event.set()
+    
+    def ms_until_apply(self):
+        """Milliseconds until the pending batch's window ends"""
+        if not self.pending_count:
+            return 0
+        left = COMMAND_COALESCE_MS - time.ticks_diff(time.ticks_ms(), self.pending_since_ms)
+        return left if left > 0 else 0
+    
+    def apply_pending(self):
+        """Apply the coalesced valve commands as one change"""
+        if not self.pending_count:
+            return
+        desired_valves = self.pending_valves
+        self.pending_valves = {}
+        self.pending_count = 0
+        self.command_stats['batches'] += 1
+        self._apply_desired_valves(desired_valves)
+    
+    def _apply_desired_valves(self, desired_valves):
+        """Switch the valves and mark the change for the coalesced report"""
+        valves = self.valve_controller
+        changed = self.execute(self._apply_valves, desired_valves)
+        if not changed:
+            LOG.debug("No valve state changes needed")
             return
         
-        # Apply changes
-        print(f"Applying desired valve states: {desired_valves}")
+        mask = valves.get_state_mask()
+        for valve_name in desired_valves:
+            if valve_name in VALVE_INDEX and changed & mask & VALVE_BITS[VALVE_INDEX[valve_name]]:
+                self.pending_desired_off.pop(valve_name, None)
+                LOG.debug("Turned ON %s", valve_name)
+        LOG.info("Applied valve changes: mask %#x, changed %#x", mask, changed)
+        self.request_report()
+    
+    def _apply_valves(self, desired_valves):
+        """Switch valves to their desired values; returns the mask of valves changed"""
+        valves = self.valve_controller
+        before = valves.get_state_mask()
         
-        # Turn off all valves first
-        for i in range(NUM_VALVES):
-            self.valve_controller.set_valve(i, False)
+        # Unless zones run concurrently only one valve can be ON: the first ON
+        # entry wins. An integer value means ON for that many seconds.
+        turn_on = []
+        for valve_name, desired_value in desired_valves.items():
+            if _turns_on(desired_value) and valve_name in VALVE_INDEX:
+                turn_on.append(valve_name)
+                if not valves.concurrent:
+                    break
         
-        # Turn on the desired valve (only one can be ON)
-        valve_turned_on = False
+        # Switch OFF first so two valves are never open together (and the budget is freed)
         for valve_name, desired_value in desired_valves.items():
-            if desired_value == "ON" and not valve_turned_on:
-                valve_number = int(valve_name.split('_')[1]) - 1  # valve_1 -> 0
-                if 0 <= valve_number < NUM_VALVES:
-                    self.valve_controller.set_valve(valve_number, True)
-                    valve_turned_on = True
-                    print(f"Turned ON {valve_name}")
+            if desired_value == "OFF" and valve_name in VALVE_INDEX:
+                bit = VALVE_BITS[VALVE_INDEX[valve_name]]
+                if (before | valves.deferred_mask) & bit:
+                    valves.set_valve(VALVE_INDEX[valve_name], False)
         
-        # Update reported state
-        new_valve_states = self.valve_controller.get_valve_states()
-        self.update_reported_state(new_valve_states)
-    
-    def process_shadow_message(self, topic, message):
-        """Process shadow-related MQTT messages"""
-        try:
-            if topic == SHADOW_GET_ACCEPTED_TOPIC:
-                if "state" in message and "desired" in message["state"]:
-                    self.handle_desired_state_change(message["state"]["desired"])
-                    
-            elif topic == SHADOW_UPDATE_ACCEPTED_TOPIC:
-                print("Shadow update accepted")
-                
-            elif topic == SHADOW_UPDATE_REJECTED_TOPIC:
-                print(f"Shadow update rejected: {message}")
-                
-        except Exception as e:
-            print(f"Error processing shadow message: {e}")
+        for valve_name in turn_on:
+            if not (before | valves.deferred_mask) & VALVE_BITS[VALVE_INDEX[valve_name]]:
+                duration = desired_valves[valve_name]
+                valves.set_valve(VALVE_INDEX[valve_name], True, duration if type(duration) is int else None)
+        
+        return before ^ valves.get_state_mask()
+    
+    def handle_delta(self, msg):
+        """Handle a shadow/update/delta document pushed by AWS"""
+        version, desired = extract_desired(msg, _DELTA_PATH, self._section_keys)
+        if not self._accept_version(version):
+            return
+        if desired:
+            self.handle_desired_state_change(desired)
+            BOOT.mark("first_command")
+    
+    def handle_get_accepted(self, msg):
+        """Handle the full shadow document returned by shadow/get"""
+        version, desired = extract_desired(msg, _GET_PATH, self._section_keys)
+        if self._accept_version(version) and desired:
+            self.handle_desired_state_change(desired)
+        if not BOOT.reported:
+            # The device now acts on the cloud's state: boot is complete
+            BOOT.mark("ready")
+            BOOT.reported = True
+            self.report_fields({"boot": BOOT.summary()})
     
     def sync_with_shadow(self):
         """Sync current device state with shadow"""
         # Update reported state
         current_valves = self.valve_controller.get_valve_states()
         self.update_reported_state(current_valves)
+        self._publish_desired_off()
+        self._publish_local_desired()
         
         # Get desired state
         self.get_shadow_state()
\ No newline at end of file
@@ -0,0 +1,4 @@
+"""
+Host simulation backends for running the controller under CPython
+Usage (from awsiotcore/): python -m sim.run
+"""
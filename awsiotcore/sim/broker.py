@@ -0,0 +1,115 @@
+"""
+In-process MQTT broker stand-in that mimics the AWS IoT Device Shadow topics
+"""
+
+import json
+
+
+def _merge(target, changes):
+    """Shadow merge semantics: nested objects merge, None deletes a key"""
+    for key, value in changes.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif isinstance(value, dict):
+            target[key] = {}
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+def _delta(desired, reported):
+    """Desired fields that differ from reported (recursively)"""
+    delta = {}
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(reported.get(key), dict):
+            sub = _delta(value, reported[key])
+            if sub:
+                delta[key] = sub
+        elif reported.get(key) != value:
+            delta[key] = value
+    return delta
+
+
+class SimBroker:
+    def __init__(self):
+        self.clients = []
+        self.shadows = {}  # thing name -> {"desired", "reported", "version"}
+        self.published = []  # (topic, payload) from devices, for inspection
+        self.pings = 0
+        self.online = True
+
+    def attach(self, client):
+        if client not in self.clients:
+            self.clients.append(client)
+
+    def detach(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def _shadow(self, thing):
+        if thing not in self.shadows:
+            self.shadows[thing] = {"desired": {}, "reported": {}, "version": 0}
+        return self.shadows[thing]
+
+    def deliver(self, topic, payload):
+        """Send a message to every client subscribed to topic"""
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        for client in self.clients:
+            if topic in client.subscriptions:
+                client.notify(topic, payload)
+
+    def publish(self, topic, payload):
+        """Handle a publish from a client"""
+        if isinstance(topic, bytes):
+            topic = topic.decode()
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = bytes(payload).decode()
+        self.published.append((topic, payload))
+
+        if topic.startswith("$aws/things/") and "/shadow/" in topic:
+            thing = topic.split("/")[2]
+            action = topic.split("/shadow/")[1]
+            if action == "update":
+                self.update_shadow(thing, json.loads(payload) if payload else {})
+            elif action == "get":
+                self._get_shadow(thing)
+            return
+        self.deliver(topic, payload)
+
+    def update_shadow(self, thing, document):
+        """Apply a shadow update the way AWS does (also used by the 'cloud' side)"""
+        shadow = self._shadow(thing)
+        prefix = f"$aws/things/{thing}/shadow/update"
+        state = document.get("state", {})
+        if "desired" in state:
+            _merge(shadow["desired"], state["desired"] or {})
+        if "reported" in state:
+            _merge(shadow["reported"], state["reported"] or {})
+        shadow["version"] += 1
+        version = shadow["version"]
+
+        self.deliver(prefix + "/accepted", json.dumps({"state": state, "version": version}))
+        delta = _delta(shadow["desired"], shadow["reported"])
+        if "desired" in state and delta:
+            self.deliver(prefix + "/delta", json.dumps({"state": delta, "version": version}))
+        return version
+
+    def _get_shadow(self, thing):
+        shadow = self._shadow(thing)
+        document = {
+            "state": {"desired": shadow["desired"], "reported": shadow["reported"]},
+            "version": shadow["version"]
+        }
+        delta = _delta(shadow["desired"], shadow["reported"])
+        if delta:
+            document["state"]["delta"] = delta
+        self.deliver(f"$aws/things/{thing}/shadow/get/accepted", json.dumps(document))
+
+
+# Default broker used by sim.umqtt.simple.MQTTClient
+BROKER = SimBroker()
@@ -0,0 +1,158 @@
+"""
+Installs the simulated hardware/network backends in place of the
+MicroPython modules, so the firmware modules import them unchanged
+"""
+
+import sys
+import os
+import gc
+import time
+import asyncio
+import ssl
+import threading
+
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+SIM_HEAP_BYTES = 8 * 1024 * 1024  # Host objects are far larger than on MicroPython
+
+_start = time.monotonic_ns()
+
+# Stands in for machine.disable_irq(): timer "IRQs" run on threads and take this lock
+irq_lock = threading.RLock()
+
+
+def ticks_ms():
+    return ((time.monotonic_ns() - _start) // 1000000) & TICKS_MAX
+
+
+def ticks_us():
+    return ((time.monotonic_ns() - _start) // 1000) & TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(end, start):
+    diff = (end - start) & TICKS_MAX
+    return diff - TICKS_PERIOD if diff >= TICKS_HALFPERIOD else diff
+
+
+def mem_alloc():
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+
+class SimSSLContext:
+    """Accepts the calls AWSIoTClient makes; the simulated broker has no TLS"""
+
+    def __init__(self, protocol=None):
+        self.check_hostname = False
+        self.verify_mode = None
+
+    def load_cert_chain(self, certfile, keyfile=None):
+        pass
+
+    def load_verify_locations(self, cafile=None, capath=None, cadata=None):
+        pass
+
+    def wrap_socket(self, sock, server_side=False, server_hostname=None):
+        return sock
+
+
+class ThreadSafeFlag:
+    """asyncio.ThreadSafeFlag for CPython: set() may be called from any thread"""
+
+    def __init__(self):
+        self._loop = None
+        self._event = None
+        self._pending = False
+
+    def set(self):
+        loop = self._loop
+        if loop is None:
+            self._pending = True
+        else:
+            loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self):
+        if self._loop is None:
+            self._event = asyncio.Event()
+            if self._pending:
+                self._event.set()
+            self._loop = asyncio.get_running_loop()
+        await self._event.wait()
+        self._event.clear()
+
+
+_installed = False
+_host_time = time.time
+_host_time_ns = time.time_ns
+
+# Loopback SNTP responders started by install()
+NTP_SERVERS = []
+
+
+def install(workdir=None):
+    """Register the sim modules and MicroPython-only helpers; point flash paths at workdir"""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_us
+    time.ticks_add = ticks_add
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    # The RTC offset set through machine.RTC().datetime() moves wall-clock time
+    time.time = lambda: _host_time() + machine.RTC._offset
+    time.time_ns = lambda: _host_time_ns() + int(machine.RTC._offset * 1000000000)
+    asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    asyncio.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms / 1000)
+    asyncio.ThreadSafeFlag = ThreadSafeFlag
+
+    gc.mem_alloc = mem_alloc
+    gc.mem_free = lambda: SIM_HEAP_BYTES - mem_alloc()
+    gc.threshold = lambda *args: -1
+
+    ssl.SSLContext = SimSSLContext
+    if not hasattr(ssl, "PROTOCOL_TLS_CLIENT"):
+        ssl.PROTOCOL_TLS_CLIENT = 16
+
+    from sim import machine, network
+    from sim.umqtt import simple
+    import sim.umqtt as umqtt
+    sys.modules["machine"] = machine
+    sys.modules["network"] = network
+    sys.modules["umqtt"] = umqtt
+    sys.modules["umqtt.simple"] = simple
+
+    import config
+    from sim import ntpd
+    NTP_SERVERS.extend(ntpd.start())
+    config.NTP_SERVERS = [server.address[0] for server in NTP_SERVERS]
+    config.NTP_PORT = NTP_SERVERS[0].address[1]
+
+    if workdir is not None:
+        os.makedirs(workdir, exist_ok=True)
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        config.DEVICE_CERT_PATH = os.path.join(here, "certs", "device-certificate.pem.crt")
+        config.DEVICE_KEY_PATH = os.path.join(here, "certs", "device-private.pem.key")
+        config.ROOT_CA_PATH = os.path.join(here, "certs", "amazon-root-ca-1.pem")
+        # Keep DER caches and flash files out of the source tree
+        for name in ("DEVICE_CERT_PATH", "DEVICE_KEY_PATH", "ROOT_CA_PATH"):
+            path = getattr(config, name)
+            copy = os.path.join(workdir, os.path.basename(path))
+            with open(path, "rb") as src, open(copy, "wb") as dst:
+                dst.write(src.read())
+            setattr(config, name, copy)
+        for name in dir(config):
+            if name.endswith("_PATH") and not name.startswith(("DEVICE_", "ROOT_")):
+                setattr(config, name, os.path.join(workdir, os.path.basename(getattr(config, name))))
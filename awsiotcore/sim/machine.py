@@ -0,0 +1,178 @@
+"""
+Simulated machine module: Pin, Timer, RTC, SPI and the reset/sleep/IRQ helpers
+"""
+
+import time
+import threading
+from sim import hal
+
+
+class Pin:
+    OUT = 1
+    IN = 0
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 4
+    IRQ_FALLING = 8
+
+    # pin id -> Pin, so a scenario can inspect outputs by GPIO number
+    registry = {}
+    # Called as on_change(pin, value, ticks_us) on every output transition
+    on_change = None
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self._value = 0 if value is None else value
+        self.changed_us = 0
+        self.transitions = 0
+        self._irq_handler = None
+        self._irq_trigger = 0
+        Pin.registry[id] = self
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        value = 1 if value else 0
+        if value != self._value:
+            old = self._value
+            self._value = value
+            self.changed_us = hal.ticks_us()
+            self.transitions += 1
+            if Pin.on_change:
+                Pin.on_change(self, value, self.changed_us)
+            self._fire_irq(old, value)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING, hard=False):
+        self._irq_handler = handler
+        self._irq_trigger = trigger
+
+    def _fire_irq(self, old, new):
+        if self._irq_handler is None:
+            return
+        if (new and self._irq_trigger & Pin.IRQ_RISING) or (not new and self._irq_trigger & Pin.IRQ_FALLING):
+            self._irq_handler(self)
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self._thread_timer = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, freq=-1, hard=False):
+        self.deinit()
+        if freq > 0:
+            period = 1000 / freq
+        self._mode = mode
+        self._period = period
+        self._callback = callback
+        self._schedule()
+
+    def _schedule(self):
+        self._thread_timer = threading.Timer(self._period / 1000, self._fire)
+        self._thread_timer.daemon = True
+        self._thread_timer.start()
+
+    def _fire(self):
+        # Timer callbacks behave like IRQs: they respect disable_irq()
+        with hal.irq_lock:
+            if self._thread_timer is None:
+                return
+            if self._mode == Timer.PERIODIC:
+                self._schedule()
+            else:
+                self._thread_timer = None
+            if self._callback:
+                self._callback(self)
+
+    def deinit(self):
+        if self._thread_timer is not None:
+            self._thread_timer.cancel()
+            self._thread_timer = None
+
+
+class RTC:
+    # Offset in seconds applied to the host clock; shared like the real RTC
+    _offset = 0
+
+    def datetime(self, datetimetuple=None):
+        if datetimetuple is None:
+            t = time.gmtime(hal._host_time() + RTC._offset)
+            return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+        year, month, day, weekday, hour, minute, second, subseconds = datetimetuple
+        target = time.mktime((year, month, day, hour, minute, second, 0, 0, 0)) - time.timezone
+        RTC._offset = target - hal._host_time()
+
+
+class SPI:
+    def __init__(self, id, baudrate=1000000, **kwargs):
+        self.id = id
+        self.baudrate = baudrate
+        self.last_write = b""
+
+    def write(self, buf):
+        self.last_write = bytes(buf)
+
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+        self.level = 0
+
+    def read_u16(self):
+        return self.level
+
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+
+    def feed(self):
+        pass
+
+
+def disable_irq():
+    hal.irq_lock.acquire()
+    return 1
+
+
+def enable_irq(state=1):
+    hal.irq_lock.release()
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def soft_reset():
+    raise SystemExit("machine.soft_reset()")
+
+
+def lightsleep(time_ms=None):
+    time.sleep((time_ms or 0) / 1000)
+
+
+def idle():
+    time.sleep(0)
+
+
+def unique_id():
+    return b"\x53\x49\x4d\x00\x00\x01"
+
+
+def freq(hz=None):
+    return 150000000
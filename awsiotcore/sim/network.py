@@ -0,0 +1,77 @@
+"""
+Simulated network module: a station WLAN that associates after a short delay
+"""
+
+import time
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    PM_NONE = 0x10
+    PM_PERFORMANCE = 0xA11142
+    PM_POWERSAVE = 0xA11C82
+
+    # Seconds between connect() and isconnected() becoming True
+    connect_delay = 0.3
+    # Set False to make association fail (e.g. AP out of range)
+    reachable = True
+
+    _instances = {}
+
+    def __new__(cls, interface=STA_IF):
+        # Like MicroPython, WLAN(STA_IF) always returns the same interface
+        if interface not in cls._instances:
+            instance = super().__new__(cls)
+            instance._active = False
+            instance._connect_at = None
+            instance._config = {"pm": WLAN.PM_PERFORMANCE}
+            cls._instances[interface] = instance
+        return cls._instances[interface]
+
+    def __init__(self, interface=STA_IF):
+        pass
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+        if not self._active:
+            self._connect_at = None
+
+    def connect(self, ssid=None, key=None):
+        self._active = True
+        self._connect_at = time.monotonic() + WLAN.connect_delay
+
+    def disconnect(self):
+        self._connect_at = None
+
+    def drop(self):
+        """Simulate losing the access point"""
+        self._connect_at = None
+
+    def isconnected(self):
+        return WLAN.reachable and self._connect_at is not None and time.monotonic() >= self._connect_at
+
+    def status(self, param=None):
+        if param == "rssi":
+            return -55
+        if self.isconnected():
+            return STAT_GOT_IP
+        return STAT_CONNECTING if self._connect_at is not None else STAT_IDLE
+
+    def ifconfig(self, config=None):
+        return ("192.168.1.50", "255.255.255.0", "192.168.1.1", "192.168.1.1")
+
+    def config(self, *args, **kwargs):
+        if kwargs:
+            self._config.update(kwargs)
+            return None
+        if args:
+            return self._config.get(args[0])
+        return None
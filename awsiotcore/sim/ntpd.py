@@ -0,0 +1,56 @@
+"""
+Loopback SNTP responders standing in for the NTP pool, with per-server
+delay and clock error so TimeSync's server selection and slewing can be
+exercised on a host
+"""
+
+import time
+import socket
+import struct
+import threading
+from sim import hal
+
+NTP_DELTA = 2208988800
+
+
+class SimNTPServer:
+    def __init__(self, address, port=0, delay=0.0, error_ms=0):
+        self.delay = delay          # Seconds before replying (half of it counts as network RTT)
+        self.error_ms = error_ms    # How far this server's clock is off
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.address = self.sock.getsockname()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    @staticmethod
+    def _timestamp(seconds):
+        seconds += NTP_DELTA
+        whole = int(seconds)
+        return whole, int((seconds - whole) * (1 << 32)) & 0xFFFFFFFF
+
+    def _serve(self):
+        while True:
+            data, client = self.sock.recvfrom(64)
+            self.requests += 1
+            time.sleep(self.delay / 2)
+            received = hal._host_time() + self.error_ms / 1000
+            reply = bytearray(48)
+            reply[0] = 0x24  # LI 0, version 4, mode 4 (server)
+            reply[1] = 2     # Stratum
+            reply[24:32] = data[40:48]  # Originate = client's transmit timestamp
+            struct.pack_into("!II", reply, 32, *self._timestamp(received))
+            struct.pack_into("!II", reply, 40, *self._timestamp(hal._host_time() + self.error_ms / 1000))
+            time.sleep(self.delay / 2)
+            self.sock.sendto(reply, client)
+
+
+def start(delays=(0.04, 0.01, 0.08)):
+    """Start one responder per loopback address; returns the servers"""
+    port = 0
+    servers = []
+    for i, delay in enumerate(delays):
+        server = SimNTPServer(f"127.0.0.{i + 1}", port, delay)
+        port = server.address[1]
+        servers.append(server)
+    return servers
@@ -0,0 +1,111 @@
+"""
+Run IrrigationController end to end under CPython against the simulated
+hardware and shadow broker, and measure command-to-GPIO latency and
+memory per message
+
+Usage (from awsiotcore/): python -m sim.run [--commands N] [--workdir DIR]
+"""
+
+import sys
+import asyncio
+import tempfile
+import tracemalloc
+import argparse
+
+from sim import hal
+
+
+async def _wait_for(predicate, timeout_s):
+    """Yield to the controller's tasks until predicate() holds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_s
+    while not predicate():
+        if loop.time() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+async def scenario(controller, commands):
+    from sim import broker
+    from sim.machine import Pin
+    from config import DEVICE_ID, NUM_VALVES, VALVE_PINS, VALVE_DRIVER, COMMAND_COALESCE_MS
+
+    task = asyncio.create_task(controller.run_async())
+    if not await _wait_for(controller.mqtt_client.is_connected, 10):
+        print("SIM: controller never connected")
+        return 1
+    # Let the initial shadow sync settle
+    await asyncio.sleep(0.2)
+
+    latencies_us = []
+    peaks = []
+    for n in range(commands):
+        valve = n % NUM_VALVES
+        pin = Pin.registry[VALVE_PINS[valve]] if VALVE_DRIVER == "gpio" else None
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        sent_us = hal.ticks_us()
+        # Like a dashboard: switch the previous valve OFF and this one ON
+        desired = {f"valve_{i + 1}": "OFF" for i in range(NUM_VALVES)}
+        desired[f"valve_{valve + 1}"] = "ON"
+        broker.BROKER.update_shadow(DEVICE_ID, {"state": {"desired": {"valves": desired}}})
+
+        if pin is not None:
+            done = await _wait_for(lambda: pin.value() == 1, 5)
+            changed_us = pin.changed_us
+        else:
+            done = await _wait_for(lambda: controller.valve_controller.is_on(valve), 5)
+            changed_us = hal.ticks_us()
+        if not done:
+            print(f"SIM: valve {valve + 1} did not open")
+            continue
+        latencies_us.append(hal.ticks_diff(changed_us, sent_us))
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        # Commands closer together than this are coalesced; measure single commands
+        await asyncio.sleep(COMMAND_COALESCE_MS / 1000)
+
+    controller.running = False
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    if latencies_us:
+        latencies_us.sort()
+        print("SIM: commands={} latency_us min={} p50={} max={}".format(
+            len(latencies_us), latencies_us[0], latencies_us[len(latencies_us) // 2], latencies_us[-1]))
+        print("SIM: peak bytes allocated per command avg={} max={}".format(
+            sum(peaks) // len(peaks), max(peaks)))
+    print(f"SIM: device publishes={len(broker.BROKER.published)}")
+    from boot_profile import BOOT
+    print(f"SIM: boot stages (ms) {BOOT.summary()}")
+    from metrics import METRICS
+    if METRICS:
+        print(f"SIM: firmware metrics {METRICS.summary()}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the irrigation controller against simulated hardware")
+    parser.add_argument("--commands", type=int, default=20, help="desired-state commands to send")
+    parser.add_argument("--workdir", default=None, help="directory standing in for the device flash")
+    parser.add_argument("--metrics", action="store_true", help="enable firmware metrics and print their summary")
+    args = parser.parse_args(argv)
+
+    hal.install(args.workdir or tempfile.mkdtemp(prefix="pico_irrigation_"))
+    if args.metrics:
+        import config
+        config.METRICS_ENABLED = True
+    tracemalloc.start()
+
+    import main as firmware
+    controller = firmware.IrrigationController()
+    if not controller.setup():
+        return 1
+    return asyncio.run(scenario(controller, args.commands))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
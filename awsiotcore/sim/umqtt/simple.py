@@ -0,0 +1,99 @@
+"""
+Simulated umqtt.simple: same client API, backed by the in-process SimBroker
+"""
+
+import time
+import socket
+from sim import broker as _broker
+
+
+class MQTTException(Exception):
+    pass
+
+
+class MQTTClient:
+    # Seconds connect() blocks, standing in for the TLS handshake
+    connect_delay = 0.05
+
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
+                 ssl=None, ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.ssl = ssl
+        self.cb = None
+        self.sock = None
+        # The broker writes one byte per queued message to the far end, so
+        # sock polls readable exactly like a TLS socket with data pending
+        self._remote = None
+        self.subscriptions = set()
+        self.inbox = []
+        self.broker = _broker.BROKER
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        pass
+
+    def _check_link(self):
+        if self.sock is None or not self.broker.online:
+            raise OSError(104, "ECONNRESET")
+
+    def connect(self, clean_session=True):
+        time.sleep(MQTTClient.connect_delay)
+        if not self.broker.online:
+            raise OSError(113, "EHOSTUNREACH")
+        self._close_sockets()
+        self.sock, self._remote = socket.socketpair()
+        self.sock.setblocking(False)
+        if clean_session:
+            self.subscriptions = set()
+            self.inbox = []
+        self.broker.attach(self)
+        return False
+
+    def _close_sockets(self):
+        for sock in (self.sock, self._remote):
+            if sock is not None:
+                sock.close()
+        self.sock = self._remote = None
+
+    def notify(self, topic, msg):
+        """Called by the broker to queue an inbound message"""
+        self.inbox.append((topic, msg))
+        self._remote.send(b"\x00")
+
+    def disconnect(self):
+        self.broker.detach(self)
+        self._close_sockets()
+
+    def ping(self):
+        self._check_link()
+        self.broker.pings += 1
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check_link()
+        self.broker.publish(topic, msg)
+
+    def subscribe(self, topic, qos=0):
+        self._check_link()
+        if isinstance(topic, str):
+            topic = topic.encode()
+        self.subscriptions.add(topic)
+
+    def wait_msg(self):
+        self._check_link()
+        try:
+            self.sock.recv(1)
+        except BlockingIOError:
+            pass
+        if not self.inbox:
+            return None
+        topic, msg = self.inbox.pop(0)
+        self.cb(topic, msg)
+        return None
+
+    def check_msg(self):
+        return self.wait_msg()
@@ -1,80 +1,239 @@
-import ntptime
+import socket
+import struct
 import time
+import asyncio
 import machine
-from config import NTP_SERVER, TIME_SYNC_INTERVAL_HOURS
+from config import (
+    NTP_SERVERS, NTP_PORT, NTP_TIMEOUT_MS, TIME_SYNC_INTERVAL_HOURS, MIN_VALID_YEAR,
+    NTP_MIN_INTERVAL_SECONDS, NTP_MAX_INTERVAL_SECONDS, NTP_TARGET_ERROR_MS,
+    NTP_STEP_THRESHOLD_MS, NTP_SLEW_RATE_PPM, NTP_MAX_DRIFT_PPM
+)
+
+NTP_DELTA = 2208988800  # Seconds from the NTP epoch (1900) to the Unix epoch
+NTP_PACKET_SIZE = 48
+
+def _wall_ms():
+    """RTC time in milliseconds since the epoch"""
+    return time.time_ns() // 1000000
+
+def _ntp_ms(data, offset):
+    """NTP timestamp at data[offset:offset + 8] as Unix milliseconds"""
+    seconds, fraction = struct.unpack_from("!II", data, offset)
+    return (seconds - NTP_DELTA) * 1000 + (fraction * 1000 >> 32)
 
 class TimeSync:
+    """Multi-server SNTP client with a drift and slew model over the RTC
+
+    All servers are queried at once from one non-blocking UDP socket and the
+    reply with the lowest round-trip time wins. Offsets above
+    NTP_STEP_THRESHOLD_MS step the RTC; smaller ones are slewed in at
+    NTP_SLEW_RATE_PPM on top of the estimated RTC drift, so get_timestamp()
+    never jumps. The sync interval doubles while the drift model holds and
+    halves when it misses.
+    """
+
     def __init__(self):
         self.last_sync_time = 0
         self.sync_interval_seconds = TIME_SYNC_INTERVAL_HOURS * 3600
         self.rtc = machine.RTC()
-        
-    def sync_time(self):
-        """Synchronize time with NTP server"""
+        self._addresses = None
+        self._last_sync_ticks = None
+        # corrected = wall + correction_ms + drift since _ref_ms + slew progress
+        self.correction_ms = 0
+        self.drift_ppm = 0
+        self.slew_ms = 0
+        self._ref_ms = _wall_ms()
+        # Last measurement
+        self.last_offset_ms = 0
+        self.last_rtt_ms = -1
+        self.last_server = None
+        self.steps = 0
+
+    def _slewed_ms(self, elapsed):
+        """Part of the pending slew applied elapsed ms after the last sync"""
+        slewed = min(abs(self.slew_ms), elapsed * NTP_SLEW_RATE_PPM // 1000000)
+        return -slewed if self.slew_ms < 0 else slewed
+
+    def _model_ms(self, wall):
+        """Correction to add to the RTC at wall-clock time wall"""
+        elapsed = wall - self._ref_ms
+        return self.correction_ms + elapsed * self.drift_ppm // 1000000 + self._slewed_ms(elapsed)
+
+    def now_ms(self):
+        """Corrected wall-clock time in milliseconds"""
+        wall = _wall_ms()
+        return wall + self._model_ms(wall)
+
+    def _resolve(self):
+        """Look up every server once; DNS is the only blocking step"""
+        addresses = []
+        for host in NTP_SERVERS:
+            try:
+                addresses.append((host, socket.getaddrinfo(host, NTP_PORT)[0][-1]))
+            except OSError as e:
+                print(f"NTP: cannot resolve {host}: {e}")
+        self._addresses = addresses
+
+    def _parse(self, data, sent, recv_us, t4):
+        """Validate a reply; returns (rtt_ms, offset_ms, server index) or None"""
+        if len(data) < NTP_PACKET_SIZE:
+            return None
+        leap, mode, stratum = data[0] >> 6, data[0] & 7, data[1]
+        if mode != 4 or leap == 3 or not 1 <= stratum <= 15:
+            return None
+        # Our transmit timestamp comes back as the originate timestamp
+        index, cookie = struct.unpack_from("!II", data, 24)
+        if index >= len(sent) or sent[index][2] != cookie:
+            return None
+        sent_us, t1, _ = sent[index]
+        t2 = _ntp_ms(data, 32)
+        t3 = _ntp_ms(data, 40)
+        rtt = max(0, time.ticks_diff(recv_us, sent_us) // 1000 - (t3 - t2))
+        return rtt, ((t2 - t1) + (t3 - t4)) // 2, index
+
+    async def sync_async(self):
+        """Query all servers concurrently and apply the lowest-RTT sample"""
+        if not self._addresses:
+            self._resolve()
+            if not self._addresses:
+                return False
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        best = None
         try:
-            print(f"Syncing time with NTP server: {NTP_SERVER}")
-            
-            # Set NTP server if different from default
-            if NTP_SERVER != "pool.ntp.org":
-                ntptime.host = NTP_SERVER
-            
-            # Sync time
-            ntptime.settime()
-            
-            # Update last sync time
-            self.last_sync_time = time.time()
-            
-            # Get current time
-            current_time = time.localtime()
-            time_str = "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
-                current_time[0], current_time[1], current_time[2],
-                current_time[3], current_time[4], current_time[5]
-            )
-            
-            print(f"Time synchronized successfully: {time_str}")
-            return True
-            
-        except Exception as e:
-            print(f"Time sync failed: {e}")
+            sent = []
+            packet = bytearray(NTP_PACKET_SIZE)
+            packet[0] = 0x1B  # LI 0, version 3, mode 3 (client)
+            for index, (host, address) in enumerate(self._addresses):
+                cookie = time.ticks_us()
+                struct.pack_into("!II", packet, 40, index, cookie)
+                sent.append((time.ticks_us(), self.now_ms(), cookie))
+                try:
+                    sock.sendto(packet, address)
+                except OSError as e:
+                    print(f"NTP: send to {host} failed: {e}")
+
+            answered = 0
+            start_ms = time.ticks_ms()
+            while answered < len(sent) and time.ticks_diff(time.ticks_ms(), start_ms) < NTP_TIMEOUT_MS:
+                try:
+                    data, _ = sock.recvfrom(64)
+                except OSError:
+                    await asyncio.sleep_ms(5)
+                    continue
+                sample = self._parse(data, sent, time.ticks_us(), self.now_ms())
+                if sample is None:
+                    continue
+                answered += 1
+                if best is None or sample[0] < best[0]:
+                    best = sample
+        finally:
+            sock.close()
+
+        if best is None:
+            print("Time sync failed: no NTP replies")
+            # Addresses may be stale; resolve again next time
+            self._addresses = None
             return False
-    
+
+        rtt, offset, index = best
+        self.last_rtt_ms = rtt
+        self.last_offset_ms = offset
+        self.last_server = self._addresses[index][0]
+        self._apply(offset)
+        self.last_sync_time = time.time()
+        self._last_sync_ticks = time.ticks_ms()
+        print(f"Time synchronized: {self.get_current_time_str()} via {self.last_server} "
+              f"(offset {offset} ms, rtt {rtt} ms, drift {self.drift_ppm} ppm, "
+              f"next in {self.sync_interval_seconds} s)")
+        return True
+
+    def _set_clock(self, target_ms):
+        """Set the RTC to target_ms; the sub-second remainder goes into the correction"""
+        tm = time.gmtime(target_ms // 1000)
+        self.rtc.datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        wall = _wall_ms()
+        self.correction_ms = target_ms - wall
+        self._ref_ms = wall
+
+    def _apply(self, offset):
+        """Step or slew by offset and update the drift estimate"""
+        wall = _wall_ms()
+        corrected = wall + self._model_ms(wall)
+        if self.last_sync_time == 0 or abs(offset) > NTP_STEP_THRESHOLD_MS:
+            print(f"Stepping clock by {offset} ms")
+            self._set_clock(corrected + offset)
+            self.slew_ms = 0
+            self.steps += 1
+            if self.last_sync_time:
+                self._adapt_interval(offset)
+            return
+
+        elapsed = wall - self._ref_ms
+        # What the model missed since the last sync, beyond the unfinished slew
+        error = offset - (self.slew_ms - self._slewed_ms(elapsed))
+        if elapsed > 0:
+            drift = self.drift_ppm + error * 1000000 // elapsed // 2
+            self.drift_ppm = max(-NTP_MAX_DRIFT_PPM, min(NTP_MAX_DRIFT_PPM, drift))
+
+        # Whole seconds of accumulated correction go into the RTC so time.time()
+        # stays close; corrected time is unchanged by this
+        if abs(corrected - wall) >= 1000:
+            self._set_clock(corrected)
+        else:
+            self.correction_ms = corrected - wall
+            self._ref_ms = wall
+        self.slew_ms = offset
+        self._adapt_interval(error)
+
+    def _adapt_interval(self, error):
+        """Stretch the interval while the model holds, shrink it when it misses"""
+        if abs(error) < NTP_TARGET_ERROR_MS // 4:
+            interval = self.sync_interval_seconds * 2
+        elif abs(error) > NTP_TARGET_ERROR_MS:
+            interval = self.sync_interval_seconds // 2
+        else:
+            return
+        self.sync_interval_seconds = max(NTP_MIN_INTERVAL_SECONDS, min(NTP_MAX_INTERVAL_SECONDS, interval))
+
     def is_sync_needed(self):
         """Check if time sync is needed"""
-        if self.last_sync_time == 0:
+        if self._last_sync_ticks is None:
             return True  # Never synced
-            
-        current_time = time.time()
-        time_since_sync = current_time - self.last_sync_time
-        
-        return time_since_sync >= self.sync_interval_seconds
-    
-    def auto_sync_if_needed(self):
+        return self.get_time_since_sync() >= self.sync_interval_seconds
+
+    def is_time_valid(self):
+        """True once the RTC holds real wall-clock time (synced now or before a soft reset)"""
+        return self.last_sync_time != 0 or time.localtime()[0] >= MIN_VALID_YEAR
+
+    async def auto_sync_if_needed(self):
         """Automatically sync time if needed"""
         if self.is_sync_needed():
-            return self.sync_time()
+            return await self.sync_async()
         return True
-    
+
     def get_current_time_str(self):
         """Get current time as formatted string"""
         try:
-            current_time = time.localtime()
+            current_time = time.gmtime(self.get_timestamp())
             return "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
                 current_time[0], current_time[1], current_time[2],
                 current_time[3], current_time[4], current_time[5]
             )
         except:
             return "Time not available"
-    
+
     def get_timestamp(self):
-        """Get current timestamp"""
-        return time.time()
-    
+        """Get the corrected current timestamp"""
+        return self.now_ms() // 1000
+
     def get_time_since_sync(self):
         """Get time elapsed since last sync in seconds"""
-        if self.last_sync_time == 0:
+        if self._last_sync_ticks is None:
             return -1  # Never synced
-        return time.time() - self.last_sync_time
-    
+        return time.ticks_diff(time.ticks_ms(), self._last_sync_ticks) // 1000
+
     def get_status(self):
         """Get time sync status"""
         time_since_sync = self.get_time_since_sync()
@@ -84,6 +243,10 @@ class TimeSync:
             'time_since_sync_seconds': time_since_sync,
             'time_since_sync_hours': time_since_sync / 3600 if time_since_sync >= 0 else -1,
             'sync_needed': self.is_sync_needed(),
-            'ntp_server': NTP_SERVER,
-            'sync_interval_hours': TIME_SYNC_INTERVAL_HOURS
-        }
\ No newline at end of file
+            'ntp_server': self.last_server,
+            'offset_ms': self.last_offset_ms,
+            'rtt_ms': self.last_rtt_ms,
+            'drift_ppm': self.drift_ppm,
+            'steps': self.steps,
+            'sync_interval_hours': self.sync_interval_seconds / 3600
+        }
@@ -0,0 +1,140 @@
+import time
+import asyncio
+from config import TIMER_TICK_MS, TIMER_WHEEL_SLOTS
+
+class Timer:
+    """A wheel entry; period_ms > 0 makes it re-arm itself after each expiry"""
+
+    def __init__(self, name, callback, period_ms=0):
+        self.name = name
+        self.callback = callback
+        self.period_ms = period_ms
+        self.slot = -1      # -1 while not scheduled
+        self.rounds = 0
+        self.prev = None
+        self.next = None
+
+    def pending(self):
+        return self.slot >= 0
+
+
+class TimerWheel:
+    """Hashed timing wheel on ticks_ms
+
+    TIMER_WHEEL_SLOTS slots of TIMER_TICK_MS each; timers further out than
+    one revolution carry a rounds count. Each slot is a doubly linked list,
+    so schedule() and cancel() are O(1). Delays are measured from the real
+    ticks_ms() at scheduling time, never from the wall clock, so NTP steps
+    cannot bunch or stall timers, and a late run() fires each overdue timer
+    once instead of replaying missed periods.
+    """
+
+    def __init__(self, on_error=None):
+        self.slots = [None] * TIMER_WHEEL_SLOTS
+        self.cursor = 0
+        self.base_ms = time.ticks_ms()  # Start of the cursor slot
+        self.on_error = on_error
+        # Set when a timer is scheduled from outside run(), so the driver recomputes its sleep
+        self.changed = asyncio.Event()
+        self._in_run = False
+
+    def _link(self, timer, slot):
+        head = self.slots[slot]
+        timer.slot = slot
+        timer.prev = None
+        timer.next = head
+        if head is not None:
+            head.prev = timer
+        self.slots[slot] = timer
+
+    def schedule(self, timer, delay_ms):
+        """(Re)arm timer to fire delay_ms from now"""
+        if timer.slot >= 0:
+            self.cancel(timer)
+        lag = time.ticks_diff(time.ticks_ms(), self.base_ms)
+        ticks = max(1, (delay_ms + lag + TIMER_TICK_MS - 1) // TIMER_TICK_MS)
+        timer.rounds = (ticks - 1) // TIMER_WHEEL_SLOTS
+        self._link(timer, (self.cursor + ticks) % TIMER_WHEEL_SLOTS)
+        if not self._in_run:
+            self.changed.set()
+
+    def start(self, timer):
+        """Arm a periodic timer one period from now"""
+        self.schedule(timer, timer.period_ms)
+
+    def cancel(self, timer):
+        if timer.slot < 0:
+            return
+        if timer.prev is not None:
+            timer.prev.next = timer.next
+        else:
+            self.slots[timer.slot] = timer.next
+        if timer.next is not None:
+            timer.next.prev = timer.prev
+        timer.slot = -1
+        timer.prev = timer.next = None
+
+    def run(self):
+        """Fire every timer whose slot has been reached"""
+        now = time.ticks_ms()
+        self._in_run = True
+        try:
+            while time.ticks_diff(now, self.base_ms) >= TIMER_TICK_MS:
+                self.cursor = (self.cursor + 1) % TIMER_WHEEL_SLOTS
+                self.base_ms = time.ticks_add(self.base_ms, TIMER_TICK_MS)
+                # Detach the slot so timers re-armed by callbacks land in a later revolution
+                timer = self.slots[self.cursor]
+                self.slots[self.cursor] = None
+                while timer is not None:
+                    following = timer.next
+                    if timer.rounds:
+                        timer.rounds -= 1
+                        self._link(timer, self.cursor)
+                    else:
+                        timer.slot = -1
+                        timer.prev = timer.next = None
+                        if timer.period_ms:
+                            self.schedule(timer, timer.period_ms)
+                        self._fire(timer)
+                    timer = following
+        finally:
+            self._in_run = False
+
+    def _fire(self, timer):
+        try:
+            timer.callback()
+        except Exception as e:
+            if self.on_error:
+                self.on_error(timer.name, e)
+            else:
+                print(f"Timer {timer.name} error: {e}")
+
+    def next_deadline_ms(self):
+        """Milliseconds until the earliest pending timer (0 if overdue), or None"""
+        best = None
+        for slot in range(TIMER_WHEEL_SLOTS):
+            timer = self.slots[slot]
+            if timer is None:
+                continue
+            distance = (slot - self.cursor - 1) % TIMER_WHEEL_SLOTS + 1
+            while timer is not None:
+                ticks = distance + timer.rounds * TIMER_WHEEL_SLOTS
+                if best is None or ticks < best:
+                    best = ticks
+                timer = timer.next
+        if best is None:
+            return None
+        deadline = time.ticks_add(self.base_ms, best * TIMER_TICK_MS)
+        return max(0, time.ticks_diff(deadline, time.ticks_ms()))
+
+    def get_status(self):
+        """Pending timers and their remaining time"""
+        pending = {}
+        for slot in range(TIMER_WHEEL_SLOTS):
+            timer = self.slots[slot]
+            distance = (slot - self.cursor - 1) % TIMER_WHEEL_SLOTS + 1
+            while timer is not None:
+                ticks = distance + timer.rounds * TIMER_WHEEL_SLOTS
+                pending[timer.name] = time.ticks_diff(time.ticks_add(self.base_ms, ticks * TIMER_TICK_MS), time.ticks_ms())
+                timer = timer.next
+        return pending
@@ -1,88 +1,331 @@
 import machine
 import time
-from config import VALVE_PINS, NUM_VALVES
+from config import (
+    NUM_VALVES, VALVE_MAX_RUN_SECONDS, VALVE_DRIVER, CONCURRENT_ZONES, VALVE_CURRENT_MA,
+    VALVE_FLOW_LPM, CURRENT_BUDGET_MA, FLOW_BUDGET_LPM, VALVE_OPEN_STAGGER_MS
+)
+from valve_drivers import create_driver
+from metrics import METRICS
+from log import LOG
+
+# Precomputed name/index tables so transitions never build strings
+VALVE_NAMES = tuple("valve_%d" % (i + 1) for i in range(NUM_VALVES))
+VALVE_INDEX = {name: i for i, name in enumerate(VALVE_NAMES)}
+VALVE_BITS = tuple(1 << i for i in range(NUM_VALVES))
+
+def _lowest_bit(mask):
+    """Index of the lowest set bit, or None for 0"""
+    if not mask:
+        return None
+    i = 0
+    while not mask & 1:
+        mask >>= 1
+        i += 1
+    return i
 
 class ValveController:
+    """Valve state as an integer bitmask (bit i = valve i+1 ON)
+
+    Up to 30 valves the mask stays a MicroPython small int, so transitions
+    allocate nothing; larger chains still work with a long-int mask.
+
+    By default only one valve is ON at a time. With CONCURRENT_ZONES several
+    may be open while the sum of their VALVE_CURRENT_MA and VALVE_FLOW_LPM
+    ratings stays within CURRENT_BUDGET_MA and FLOW_BUDGET_LPM, and
+    openings are spaced VALVE_OPEN_STAGGER_MS apart so solenoid inrush
+    currents never overlap.
+    """
+    
     def __init__(self):
-        self.valves = []
-        self.valve_states = {}
-        self.active_valve = None
+        self.driver = create_driver(VALVE_DRIVER, NUM_VALVES)
+        self.num_valves = NUM_VALVES
+        self.state_mask = 0
+        self.active_valve = None  # Most recently opened valve still ON
+        self.until_ms = [None] * NUM_VALVES  # ticks_ms auto-off deadline per open valve
+        self.concurrent = CONCURRENT_ZONES
+        # Openings waiting for the inrush stagger gap (concurrent mode), oldest first
+        self._deferred = []
+        self.deferred_mask = 0
+        self.deferred_seconds = [None] * NUM_VALVES
+        self.last_open_ms = time.ticks_add(time.ticks_ms(), -VALVE_OPEN_STAGGER_MS)
+        # Called after every state change (the journal records it)
+        self.on_change = None
         
-        # Initialize GPIO pins for valves
-        for i, pin_num in enumerate(VALVE_PINS[:NUM_VALVES]):
-            valve_pin = machine.Pin(pin_num, machine.Pin.OUT)
-            valve_pin.value(0)  # Start with valve OFF
-            self.valves.append(valve_pin)
-            self.valve_states[f"valve_{i+1}"] = "OFF"
+        # Auto-off timers, preallocated per valve. The callbacks only force the
+        # output low and set a flag, so they allocate nothing and can run as
+        # hard IRQs; service_expired() reconciles state afterwards.
+        # _irq_off[0] = 0 leaves the output to service_expired() as well.
+        self.max_run_seconds = list(VALVE_MAX_RUN_SECONDS[:NUM_VALVES])
+        self.timers = [machine.Timer() for _ in range(NUM_VALVES)]
+        self._armed = bytearray(NUM_VALVES)
+        self._expired = bytearray(NUM_VALVES)
+        self._irq_off = bytearray(b"\x01")
+        self._none_expired = bytes(NUM_VALVES)
+        self._expire_callbacks = [self._make_expire_callback(i) for i in range(NUM_VALVES)]
         
-        print(f"Initialized {len(self.valves)} valves on pins: {VALVE_PINS[:NUM_VALVES]}")
+        print(f"Initialized {NUM_VALVES} valves: {self.driver.describe()}")
     
-    def set_valve(self, valve_index, state):
-        """Set valve state (True=ON, False=OFF)"""
-        if not 0 <= valve_index < len(self.valves):
-            print(f"Invalid valve index: {valve_index}")
-            return False
+    def _make_expire_callback(self, valve_index):
+        """Build the allocation-free timer callback for one valve"""
+        off = self.driver.off
+        expired = self._expired
+        irq_off = self._irq_off
+        
+        def callback(timer):
+            if irq_off[0]:
+                off(valve_index)
+            expired[valve_index] = 1
         
-        valve_name = f"valve_{valve_index + 1}"
+        return callback
+    
+    def set_irq_off(self, enabled):
+        """Whether the auto-off IRQ drives the output low itself or only flags the expiry"""
+        self._irq_off[0] = 1 if enabled else 0
+    
+    def _arm_timer(self, valve_index, seconds):
+        """Start the one-shot auto-off timer for a valve"""
+        timer = self.timers[valve_index]
+        try:
+            timer.init(mode=machine.Timer.ONE_SHOT, period=seconds * 1000,
+                       callback=self._expire_callbacks[valve_index], hard=True)
+        except TypeError:
+            # Ports without hard timer IRQs
+            timer.init(mode=machine.Timer.ONE_SHOT, period=seconds * 1000,
+                       callback=self._expire_callbacks[valve_index])
+        self._armed[valve_index] = 1
+    
+    def _cancel_timer(self, valve_index):
+        """Stop a valve's auto-off timer"""
+        if self._armed[valve_index]:
+            self.timers[valve_index].deinit()
+            self._armed[valve_index] = 0
+        self._expired[valve_index] = 0
+    
+    def _close(self, valve_index):
+        """Close one valve; touches only its own output"""
+        self._cancel_timer(valve_index)
+        self.driver.set(valve_index, 0)
+        bit = VALVE_BITS[valve_index]
+        self.state_mask &= ~bit
+        self.until_ms[valve_index] = None
+        if self.deferred_mask & bit:
+            self.deferred_mask &= ~bit
+            self._deferred.remove(valve_index)
+        if self.active_valve == valve_index:
+            self.active_valve = _lowest_bit(self.state_mask)
+    
+    def _open(self, valve_index, duration):
+        """Open one valve, arming its auto-off first so it is never unguarded"""
+        limit = self.max_run_seconds[valve_index]
+        if duration is None or duration <= 0:
+            seconds = limit
+        else:
+            seconds = min(duration, limit) if limit else duration
+        self._cancel_timer(valve_index)
+        if seconds:
+            self._arm_timer(valve_index, seconds)
+        
+        self.driver.set(valve_index, 1)
+        self.state_mask |= VALVE_BITS[valve_index]
+        self.active_valve = valve_index
+        now = time.ticks_ms()
+        self.until_ms[valve_index] = time.ticks_add(now, seconds * 1000) if seconds else None
+        self.last_open_ms = now
+        if METRICS:
+            METRICS.valve_actuated()
+        if seconds:
+            LOG.info("Valve %d turned ON for %d s", valve_index + 1, seconds)
+        else:
+            LOG.info("Valve %d turned ON", valve_index + 1)
+    
+    def within_budget(self, mask):
+        """True if the valves in mask may be open together (a single valve always may)"""
+        if not mask & (mask - 1):
+            return True
+        current = flow = 0
+        i = 0
+        while mask:
+            if mask & 1:
+                current += VALVE_CURRENT_MA[i]
+                flow += VALVE_FLOW_LPM[i]
+            mask >>= 1
+            i += 1
+        return current <= CURRENT_BUDGET_MA and flow <= FLOW_BUDGET_LPM
+    
+    def set_valve(self, valve_index, state, duration=None):
+        """Set valve state (True=ON, False=OFF); ON runs for duration seconds, capped by the valve's max run time
+
+        In concurrent mode an ON that would exceed the budget returns False,
+        and one that comes too soon after another opening is deferred (it
+        counts as ON for the budget) until service_deferred() opens it.
+        """
+        if not 0 <= valve_index < NUM_VALVES:
+            LOG.warning("Invalid valve index: %s", valve_index)
+            return False
         
         if state:  # Turn valve ON
-            # First turn off all other valves (only one can be ON)
-            self._turn_off_all_valves()
-            
-            # Turn on the requested valve
-            self.valves[valve_index].value(1)
-            self.valve_states[valve_name] = "ON"
-            self.active_valve = valve_index
-            print(f"Valve {valve_index + 1} turned ON")
+            bit = VALVE_BITS[valve_index]
+            if self.concurrent:
+                claimed = self.state_mask | self.deferred_mask
+                if not claimed & bit and not self.within_budget(claimed | bit):
+                    LOG.warning("Valve %d not opened: over the supply budget", valve_index + 1)
+                    return False
+                if not self.state_mask & bit and (self.deferred_mask or time.ticks_diff(
+                        time.ticks_ms(), self.last_open_ms) < VALVE_OPEN_STAGGER_MS):
+                    if not self.deferred_mask & bit:
+                        self.deferred_mask |= bit
+                        self._deferred.append(valve_index)
+                    self.deferred_seconds[valve_index] = duration
+                    return True
+            # Only one valve can be ON: close the active one, if it is another
+            elif self.active_valve is not None and self.active_valve != valve_index:
+                self._close(self.active_valve)
+            self._open(valve_index, duration)
             
         else:  # Turn valve OFF
-            self.valves[valve_index].value(0)
-            self.valve_states[valve_name] = "OFF"
-            if self.active_valve == valve_index:
-                self.active_valve = None
-            print(f"Valve {valve_index + 1} turned OFF")
+            self._close(valve_index)
+            if METRICS:
+                METRICS.valve_actuated()
+            LOG.info("Valve %d turned OFF", valve_index + 1)
         
+        if self.on_change:
+            self.on_change()
         return True
     
     def _turn_off_all_valves(self):
         """Turn off all valves"""
-        for i, valve in enumerate(self.valves):
-            valve.value(0)
-            self.valve_states[f"valve_{i+1}"] = "OFF"
+        for i in range(NUM_VALVES):
+            self._cancel_timer(i)
+        # Drive every output low regardless of the recorded state
+        self.driver.write(0, (1 << NUM_VALVES) - 1)
+        self.state_mask = 0
         self.active_valve = None
+        for i in range(NUM_VALVES):
+            self.until_ms[i] = None
+        self._deferred = []
+        self.deferred_mask = 0
+        if self.on_change:
+            self.on_change()
     
     def turn_off_all_valves(self):
         """Public method to turn off all valves"""
         self._turn_off_all_valves()
-        print("All valves turned OFF")
+        LOG.info("All valves turned OFF")
+    
+    def get_state_mask(self):
+        """Current valve state as a bitmask (no allocation)"""
+        return self.state_mask
+    
+    def is_on(self, valve_index):
+        """True if a valve is ON"""
+        return bool(self.state_mask & VALVE_BITS[valve_index])
+    
+    def states_from_mask(self, mask, only=None):
+        """Build a {valve_name: "ON"/"OFF"} dict for the bits set in only (default: all)"""
+        if only is None:
+            only = (1 << NUM_VALVES) - 1
+        states = {}
+        i = 0
+        while only:
+            if only & 1:
+                states[VALVE_NAMES[i]] = "ON" if (mask >> i) & 1 else "OFF"
+            only >>= 1
+            i += 1
+        return states
+    
+    def mask_from_states(self, valve_states):
+        """Inverse of states_from_mask"""
+        mask = 0
+        for valve_name, state in valve_states.items():
+            if state == "ON" and valve_name in VALVE_INDEX:
+                mask |= VALVE_BITS[VALVE_INDEX[valve_name]]
+        return mask
     
     def get_valve_states(self):
         """Get current state of all valves"""
-        return self.valve_states.copy()
+        return self.states_from_mask(self.state_mask)
+    
+    def remaining_seconds(self):
+        """Seconds left on the shortest open valve's run timer (0 = no limit or none open)"""
+        now = time.ticks_ms()
+        left = None
+        for until in self.until_ms:
+            if until is not None:
+                ms = time.ticks_diff(until, now)
+                if left is None or ms < left:
+                    left = ms
+        if left is None:
+            return 0
+        return max(1, (left + 999) // 1000)
+    
+    def service_deferred(self):
+        """Open the oldest deferred valve once the stagger gap has passed; True if one opened"""
+        if not self.deferred_mask or time.ticks_diff(time.ticks_ms(), self.last_open_ms) < VALVE_OPEN_STAGGER_MS:
+            return False
+        valve_index = self._deferred.pop(0)
+        self.deferred_mask &= ~VALVE_BITS[valve_index]
+        self._open(valve_index, self.deferred_seconds[valve_index])
+        if self.on_change:
+            self.on_change()
+        return True
     
     def get_active_valve(self):
         """Get currently active valve (if any)"""
         return self.active_valve
     
-    def set_valve_by_name(self, valve_name, state):
+    def set_valve_by_name(self, valve_name, state, duration=None):
         """Set valve state by name (valve_1, valve_2, etc.)"""
-        try:
-            valve_number = int(valve_name.split('_')[1]) - 1
-            return self.set_valve(valve_number, state == "ON")
-        except (IndexError, ValueError):
-            print(f"Invalid valve name: {valve_name}")
+        valve_index = VALVE_INDEX.get(valve_name)
+        if valve_index is None:
+            LOG.warning("Invalid valve name: %s", valve_name)
             return False
+        return self.set_valve(valve_index, state == "ON", duration)
+    
+    def expired_pending(self):
+        """True if a run timer closed a valve since the last service_expired() (no allocation)"""
+        return self._expired != self._none_expired
+    
+    def service_expired(self):
+        """Reconcile valves closed by their auto-off timer; returns their names"""
+        expired = []
+        for i in range(NUM_VALVES):
+            if self._expired[i]:
+                self._close(i)
+                expired.append(VALVE_NAMES[i])
+                LOG.info("Valve %d turned OFF by run timer", i + 1)
+        if expired and self.on_change:
+            self.on_change()
+        return expired
+    
+    def verify_outputs(self):
+        """Re-drive any output that disagrees with the recorded state"""
+        if hasattr(self.driver, "refresh"):
+            self.driver.refresh()
+            return 0
+        # A timer IRQ must not fire between the check and the write
+        irq_state = machine.disable_irq()
+        expected = self.state_mask
+        for i in range(NUM_VALVES):
+            if self._expired[i]:
+                expected &= ~VALVE_BITS[i]
+        diff = self.driver.read() ^ expected
+        if diff:
+            self.driver.write(expected, diff)
+        machine.enable_irq(irq_state)
+        if diff:
+            LOG.warning("Valve safety corrected outputs: %#x", diff)
+        return diff
     
     def emergency_stop(self):
         """Emergency stop - turn off all valves immediately"""
-        print("EMERGENCY STOP - Turning off all valves")
+        LOG.error("EMERGENCY STOP - Turning off all valves")
         self._turn_off_all_valves()
     
     def test_valves(self, test_duration_seconds=2):
         """Test each valve sequentially"""
         print("Starting valve test...")
         
-        for i in range(len(self.valves)):
+        for i in range(NUM_VALVES):
             print(f"Testing valve {i+1}")
             self.set_valve(i, True)
             time.sleep(test_duration_seconds)
@@ -94,8 +337,12 @@ class ValveController:
     def get_status(self):
         """Get detailed status of valve controller"""
         return {
-            'total_valves': len(self.valves),
-            'valve_states': self.valve_states,
+            'total_valves': NUM_VALVES,
+            'state_mask': self.state_mask,
             'active_valve': self.active_valve,
-            'pins': VALVE_PINS[:NUM_VALVES]
+            'concurrent': self.concurrent,
+            'deferred': list(self._deferred),
+            'timed_valves': [i for i in range(NUM_VALVES) if self._armed[i]],
+            'max_run_seconds': self.max_run_seconds,
+            'outputs': self.driver.describe()
         }
\ No newline at end of file
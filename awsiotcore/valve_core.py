@@ -0,0 +1,257 @@
+import time
+import asyncio
+from config import (
+    VALVE_CORE_ENABLED, VALVE_CORE_POLL_MS, VALVE_CORE_MAILBOX_SLOTS, VALVE_CORE_EVENT_SLOTS,
+    VALVE_CORE_CALL_TIMEOUT_MS, VALVE_SAFETY_INTERVAL_MS, SCHEDULE_TICK_MS, SENSOR_BATCH_MS
+)
+from log import LOG
+
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+# Mailbox slot fields and states
+_FN, _ARGS, _RESULT, _ERROR, _STATE, _WAITER = range(6)
+_FREE, _POSTED, _DONE = 0, 1, 2
+
+class ValveCore:
+    """Valve control, run timers and local schedules on the second core
+
+    Core 0 keeps the asyncio loop (WiFi, TLS, MQTT, JSON, flash). Core 1
+    owns the ValveController and ScheduleEngine: every VALVE_CORE_POLL_MS it
+    runs the calls posted to its mailbox, opens staggered (deferred) valves,
+    closes valves whose run timer expired, re-asserts outputs, ticks the
+    schedules and aggregates the flow monitor's sample batch. A blocking
+    TLS handshake on core 0 therefore no longer delays a timed shutoff or
+    the next schedule step.
+
+    Core 0 never mutates valve or schedule state itself: call() posts a
+    function to a fixed-size, lock-protected mailbox and waits for core 1
+    to run it. Core 1 publishes a (mask, active valve, run name, run step,
+    soaking) snapshot tuple after each change, which core 0 reads through
+    current() for status, telemetry, idle checks and journal checkpoints.
+    Work that belongs on core 0 (journal writes, shadow reports) is queued
+    with emit() and run there by drain_events().
+
+    Without _thread, or with VALVE_CORE_ENABLED off, nothing is started:
+    call() and emit() run inline and the timer wheel does the periodic work.
+    """
+
+    def __init__(self, valve_controller, scheduler, flow_monitor=None):
+        self.valves = valve_controller
+        self.scheduler = scheduler
+        self.flow_monitor = flow_monitor
+        self.threaded = False
+        self.running = False
+        self.lock = _thread.allocate_lock() if _thread else None
+        self._mailbox = [[None, None, None, None, _FREE, False] for _ in range(VALVE_CORE_MAILBOX_SLOTS)]
+        self._post_index = 0
+        self._take_index = 0
+        self._events = [[None, None] for _ in range(VALVE_CORE_EVENT_SLOTS)]
+        self._event_count = 0
+        # Wakes the core 0 task that drains events (safe to set from another thread)
+        self.events_ready = asyncio.ThreadSafeFlag()
+        self.snapshot = (0, None, None, 0, False)
+        # on_expired(valve_names): valves closed by their run timer, run on core 0
+        self.on_expired = None
+        self._safety_due = 0
+        self._tick_due = 0
+        self._batch_due = 0
+        self.stats = {'loops': 0, 'calls': 0, 'timeouts': 0, 'events_dropped': 0, 'max_pass_us': 0}
+
+    def start(self):
+        """Start the core 1 loop; returns False when running single-core"""
+        if not VALVE_CORE_ENABLED or _thread is None:
+            print("Valve core: single-core mode")
+            return False
+        self._publish_snapshot()
+        now = time.ticks_ms()
+        self._safety_due = now
+        self._tick_due = now
+        self._batch_due = time.ticks_add(now, SENSOR_BATCH_MS)
+        self.running = True
+        self.threaded = True
+        if self.valves.driver.shared_bus:
+            # The timer IRQ may fire on core 0 mid-transfer on core 1, so
+            # core 1 closes expired valves itself within VALVE_CORE_POLL_MS
+            self.valves.set_irq_off(False)
+        _thread.start_new_thread(self._loop, ())
+        print("Valve core: running on core 1")
+        return True
+
+    def stop(self, timeout_ms=500):
+        """Stop the core 1 loop and wait for it to exit"""
+        if not self.threaded:
+            return
+        self.running = False
+        start = time.ticks_ms()
+        while self.threaded and time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            time.sleep_ms(1)
+
+    # --- core 0 side ---
+
+    def call(self, fn, *args):
+        """Run fn(*args) on core 1 and return its result; exceptions are re-raised here"""
+        if not self.threaded:
+            return fn(*args)
+        slot = self._post(fn, args, True)
+        start = time.ticks_ms()
+        while slot[_STATE] != _DONE:
+            if time.ticks_diff(time.ticks_ms(), start) > VALVE_CORE_CALL_TIMEOUT_MS:
+                with self.lock:
+                    abandoned = slot[_STATE] != _DONE
+                    if abandoned:
+                        # It still runs later; core 1 frees the slot itself
+                        slot[_WAITER] = False
+                if abandoned:
+                    self.stats['timeouts'] += 1
+                    raise OSError("valve core call timed out")
+                break
+            time.sleep_ms(0)
+        with self.lock:
+            result, error = slot[_RESULT], slot[_ERROR]
+            self._release(slot)
+        if error is not None:
+            raise error
+        return result
+
+    def post(self, fn, *args):
+        """Queue fn(*args) for core 1 without waiting"""
+        if not self.threaded:
+            fn(*args)
+            return
+        self._post(fn, args, False)
+
+    def _post(self, fn, args, waiter):
+        with self.lock:
+            slot = self._mailbox[self._post_index]
+            if slot[_STATE] != _FREE:
+                raise OSError("valve core mailbox full")
+            slot[_FN] = fn
+            slot[_ARGS] = args
+            slot[_WAITER] = waiter
+            slot[_STATE] = _POSTED
+            self._post_index = (self._post_index + 1) % VALVE_CORE_MAILBOX_SLOTS
+        return slot
+
+    def _release(self, slot):
+        slot[_FN] = slot[_ARGS] = slot[_RESULT] = slot[_ERROR] = None
+        slot[_STATE] = _FREE
+
+    def drain_events(self):
+        """Run the callbacks core 1 queued for core 0; returns how many ran"""
+        with self.lock:
+            count = self._event_count
+            pending = [(slot[0], slot[1]) for slot in self._events[:count]]
+            for slot in self._events[:count]:
+                slot[0] = slot[1] = None
+            self._event_count = 0
+        for fn, args in pending:
+            try:
+                fn(*args)
+            except Exception as e:
+                LOG.error("Valve core event error: %s", e)
+        return count
+
+    # --- core 1 side ---
+
+    def emit(self, fn, *args):
+        """Have core 0 run fn(*args) (inline when single-core)"""
+        if not self.threaded:
+            fn(*args)
+            return
+        with self.lock:
+            if self._event_count >= VALVE_CORE_EVENT_SLOTS:
+                self.stats['events_dropped'] += 1
+                return
+            slot = self._events[self._event_count]
+            slot[0] = fn
+            slot[1] = args
+            self._event_count += 1
+        self.events_ready.set()
+
+    def _run_mailbox(self):
+        while True:
+            with self.lock:
+                slot = self._mailbox[self._take_index]
+                if slot[_STATE] != _POSTED:
+                    return
+                fn, args = slot[_FN], slot[_ARGS]
+            result = error = None
+            try:
+                result = fn(*args)
+            except Exception as e:
+                error = e
+            with self.lock:
+                self.stats['calls'] += 1
+                if slot[_WAITER]:
+                    slot[_RESULT] = result
+                    slot[_ERROR] = error
+                    slot[_STATE] = _DONE
+                else:
+                    if error is not None:
+                        LOG.error("Valve core call error: %s", error)
+                    self._release(slot)
+                self._take_index = (self._take_index + 1) % VALVE_CORE_MAILBOX_SLOTS
+
+    def _publish_snapshot(self):
+        """Replace the snapshot if valve or run state changed (one reference store)"""
+        scheduler = self.scheduler
+        current = self.snapshot
+        if (current[0] != self.valves.state_mask or current[1] != self.valves.active_valve
+                or current[2] != scheduler.run_name or current[3] != scheduler.run_step
+                or current[4] != scheduler.soaking):
+            self.snapshot = (self.valves.state_mask, self.valves.active_valve,
+                             scheduler.run_name, scheduler.run_step, scheduler.soaking)
+
+    def current(self):
+        """(mask, active valve, run name, run step, soaking) for core 0; read live when single-core"""
+        if not self.threaded:
+            self._publish_snapshot()
+        return self.snapshot
+
+    def service(self):
+        """One pass of core 1's work"""
+        self._run_mailbox()
+        if self.valves.deferred_mask:
+            self.valves.service_deferred()
+        if self.valves.expired_pending():
+            expired = self.valves.service_expired()
+            if expired and self.on_expired:
+                self.emit(self.on_expired, expired)
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._safety_due) >= 0:
+            self._safety_due = time.ticks_add(now, VALVE_SAFETY_INTERVAL_MS)
+            self.valves.verify_outputs()
+        if time.ticks_diff(now, self._tick_due) >= 0:
+            self._tick_due = time.ticks_add(now, SCHEDULE_TICK_MS)
+            self.scheduler.tick()
+        if self.flow_monitor is not None and time.ticks_diff(now, self._batch_due) >= 0:
+            self._batch_due = time.ticks_add(now, SENSOR_BATCH_MS)
+            self.flow_monitor.process()
+        self._publish_snapshot()
+
+    def _loop(self):
+        stats = self.stats
+        try:
+            while self.running:
+                start = time.ticks_us()
+                try:
+                    self.service()
+                except Exception as e:
+                    LOG.error("Valve core error: %s", e)
+                elapsed = time.ticks_diff(time.ticks_us(), start)
+                if elapsed > stats['max_pass_us']:
+                    stats['max_pass_us'] = elapsed
+                stats['loops'] += 1
+                time.sleep_ms(VALVE_CORE_POLL_MS)
+        finally:
+            self.threaded = False
+            self.valves.set_irq_off(True)
+
+    def get_status(self):
+        """Get valve core status"""
+        status = dict(self.stats)
+        status['threaded'] = self.threaded
+        return status
@@ -0,0 +1,135 @@
+import machine
+from config import (
+    VALVE_PINS, SHIFT_REGISTER_SPI_ID, SHIFT_REGISTER_BAUDRATE,
+    SHIFT_REGISTER_SCK_PIN, SHIFT_REGISTER_MOSI_PIN, SHIFT_REGISTER_LATCH_PIN
+)
+
+class GPIOValveDriver:
+    """One GPIO pin per valve"""
+
+    # off() is one pin write, safe from an IRQ on either core
+    shared_bus = False
+
+    def __init__(self, count):
+        self.count = count
+        self.pins = []
+        for pin_num in VALVE_PINS[:count]:
+            valve_pin = machine.Pin(pin_num, machine.Pin.OUT)
+            valve_pin.value(0)  # Start with valve OFF
+            self.pins.append(valve_pin)
+
+    def set(self, index, on):
+        """Drive a single valve output"""
+        self.pins[index].value(on)
+
+    def off(self, index):
+        """Force one output low; allocation-free, safe from a hard IRQ"""
+        self.pins[index].value(0)
+
+    def write(self, mask, changed):
+        """Drive only the outputs whose bit is set in changed"""
+        pins = self.pins
+        i = 0
+        while changed:
+            if changed & 1:
+                pins[i].value((mask >> i) & 1)
+            changed >>= 1
+            i += 1
+
+    def read(self):
+        """Current output levels as a bitmask"""
+        mask = 0
+        for i in range(self.count):
+            if self.pins[i].value():
+                mask |= 1 << i
+        return mask
+
+    def describe(self):
+        return {'driver': 'gpio', 'pins': VALVE_PINS[:self.count]}
+
+
+class ShiftRegisterValveDriver:
+    """Chained 74HC595 shift registers on hardware SPI plus a latch pin
+
+    Valve i is bit i % 8 of the i // 8-th register in the chain. The whole
+    chain is shifted from a preallocated buffer, so writes allocate nothing.
+    Outputs cannot be read back; read() returns the last latched image.
+    """
+
+    # Every output goes through one SPI transfer; disable_irq() only masks
+    # the calling core, so off() is unsafe from an IRQ on the other core
+    shared_bus = True
+
+    def __init__(self, count):
+        self.count = count
+        self.nbytes = (count + 7) // 8
+        # The first byte shifted out ends up in the last register of the chain
+        self._buf = bytearray(self.nbytes)
+        self.spi = machine.SPI(SHIFT_REGISTER_SPI_ID, baudrate=SHIFT_REGISTER_BAUDRATE,
+                               sck=machine.Pin(SHIFT_REGISTER_SCK_PIN),
+                               mosi=machine.Pin(SHIFT_REGISTER_MOSI_PIN))
+        self.latch = machine.Pin(SHIFT_REGISTER_LATCH_PIN, machine.Pin.OUT)
+        self.latch.value(0)
+        self._shift()
+
+    def _shift(self):
+        self.latch.value(0)
+        self.spi.write(self._buf)
+        self.latch.value(1)
+
+    def _update(self, index, on):
+        byte = self.nbytes - 1 - (index >> 3)
+        bit = 1 << (index & 7)
+        if on:
+            self._buf[byte] |= bit
+        else:
+            self._buf[byte] &= ~bit & 0xFF
+
+    def set(self, index, on):
+        """Drive a single valve output"""
+        # A timer IRQ on this core calling off() must not interleave with this transfer
+        irq_state = machine.disable_irq()
+        self._update(index, on)
+        self._shift()
+        machine.enable_irq(irq_state)
+
+    def off(self, index):
+        """Force one output low; allocation-free, safe from a hard IRQ"""
+        self._update(index, 0)
+        self._shift()
+
+    def write(self, mask, changed):
+        """Set the changed bits and latch the chain once"""
+        irq_state = machine.disable_irq()
+        i = 0
+        while changed:
+            if changed & 1:
+                self._update(i, (mask >> i) & 1)
+            changed >>= 1
+            i += 1
+        self._shift()
+        machine.enable_irq(irq_state)
+
+    def read(self):
+        """Last latched output image as a bitmask"""
+        mask = 0
+        for i in range(self.count):
+            if self._buf[self.nbytes - 1 - (i >> 3)] & (1 << (i & 7)):
+                mask |= 1 << i
+        return mask
+
+    def refresh(self):
+        """Re-latch the whole chain (outputs cannot be read back)"""
+        irq_state = machine.disable_irq()
+        self._shift()
+        machine.enable_irq(irq_state)
+
+    def describe(self):
+        return {'driver': 'shift_register', 'registers': self.nbytes, 'latch_pin': SHIFT_REGISTER_LATCH_PIN}
+
+
+def create_driver(kind, count):
+    """Build the valve output driver named by VALVE_DRIVER"""
+    if kind == "shift_register":
+        return ShiftRegisterValveDriver(count)
+    return GPIOValveDriver(count)
@@ -1,10 +1,15 @@
 import network
 import time
+import asyncio
 from config import WIFI_SSID, WIFI_PASSWORD
 
 class WiFiManager:
     def __init__(self):
         self.wlan = network.WLAN(network.STA_IF)
+        self.power_save = False
+        self._power_save_supported = True
+        # ticks_ms when begin() started an association that is still pending
+        self._joining_since = None
         
     def connect(self, timeout=30):
         """Connect to WiFi network"""
@@ -27,12 +32,58 @@ class WiFiManager:
         print(f"Connected to WiFi: {self.wlan.ifconfig()}")
         return True
     
+    def begin(self):
+        """Start associating and return at once; connect_async() then only waits
+
+        Called first thing at boot so the rest of initialization overlaps
+        with the association.
+        """
+        if self.wlan.isconnected() or self._joining_since is not None:
+            return
+        self.wlan.active(True)
+        self.wlan.connect(WIFI_SSID, WIFI_PASSWORD)
+        self._joining_since = time.ticks_ms()
+        print(f"Connecting to {WIFI_SSID}...")
+    
+    async def connect_async(self, timeout=30):
+        """Connect to WiFi network without blocking the event loop"""
+        if self.wlan.isconnected():
+            self._joining_since = None
+            return True
+            
+        self.begin()
+        start_ms = self._joining_since
+        try:
+            while not self.wlan.isconnected():
+                if time.ticks_diff(time.ticks_ms(), start_ms) > timeout * 1000:
+                    print("WiFi connection timeout")
+                    return False
+                # Short polls: the link is usually up well within a second of association
+                await asyncio.sleep_ms(50)
+        finally:
+            self._joining_since = None
+            
+        print(f"Connected to WiFi: {self.wlan.ifconfig()}")
+        return True
+    
     def disconnect(self):
         """Disconnect from WiFi"""
         if self.wlan.isconnected():
             self.wlan.disconnect()
             print("Disconnected from WiFi")
     
+    def set_power_save(self, enabled):
+        """Switch the radio between PM_POWERSAVE and PM_PERFORMANCE"""
+        if enabled == self.power_save or not self._power_save_supported:
+            return
+        try:
+            self.wlan.config(pm=network.WLAN.PM_POWERSAVE if enabled else network.WLAN.PM_PERFORMANCE)
+            self.power_save = enabled
+            print(f"WiFi power save {'on' if enabled else 'off'}")
+        except (AttributeError, ValueError, OSError) as e:
+            print(f"WiFi power save not supported: {e}")
+            self._power_save_supported = False
+    
     def is_connected(self):
         """Check if connected to WiFi"""
         return self.wlan.isconnected()
@@ -42,5 +93,6 @@ class WiFiManager:
         return {
             'connected': self.wlan.isconnected(),
             'ip': self.wlan.ifconfig()[0] if self.wlan.isconnected() else None,
-            'ssid': WIFI_SSID
+            'ssid': WIFI_SSID,
+            'power_save': self.power_save
         }
\ No newline at end of file